@@ -15,136 +15,618 @@
 """Script con la aplicación principal"""
 
 # Librerías internas de python
-from datetime import datetime
 from io import BytesIO
-import pytz
-import time
-from typing import Tuple
+import os
+from pathlib import Path, PurePath
+from typing import List, Optional, Tuple
+import zipfile
 # Librerías de terceros
-from matplotlib.ticker import MaxNLocator
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from PIL import Image
 import streamlit as st
 # Librerías propias del proyecto
-from models.convnet_model import load_model
+from charts import (plot_aciertos_acumulados, plot_digitos, plot_explicacion, plot_precision_por_digito,
+                    serie_confianzas)
+from history import FORMATOS_EXPORTACION, HistoryStore
+from ingestion import ERROR_NO_VALIDA, are_valid_images, decode_digit, is_valid_image, process_image
+from metrics import get_registry, timed, timer
+from models.cache import PredictionCache, cache_from_env
+from models.calibration import NUM_VARIANTES, aggregate, augment
+from models.cascade import FirstStage, early_exits, get_cascade_threshold, get_first_stage
+from models.convnet_model import (get_backend, get_batcher, get_calibrator, get_model_registry,
+                                  get_model_version, start_warm_up)
+from models.explain import PARCHE, TAMAÑOS_PARCHE, gradient_saliency, image_digest, occlusion_map
+from models.pipeline import cache_namespace, predict_images
+from server import start_http_server
+from session import get_session
 from streamlit_func import show_sidebar, config_page
 
 # Constantes #
 DAY_HOUR_FORMAT = """%d/%m/%y\n%H:%M"""
 DAY_FORMAT = "%d/%m/%y"
-COLOR_BLUE = '#213f99'
+IMAGE_TYPES = ["png","tif","jpg","bmp","jpeg"]
+BATCH_SIZE = 64
+MAX_DIGITOS_VISTA = 20
+MODO_INDIVIDUAL = 'Imagen individual'
+MODO_LOTE = 'Lote de imágenes'
+PREDICT_TIMEOUT = 60
+HISTORY_DB_ENV = 'KOPURU_HISTORY_DB'
+HISTORY_DB_DEFAULT = '.cache/historial.sqlite3'
+MAX_FILAS_TABLA = 1000
+# Archivos subidos cuya decodificación se guarda en caché
+MAX_ARCHIVOS_DECODIFICADOS = 256
+# Formatos de exportación del historial por etiqueta
+ETIQUETAS_EXPORTACION = {'Parquet': 'parquet', 'Arrow IPC': 'arrow'}
+# Por debajo de esta confianza (ya calibrada) la predicción se marca en rojo
+UMBRAL_CONFIANZA = 0.7
+# Modos de explicación de la tab Ver dígito
+EXPLICACION_NINGUNA = 'Ninguna'
+EXPLICACION_OCLUSION = 'Oclusión'
+EXPLICACION_SALIENCIA = 'Saliencia (gradiente)'
+MAX_EXPLICACIONES = 64
 
 # Funciones auxiliares #
-def process_image(img_array:np.ndarray) -> np.ndarray:
-    """Preprocesa la imagen cargada para adecuarla a los requerimientos
-    del modelo
+def rerun_app(mensaje:Optional[str]=None) -> None:
+    """Vuelve a ejecutar la app completa cuando una tab, que es un fragment,
+    cambia algo que muestran otras tabs. El mensaje se muestra como toast
+    en la nueva ejecución, ya que lo que se escribe antes del rerun se pierde"""
+    get_session().aviso = mensaje
+    st.rerun()
+
+def show_prediction(pred:int, conf:float) -> None:
+    """Muestra el dígito predicho y la confianza. Si la confianza calibrada es menor
+    del umbral ponemos un signo menos para que streamlit lo muestre en color rojo"""
+    st.metric('Predicción del modelo', value=pred, delta=f"{'-' if conf < UMBRAL_CONFIANZA else ''}{conf:.2%}")
+
+@st.cache_resource()
+def get_prediction_cache(namespace:str) -> PredictionCache:
+    """Devuelve la caché de predicciones compartida por todas las sesiones.
+    Por defecto se respalda en disco para sobrevivir a los reinicios.
+    Se configura con KOPURU_CACHE_DB, KOPURU_CACHE_TTL y KOPURU_CACHE_MAX_ROWS
+    (ver cache_from_env)
 
     Parameters
     ----------
-    img_array : np.ndarray
-        Imagen en formato array sin procesar
+    namespace : str
+        Versión del modelo y backend, separa las predicciones de cada uno
 
     Returns
     -------
-    np.ndarray
-        Imagen reescalada con el formato adecuado para alimentar el modelo
+    PredictionCache
+        Caché de predicciones del modelo y backend activos
     """
-    img_process = img_array.reshape(1,28,28,1).astype(np.float32) / 255
-    return img_process
-
-@st.cache_data()
-def predict(img_processed:np.ndarray) -> Tuple[int, float]:
-    """Lanza el modelo sobre la imagen procesada
-    y devuelve una tupla con la predicción del modelo
-    y la confianza
+    return cache_from_env(namespace)
+
+def get_cascade(tta:bool=False) -> Optional[FirstStage]:
+    """Devuelve la primera etapa de la cascada, o None si no está entrenada.
+    Con TTA no se usa, ya que el TTA busca precisamente la predicción más robusta"""
+    return None if tta else get_first_stage()
+
+def get_active_cache(tta:bool=False) -> PredictionCache:
+    """Devuelve la caché de predicciones de la versión del modelo y el backend activos.
+    El modo de predicción (con su primera etapa y umbral si hay cascada) y la
+    temperatura de calibración también forman parte del namespace, ya que
+    cambian la predicción o la confianza guardadas"""
+    return get_prediction_cache(cache_namespace(get_model_version(), get_backend(), get_cascade(tta),
+                                                get_cascade_threshold(), get_calibrator().temperature(tta), tta))
+
+@timed('predict')
+def predict(img_array:np.ndarray, tta:bool=False) -> Tuple[int, float]:
+    """Lanza el modelo sobre la imagen y devuelve una tupla con
+    la predicción del modelo y la confianza calibrada. Si la misma imagen
+    ya se ha predicho antes se devuelve desde la caché sin pasar por el modelo,
+    y si la primera etapa de la cascada está segura se devuelve su predicción
 
     Parameters
     ----------
-    img_processed : np.ndarray
-        Imagen en formato array de numpy con el formato
-        adecuado
+    img_array : np.ndarray
+        Imagen (28, 28) en formato array sin procesar
+    tta : bool, optional
+        Promedia la predicción de varias versiones desplazadas, giradas y
+        escaladas de la imagen, que se encolan juntas en un solo lote, by default False
 
     Returns
     -------
     Tuple[int, float]
         Dígito predicho y confianza
     """
-    # Cargamos el modelo
-    model = load_model()    
-    # Sacamos array de probabilidades
-    probs:np.ndarray = model.predict(img_processed)
+    registry = get_registry()
+    cache = get_active_cache(tta)
+    with registry.timer('cache_lookup'):
+        clave = cache.digest(img_array)
+        cached = cache.get(clave)
+    if cached is not None:
+        registry.inc('prediction_cache_hits')
+        return cached
+    registry.inc('prediction_cache_misses')
+    # Si la primera etapa de la cascada está segura, la imagen no llega a la convnet
+    if (etapa := get_cascade(tta)) is not None:
+        registry.inc('cascade_requests')
+        with registry.timer('first_stage'):
+            probs_etapa = etapa.predict(img_array)
+        if early_exits(probs_etapa, get_cascade_threshold())[0]:
+            registry.inc('cascade_early_exits')
+            pred, conf = int(probs_etapa.argmax()), float(probs_etapa.max())
+            cache.put(clave, pred, conf)
+            return pred, conf
+    # Encolamos la imagen en el agrupador compartido, que la juntará con las
+    # peticiones de otras sesiones en una sola pasada del modelo
+    with registry.timer('preprocess'):
+        img_processed = process_image(augment(img_array) if tta else img_array)
+    future = get_batcher().submit(img_processed)
+    # Sacamos array de probabilidades, promediando las variantes si hay TTA
+    probs:np.ndarray = future.result(timeout=PREDICT_TIMEOUT)
+    if tta:
+        probs = aggregate(probs)
+    probs = get_calibrator().calibrate(probs, tta)
     # Sacamos la predicción del dígito
-    pred = np.argmax(probs)
+    pred = int(np.argmax(probs))
     # Sacamos la confianza de dicha predicción
-    conf = probs.max()
+    conf = float(probs.max())
+    cache.put(clave, pred, conf)
     return pred, conf
 
-def reset_predictions() -> None:
-    """Resetea algunas variables de sesión cuando se cambia de imagen cargada
-    o se elimina la imagen cargada"""
-    if 'ultima_prediccion' in st.session_state:
-        del st.session_state['ultima_prediccion']
+@timed('predict_batch')
+def predict_batch(img_batch:np.ndarray, batch_size:int=BATCH_SIZE, tta:bool=False) -> Tuple[np.ndarray, np.ndarray]:
+    """Lanza el modelo sobre un lote de imágenes en una única
+    llamada a predict. Keras se encarga de trocear el lote en micro-batches
+    de tamaño batch_size. Solo pasan por el modelo las imágenes que no
+    están en la caché de predicciones ni salen en la primera etapa de la cascada
+
+    Parameters
+    ----------
+    img_batch : np.ndarray
+        Lote de imágenes sin procesar con forma (N, 28, 28)
+    batch_size : int, optional
+        Tamaño de los micro-batches, by default BATCH_SIZE
+    tta : bool, optional
+        Promedia la predicción de varias variantes de cada imagen. Todas las
+        variantes del lote van al modelo en la misma llamada, by default False
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Arrays de dígitos predichos y de confianzas calibradas, ambos de longitud N
+    """
+    registry = get_registry()
 
-def get_timestamp(formato:str) -> str:
-    """Recibe un formato de timestamp en string y devuelve
-    en ese formato el momento del día actual
+    def forward(img_processed:np.ndarray) -> np.ndarray:
+        # Tomamos prestado el modelo activo para que un cambio de versión espere a este lote.
+        # Con TTA los micro-batches crecen en proporción para mantener el número de llamadas
+        with registry.timer('forward_batch'), get_model_registry().lease(get_backend()) as model:
+            return model.predict(img_processed, batch_size=batch_size * (NUM_VARIANTES if tta else 1), verbose=0)
+
+    # Mismo camino que el servidor HTTP: caché, cascada y convnet
+    return predict_images(img_batch, forward, get_active_cache(tta), get_calibrator(), registry,
+                          etapa=get_cascade(tta), umbral=get_cascade_threshold(), tta=tta)
+
+@st.cache_data(max_entries=MAX_ARCHIVOS_DECODIFICADOS, show_spinner=False)
+def decode_upload(file_id:str, _archivo) -> np.ndarray:
+    """Decodifica y normaliza al formato MNIST una imagen subida. El resultado
+    se guarda en caché por el id del archivo subido, así que los reruns
+    no vuelven a decodificar la imagen
 
     Parameters
     ----------
-    formato : str
-        Formato de tipo datetime para mostrar
-        Por ejemplo: %d/%m/%y
+    file_id : str
+        Id del archivo subido, clave de la caché
+    _archivo : UploadedFile
+        Archivo devuelto por st.file_uploader, no forma parte de la clave
 
     Returns
     -------
-    str
-        Devuelve momento actual del día
-        en el formato especificado
+    np.ndarray
+        Imagen (28, 28) uint8
     """
-    return datetime.strftime(datetime.now(tz=pytz.timezone('Europe/Madrid')),format=formato)
+    with timer('decode'):
+        return decode_digit(_archivo.getvalue())
 
-# Validaciones #
-def pred_already_saved(filename:str) -> bool:
-    """Comprueba si el nombre de archivo está guardado ya en el historial.
-    Devuelve True si ya ha sido guardado y False en caso contrario
+@st.cache_data(max_entries=MAX_ARCHIVOS_DECODIFICADOS, show_spinner=False)
+def decode_upload_many(file_id:str, _archivo) -> Tuple[List[str], List[np.ndarray], List[Tuple[str, str]]]:
+    """Decodifica un archivo subido en modo lote, que puede ser una imagen
+    suelta o un ZIP con imágenes. Se guarda en caché por el id del archivo
 
     Parameters
     ----------
-    filename : str
-        _description_
+    file_id : str
+        Id del archivo subido, clave de la caché
+    _archivo : UploadedFile
+        Archivo devuelto por st.file_uploader, no forma parte de la clave
 
     Returns
     -------
-    bool
-        True si el nombre del archivo está en historial
-        False en caso contrario
+    Tuple[List[str], List[np.ndarray], List[Tuple[str, str]]]
+        Nombres de las imágenes decodificadas, imágenes (28, 28)
+        y lista de tuplas (nombre, mensaje de error)
     """
-    return any(filename in pred.values() for pred in st.session_state['historial'])
+    nombres, imagenes, errores = [], [], []
+
+    def añadir(nombre:str, contenido:bytes) -> None:
+        try:
+            imagenes.append(decode_digit(contenido))
+        except Exception as exc:
+            errores.append((nombre, f'No se ha podido leer la imagen: {exc}'))
+            return
+        nombres.append(nombre)
+
+    contenido = _archivo.getvalue()
+    if not zipfile.is_zipfile(BytesIO(contenido)):
+        añadir(_archivo.name, contenido)
+    else:
+        with zipfile.ZipFile(BytesIO(contenido)) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or PurePath(info.filename).suffix.lower().lstrip('.') not in IMAGE_TYPES:
+                    continue
+                añadir(f'{_archivo.name}/{info.filename}', zf.read(info))
+    return nombres, imagenes, errores
+
+@timed('decode_batch')
+def decode_images(archivos:list) -> Tuple[List[str], np.ndarray, List[Tuple[str, str]]]:
+    """Decodifica una lista de archivos cargados (imágenes sueltas o ZIPs con imágenes),
+    los normaliza al formato MNIST y los apila en un único array (N, 28, 28).
+    Las imágenes que no se pueden decodificar o no pasan la validación
+    se devuelven como errores
 
-def is_valid_image(img_array:np.ndarray) -> Tuple[bool, str]:
-    """Realiza validaciones al array de la imagen.
-    Devuelve una tupla con un bool y un mensaje de error
+    Parameters
+    ----------
+    archivos : list
+        Lista de archivos devuelta por st.file_uploader
+
+    Returns
+    -------
+    Tuple[List[str], np.ndarray, List[Tuple[str, str]]]
+        Nombres de las imágenes válidas, lote de imágenes válidas
+        y lista de tuplas (nombre, mensaje de error)
+    """
+    nombres, imagenes, errores = [], [], []
+    for archivo in archivos:
+        nombres_archivo, imagenes_archivo, errores_archivo = decode_upload_many(archivo.file_id, archivo)
+        nombres.extend(nombres_archivo)
+        imagenes.extend(imagenes_archivo)
+        errores.extend(errores_archivo)
+
+    if not imagenes:
+        return [], np.empty((0, 28, 28), dtype=np.uint8), errores
+    lote = np.stack(imagenes)
+    # Validamos todo el lote de una vez
+    validas = are_valid_images(lote)
+    errores.extend((nombre, ERROR_NO_VALIDA) for nombre, valida in zip(nombres, validas) if not valida)
+    nombres = [nombre for nombre, valida in zip(nombres, validas) if valida]
+    return nombres, lote[validas], errores
+
+@st.cache_resource()
+def get_history_store() -> HistoryStore:
+    """Devuelve el historial de evaluaciones compartido por todas las sesiones.
+    Se guarda en SQLite para sobrevivir a los reinicios. La ruta se configura
+    con KOPURU_HISTORY_DB (vacía para usar solo memoria)
+
+    Returns
+    -------
+    HistoryStore
+        Historial persistente de evaluaciones
+    """
+    db_path = os.environ.get(HISTORY_DB_ENV, HISTORY_DB_DEFAULT)
+    return HistoryStore(Path(db_path) if db_path else None)
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def export_history(version:int, formato:str) -> bytes:
+    """Exporta el historial completo. La versión del historial forma parte
+    de la clave para no volver a serializarlo en cada rerun si no ha cambiado"""
+    return get_history_store().export(formato)
+
+@st.cache_data(max_entries=MAX_EXPLICACIONES, show_spinner=False)
+def explain(digest:str, modo:str, parche:int, version:str, backend:str, _img_array:np.ndarray) -> Tuple[np.ndarray, int]:
+    """Calcula el mapa de explicación de una imagen. Se cachea por el digest de
+    la imagen, el modo, el parche y la versión del modelo y el backend, así que
+    los reruns y las sesiones que suben la misma imagen no lo vuelven a calcular
 
     Parameters
     ----------
-    img_array : np.ndarray
-        La imagen en formato array de numpy
+    digest : str
+        Digest de la imagen, forma parte de la clave en lugar de la imagen
+    modo : str
+        EXPLICACION_OCLUSION o EXPLICACION_SALIENCIA
+    parche : int
+        Lado del parche de la oclusión
+    version : str
+        Versión del modelo activo
+    backend : str
+        Backend de inferencia
+    _img_array : np.ndarray
+        Imagen (28, 28) sin procesar, no forma parte de la clave
+
+    Returns
+    -------
+    Tuple[np.ndarray, int]
+        Mapa (28, 28) y dígito explicado
+    """
+    if modo == EXPLICACION_SALIENCIA:
+        # El gradiente necesita el modelo de Keras sea cual sea el backend
+        with timer('explain_saliency'), get_model_registry().lease('keras') as model:
+            return gradient_saliency(model, _img_array)
+    # Todas las variantes tapadas se puntúan en una sola pasada del modelo
+    with timer('explain_occlusion'), get_model_registry().lease(backend) as model:
+        return occlusion_map(model.predict_on_batch, _img_array, parche=parche)
+
+# Validaciones #
+def pred_already_saved(filename:str) -> bool:
+    """Comprueba si la sesión ha guardado ya el nombre de archivo en el historial.
+    Devuelve True si ya ha sido guardado y False en caso contrario
+
+    Parameters
+    ----------
+    filename : str
+        Nombre del archivo de la imagen evaluada
 
     Returns
     -------
-    Tuple[bool, str]
-        True, "" si la imagen es válida
-        False, "mensaje de error" si la imagen no es válida
+    bool
+        True si la sesión ya ha guardado el archivo en el historial
+        False en caso contrario
     """
-    # Si hay más de un 95% de negro o menos de un 10% consideramos que el número no puede ser válido
-    if (np.count_nonzero(img_array == 0) > 0.95 * img_array.size) or (np.count_nonzero(img_array == 0) < 0.10 * img_array.size):
-        return False, "La imagen no es válida. Carga una imagen con un dígito en blanco sobre fondo negro."
-    # Comprobamos la shape de la imagen, que debe ser 28 x 28 píxeles
-    if img_array.shape != (28, 28):
-        return False, f"La dimensión de la imagen debe ser (28, 28). La imagen cargada es {img_array.shape}."
-    return True, ""
+    return get_history_store().saved(filename, get_session().id)
+
+# Tabs #
+def show_upload_tab() -> None:
+    """Tab de carga: decodifica y valida la imagen o el lote subido y lo guarda en la sesión"""
+    sesion = get_session()
+    # Olvidamos lo cargado antes, lo volvemos a leer de los archivos subidos
+    sesion.clear_upload()
+    st.write('''Carga tu imagen con el dígito dibujado. 
+        Puede ser de cualquier tamaño, en color o en escala de grises.<br>El dígito se
+        recorta, se centra y se pasa a blanco sobre fondo negro.''', unsafe_allow_html=True)
+    
+    modo = st.radio('Modo de carga', [MODO_INDIVIDUAL, MODO_LOTE], horizontal=True, on_change=sesion.reset_predictions)
+    sesion.lote = modo == MODO_LOTE
+    if not sesion.lote:
+        imagen_bruta = st.file_uploader('Sube tu dígito', type=IMAGE_TYPES, on_change=sesion.reset_predictions)
+        # Si hay imagen cargada, convertimos en array la imagen y realizamos las validaciones de la imagen
+        if imagen_bruta is not None:
+            # Decodificamos y normalizamos la imagen al formato MNIST.
+            # Se guarda en caché por archivo, los reruns no la vuelven a decodificar
+            try:
+                img_array = decode_upload(imagen_bruta.file_id, imagen_bruta)
+            except Exception as exc:
+                st.error(f'No se ha podido leer la imagen: {exc}')
+                return
+            # Realizamos validaciones sobre la imagen
+            with timer('validate'):
+                valid_img, error_msg = is_valid_image(img_array)
+            # Si la imagen no es válida mostramos mensaje de error y no la guardamos en sesión.
+            # Forzamos al usuario a cargar una nueva imagen válida
+            if not valid_img:
+                st.error(error_msg)
+                return
+            # Si la imagen es válida guardamos en sesión la imagen y el nombre del archivo
+            sesion.nombre_imagen, sesion.img_array = imagen_bruta.name, img_array
+            # Este mensaje solo se mostrará si hay una imagen cargada y si la imagen está validada
+            st.success('Imagen cargada correctamente.')
+    else:
+        archivos = st.file_uploader('Sube tus dígitos o un ZIP con ellos', type=IMAGE_TYPES + ['zip'],
+                                    accept_multiple_files=True, on_change=sesion.reset_predictions)
+        if archivos:
+            # Decodificamos y validamos todas las imágenes del lote
+            nombres_lote, lote_array, errores = decode_images(archivos)
+            if errores:
+                with st.expander(f'{len(errores)} imágenes descartadas'):
+                    st.dataframe(pd.DataFrame(errores, columns=['archivo', 'error']), 
+                                 use_container_width=True, hide_index=True)
+            if nombres_lote:
+                sesion.nombre_imagen = f'{len(nombres_lote)} imágenes'
+                sesion.nombres_lote, sesion.lote_array = nombres_lote, lote_array
+                st.success(f'{len(nombres_lote)} imágenes cargadas correctamente.')
+            else:
+                st.error('Ninguna de las imágenes cargadas es válida.')
+
+def show_explanation(img_array:np.ndarray) -> None:
+    """Muestra el mapa de explicación elegido sobre la imagen"""
+    modo = st.radio('Explicación', [EXPLICACION_NINGUNA, EXPLICACION_OCLUSION, EXPLICACION_SALIENCIA],
+                    horizontal=True, help='Qué zonas de la imagen han llevado al modelo a su predicción')
+    if modo == EXPLICACION_NINGUNA:
+        return
+    parche = PARCHE
+    if modo == EXPLICACION_OCLUSION:
+        parche = st.select_slider('Tamaño del parche', TAMAÑOS_PARCHE, value=PARCHE)
+    digest = image_digest(img_array)
+    version, backend = get_model_version(), get_backend()
+    with st.spinner('Calculando la explicación...'):
+        mapa, clase = explain(digest, modo, parche, version, backend, img_array)
+    st.image(plot_explicacion(f'{digest}:{modo}:{parche}:{version}:{backend}', img_array, mapa,
+                              f'{modo} para la predicción {clase}'))
+    if modo == EXPLICACION_OCLUSION:
+        st.caption(f'En rojo, las zonas que al taparlas con un parche de {parche}x{parche} píxeles '
+                   f'bajan la probabilidad del {clase}. En azul, las que la suben.')
+    else:
+        st.caption(f'Píxeles en los que un pequeño cambio más afecta a la probabilidad del {clase}.')
+
+@st.fragment
+def show_digit_tab() -> None:
+    """Tab que muestra la imagen cargada o los primeros dígitos del lote"""
+    sesion = get_session()
+    # Verificamos que tengamos una imagen cargada y validada en sesión
+    if sesion.nombre_imagen:
+        # Mostramos en una sola tira los primeros dígitos del lote.
+        # La figura se cachea por imagen, los reruns no la vuelven a dibujar
+        imagenes = sesion.lote_array[:MAX_DIGITOS_VISTA] if sesion.lote else sesion.img_array[None]
+        with timer('render_digit'):
+            st.image(plot_digitos(imagenes, sesion.nombre_imagen))
+        if not sesion.lote:
+            show_explanation(sesion.img_array)
+    else:
+        st.info('Carga una imagen para visualizar.')
+
+@st.fragment
+def show_predict_tab() -> None:
+    """Tab de predicción de la imagen o del lote cargado"""
+    sesion = get_session()
+    tta = st.toggle('Aumentado en test (TTA)', on_change=sesion.reset_predictions,
+                    help='Promedia la predicción de varias versiones desplazadas, giradas y escaladas '
+                         'de cada imagen. Todas pasan por el modelo en un único lote')
+    if sesion.lote:
+        # Mostramos las predicciones del lote si ya se han lanzado
+        if sesion.predicciones_lote is not None:
+            st.dataframe(pd.DataFrame(sesion.predicciones_lote), use_container_width=True, hide_index=True)
+        elif sesion.nombre_imagen:
+            batch_size = st.number_input('Tamaño de micro-batch', min_value=1, max_value=1024, value=BATCH_SIZE)
+            if st.button(f'Predecir lote de {len(sesion.nombres_lote)} imágenes'):
+                with st.spinner(text='Prediciendo dígitos...'):
+                    try:
+                        # Una única pasada del modelo para todo el lote
+                        preds, confs = predict_batch(sesion.lote_array, batch_size=int(batch_size), tta=tta)
+                    except Exception as exc:
+                        st.error(f'Se ha producido un error al predecir: {exc}')
+                        return
+                sesion.predicciones_lote = [
+                    {'archivo': nombre, 'pred': int(pred), 'conf': float(conf)}
+                    for nombre, pred, conf in zip(sesion.nombres_lote, preds, confs)
+                ]
+                # La tab de evaluación tiene que ver las predicciones nuevas
+                rerun_app()
+        else:
+            st.info('Carga un lote de imágenes para predecir.')
+    # Comprobamos si se ha lanzado una predicción y por tanto está almacenada en sesión.
+    # Si tenemos una predicción la mostramos
+    elif (last_pred:=sesion.ultima_prediccion) is not None:
+        show_prediction(last_pred['pred'], last_pred['conf'])
+    # Si no se ha lanzado una predicción, mostramos mecanismo para lanzarla
+    # Verificamos que tengamos una imagen cargada y validada en sesión
+    elif sesion.nombre_imagen:
+        if st.button(f'Predecir "{sesion.nombre_imagen}"'):
+            # Lanzamos las predicciones
+            with st.spinner(text='Prediciendo dígito...'):
+                try:
+                    pred, conf = predict(sesion.img_array, tta=tta)
+                except Exception as exc:
+                    st.error(f'Se ha producido un error al predecir: {exc}')
+                    return
+            # Guardamos en sesión
+            sesion.ultima_prediccion = {
+                'pred': int(pred),
+                'conf': conf,
+                'archivo': sesion.nombre_imagen,
+            }
+            rerun_app()
+    else:
+        st.info('Carga una imagen para predecir.')
+
+@st.fragment
+def show_evaluate_tab() -> None:
+    """Tab en la que el usuario indica el dígito real y guarda la evaluación en el historial"""
+    sesion = get_session()
+    historial = get_history_store()
+    # En modo lote el usuario marca el dígito real de cada imagen en una tabla editable
+    if sesion.lote:
+        if sesion.predicciones_lote is not None:
+            st.subheader('¿ Ha acertado el modelo ?')
+            # Por defecto el dígito real es el predicho, solo hay que corregir los fallos
+            df_lote = pd.DataFrame(sesion.predicciones_lote).assign(real=lambda df: df['pred'])
+            df_lote = st.data_editor(df_lote, use_container_width=True, hide_index=True,
+                                     disabled=['archivo', 'pred', 'conf'],
+                                     column_config={'real': st.column_config.NumberColumn(min_value=0, max_value=9, step=1)})
+            if st.button('Guardar evaluaciones', help='Añade las evaluaciones del lote al historial'):
+                # Una celda vaciada en la tabla llega como NaN. Esas filas no se guardan
+                validas = df_lote['real'].between(0, 9) & (df_lote['real'] % 1 == 0)
+                if not validas.all():
+                    st.warning(f'{int((~validas).sum())} evaluaciones sin un dígito real entre 0 y 9 '
+                               f'no se han guardado: {", ".join(df_lote.loc[~validas, "archivo"])}')
+                try:
+                    # Añadimos todas las evaluaciones de una vez, el historial descarta las ya guardadas
+                    guardadas = historial.add_many(df_lote[validas].astype({'real': int}).assign(sesion=sesion.id).to_dict('records'))
+                except Exception as exc:
+                    st.error(f'No se han podido guardar las evaluaciones: {exc}')
+                    return
+                mensaje = f'{guardadas} evaluaciones guardadas correctamente.'
+                # La tab de estadísticas tiene que ver las evaluaciones nuevas. Si hay
+                # filas descartadas no se vuelve a ejecutar para que se vea el aviso
+                if guardadas and validas.all():
+                    rerun_app(mensaje)
+                st.success(mensaje)
+        else:
+            st.info('Lanza una predicción del lote para evaluar.')
+    # Verificamos si hay una predicción lanzada y guardada en sesión
+    elif (last_pred:=sesion.ultima_prediccion) is not None:
+        # Posibilidad de contrastar con la realidad para almacenar porcentaje de aciertos
+        st.subheader('¿ Ha acertado el modelo ?')
+        digit = st.number_input('Marca el dígito que habías dibujado', min_value=0, max_value=9)
+        # Si se pulsa el botón
+        if st.button('Guardar evaluación', help='Añade la evaluación al historial'):
+            # Comprobamos que no hayamos guardado ya en sesión para no falsear las estadísticas
+            if not pred_already_saved(last_pred['archivo']):
+                # Añadimos al historial la predicción con la evaluación del usuario
+                historial.add({**last_pred, 'real': digit, 'sesion': sesion.id})
+                # Volvemos a ejecutar la app para actualizar las estadísticas, con mensaje de éxito
+                rerun_app('Evaluación guardada correctamente.')
+            else:
+                # Mostramos advertencia
+                st.info('La evaluación ya se ha guardado.')
+    else:
+        st.info('Lanza una predicción para evaluar.')
+
+@st.fragment
+def show_stats_tab() -> None:
+    """Tab con las estadísticas del historial y su exportación e importación"""
+    sesion = get_session()
+    historial = get_history_store()
+    if historial.descartadas:
+        st.warning(f'{len(historial.descartadas)} filas de la base de datos del historial no son válidas y no se '
+                   f'han cargado (ids {", ".join(map(str, historial.descartadas[:10]))}'
+                   f'{"…" if len(historial.descartadas) > 10 else ""}).')
+    # Comprobamos que haya historial guardado
+    if len(historial):
+        # Resumen a partir de los agregados del historial
+        resumen = historial.summary()
+        col_total, col_precision, col_conf = st.columns(3)
+        col_total.metric('Evaluaciones', resumen['total'])
+        col_precision.metric('Aciertos', f"{resumen['precision']:.2%}")
+        col_conf.metric('Confianza media', f"{resumen['conf_media']:.2%}")
+        # Las series y agregados se mantienen de forma incremental en el historial
+        stats = historial.stats
+
+        with timer('render_charts'):
+            # Gráfico de evolución de confianzas
+            st.line_chart(serie_confianzas(historial.version, stats.confianzas.values))
+
+            # Curva de aciertos acumulados, solo se vuelve a dibujar si cambia el historial
+            st.image(plot_aciertos_acumulados(historial.version, stats.aciertos_acumulados.values, historial.fecha))
+
+            # Porcentaje de aciertos y conteo de predicciones de los dígitos reales evaluados
+            digitos = np.flatnonzero(stats.conteo)
+            st.image(plot_precision_por_digito(historial.version, digitos, 
+                                               stats.precision_por_digito()[digitos], stats.conteo[digitos]))
+
+        # Matriz de confusión: filas dígito real, columnas dígito predicho
+        st.write('Matriz de confusión (filas: dígito real, columnas: predicción)')
+        st.dataframe(pd.DataFrame(stats.confusion), use_container_width=True)
+
+        # Mostramos las evaluaciones más recientes
+        # La fecha se guarda como epoch y solo se formatea aquí, para las filas que se muestran
+        st.dataframe(historial.to_frame(ultimos=MAX_FILAS_TABLA, formato=DAY_HOUR_FORMAT)[::-1],
+                     use_container_width=True, hide_index=True,
+                     column_order=['archivo', 'pred', 'conf', 'real', 'fecha'])
+
+    # Si no hay historial (lista vacía) mostramos mensaje de información 
+    else:
+        st.info('No hay estadísticas disponibles.')
+
+    # Exportación e importación del historial completo
+    with st.expander('Exportar / importar historial'):
+        formato = ETIQUETAS_EXPORTACION[st.radio('Formato', list(ETIQUETAS_EXPORTACION), horizontal=True)]
+        if len(historial):
+            st.download_button('Descargar historial', data=export_history(historial.version, formato),
+                               file_name=f'historial.{formato}', mime='application/octet-stream')
+        archivo_historial = st.file_uploader('Importar historial', type=list(FORMATOS_EXPORTACION),
+                                             help='Las evaluaciones de archivos que ya has guardado se ignoran')
+        if archivo_historial is not None and sesion.historial_importado != archivo_historial.file_id:
+            try:
+                importadas = historial.import_(archivo_historial.getvalue(), sesion.id)
+            except Exception as exc:
+                st.error(f'No se ha podido importar el historial: {exc}')
+            else:
+                # Recordamos el archivo para no volver a importarlo en cada rerun
+                sesion.historial_importado = archivo_historial.file_id
+                st.success(f'{importadas} evaluaciones importadas.')
+                # Volvemos a ejecutar la tab para mostrar las estadísticas con lo importado
+                st.rerun()
 
 # Función principal #
 def main() -> None:
@@ -152,198 +634,48 @@ def main() -> None:
 
     # Configuración de la app
     config_page()
+    # Adoptamos la versión del modelo elegida desde otro proceso, si ha cambiado
+    get_model_registry().sync()
+    # Precargamos el modelo en segundo plano mientras el usuario carga su imagen
+    start_warm_up()
+    # Servidor HTTP de inferencia con el mismo modelo, si se ha definido KOPURU_HTTP_PORT
+    start_http_server()
     # Mostramos la Sidebar que hemos configurado en streamlit_func
     show_sidebar()
+    # Mensaje de una tab que ha vuelto a ejecutar la app
+    sesion = get_session()
+    if sesion.aviso:
+        st.toast(sesion.aviso)
+        sesion.aviso = None
     # Título y descripción de la app
     st.title('Reconocimiento de dígitos')
     st.subheader('Una App para Kopuru')
     st.write('''Con esta app serás capaz de evaluar un modelo convolucional entrenado 
                 con el dataset [MNIST](https://www.kaggle.com/datasets/hojjatk/mnist-dataset).<br>
-                Sube una imagen monocanal (escala de grises) de dimensiones 28x28 píxeles con
-                un dígito dibujado en color blanco sobre fondo negro.<br>
+                Sube una imagen o una foto con un dígito dibujado. Se convierte automáticamente
+                al formato de MNIST: 28x28 píxeles en escala de grises con el dígito en blanco sobre fondo negro.<br>
                 Pulsa sobre el botón **predecir** y comprueba si el modelo ha sido
                 capaz de averiguar el dígito que habías dibujado.''', unsafe_allow_html=True)
     
-    # Inicializamos variables de sesión para llevar un registro de las predicciones
-    if st.session_state.get('historial') is None:
-        st.session_state['historial'] = []
-    # Flag para saber si tenemos una imagen cargada y validada
-    st.session_state['imagen_cargada_y_validada'] = False
+    # Historial compartido. Traemos las evaluaciones guardadas por otros procesos
+    get_history_store().sync()
     # Definimos las 5 tabs que tendrá nuestra app
     tab_cargar_imagen, tab_ver_digito, tab_predecir, \
         tab_evaluar, tab_estadisticas = st.tabs(['Cargar imagen', 'Ver dígito', 
                                         'Predecir', 'Evaluar', 'Ver estadísticas'])
-    ################
-    ## TAB Cargar ##
-    ################
+    # La carga se ejecuta con toda la app, ya que una imagen nueva cambia todas las tabs.
+    # El resto de tabs son fragments que se vuelven a ejecutar solas al tocar sus widgets
     with tab_cargar_imagen:
-        st.write('''Carga tu imagen con el dígito dibujado. 
-            Recuerda que debe ser una imagen de 28x28 píxeles.<br>El dígito debe estar
-            dibujado en blanco sobre color negro.''', unsafe_allow_html=True)
-        
-        imagen_bruta = st.file_uploader('Sube tu dígito', type=["png","tif","jpg","bmp","jpeg"], on_change=reset_predictions)
-        # Si hay imagen cargada, convertimos en array la imagen y realizamos las validaciones de la imagen
-        if imagen_bruta is not None:
-            # Utilizamos el wrapper BytesIO para cargar bytes en la calse Image de PIL
-            # Transformamos la imagen en array de numpy
-            img_array = np.array(Image.open(BytesIO(imagen_bruta.read())))
-            # Realizamos validaciones sobre la imagen
-            valid_img, error_msg = is_valid_image(img_array)
-            # Si la imagen no es válida mostramos mensaje de error y paramos la ejecución de la app
-            # Forzamos al usuario a cargar una nueva imagen válida
-            if not valid_img:
-                st.error(error_msg)
-                st.stop() # Lo que viene después del stop no se ejecutará.
-            # Si la imagen es válida guardamos en sesión el nombre del archivo y mostramos un mensaje de éxito
-            st.session_state['imagen_cargada_y_validada'] = imagen_bruta.name
-            # Este mensaje solo se mostrará si hay una imagen cargada y si la imagen está validada
-            st.success('Imagen cargada correctamente.')
-
-    ################
-    ## TAB Dígito ##
-    ################        
+        show_upload_tab()
     with tab_ver_digito:
-        # Verificamos que tengamos una imagen cargada y validada en sesión
-        if nombre_archivo:=st.session_state.get('imagen_cargada_y_validada'):
-            fig, ax = plt.subplots(figsize=(5, 2))
-            ax.imshow(img_array, cmap="gray")
-            ax.axis('off')
-            ax.set_title(nombre_archivo, fontsize=5)
-            st.pyplot(fig)
-        else:
-            st.info('Carga una imagen para visualizar.')
-
-    ##################
-    ## TAB Predecir ##
-    ##################
+        show_digit_tab()
     with tab_predecir:
-        # Comprobamos si se ha lanzado una predicción y por tanto está almacenada en sesión.
-        # Si tenemos una predicción la mostramos
-        if (last_pred:=st.session_state.get('ultima_prediccion')) is not None:
-            pred = last_pred['pred']
-            conf = last_pred['conf']
-            st.metric('Predicción del modelo', value=pred, delta=f"{'-' if conf < 0.7 else ''}{conf:.2%}")
-        else:
-            # Si no se ha lanzado una predicción, mostramos mecanismo para lanzarla
-            # Verificamos que tengamos una imagen cargada y validada en sesión
-            if nombre_imagen:=st.session_state.get('imagen_cargada_y_validada'):
-                predecir = st.button(f'Predecir "{nombre_imagen}"')
-                if predecir:
-                    # Procesamos la imagen
-                    img_processed = process_image(img_array)
-                    # Lanzamos las predicciones
-                    with st.spinner(text='Prediciendo dígito...'):
-                        try:
-                            pred, conf = predict(img_processed)
-                            time.sleep(1)
-                        except Exception as exc:
-                            st.error(f'Se ha producido un error al predecir: {exc}')
-                            st.stop()
-                    # Si la confianza es menor del 70% ponemos un signo menos para que streamlit lo muestre
-                    # en color rojo
-                    st.metric('Predicción del modelo', value=pred, delta=f"{'-' if conf < 0.7 else ''}{conf:.2%}")
-                    # Guardamos en sesión
-                    st.session_state['ultima_prediccion'] = {
-                        'pred': int(pred),
-                        'conf': conf,
-                        'archivo': nombre_imagen,
-                    }
-                    
-            else:
-                st.info('Carga una imagen para predecir.')
-
-    #################
-    ## TAB Evaluar ##
-    #################
+        show_predict_tab()
     with tab_evaluar:
-        # Verificamos si hay una predicción lanzada y guardada en sesión
-        if (last_pred:=st.session_state.get('ultima_prediccion')) is not None:
-            # Posibilidad de contrastar con la realidad para almacenar porcentaje de aciertos
-            st.subheader('¿ Ha acertado el modelo ?')
-            digit = st.number_input('Marca el dígito que habías dibujado', min_value=0, max_value=9)
-            guardar_pred = st.button('Guardar evaluación', help='Añade la evaluación al historial')
-            # Si se pulsa el botón
-            if guardar_pred:
-                # Comprobamos que no hayamos guardado ya en sesión para no falsear las estadísticas
-                if not pred_already_saved(last_pred['archivo']):
-                    # Añadimos a ultima_prediccion la evaluación del usuario
-                    last_pred['real'] = digit
-                    # Añadimos la hora
-                    last_pred['fecha'] = get_timestamp(DAY_HOUR_FORMAT)
-                    # Añadimos los valores al historial
-                    st.session_state['historial'].append(last_pred)
-                    # Mostramos mensaje de éxito
-                    st.success('Evaluación guardada correctamente.')
-                else:
-                    # Mostramos advertencia
-                    st.info('La evaluación ya se ha guardado.')
-        else:
-            st.info('Lanza una predicción para evaluar.')
-
-    ######################
-    ## TAB Estadísticas ##
-    ######################
+        show_evaluate_tab()
     with tab_estadisticas:
-        # Comprobamos que haya historial guardado en sesión
-        if st.session_state.get('historial'):
-            # Creamos un dataframe con el historial guardado en sesión
-            df = pd.DataFrame(st.session_state.get('historial'))
-            # Sacamos los aciertos comparando la variable pred y real
-            df['acierto'] = df['pred'] == df['real']
+        show_stats_tab()
 
-            # Gráfico de evolución de confianzas
-            st.line_chart(df, x='fecha', y='conf')
-
-            # Ploteamos el acumulado de aciertos para representar la curva de acumulados
-            plt.figure(figsize=(10, 6))
-            plt.plot(np.arange(len(df)), np.cumsum(df['acierto']), label='acumulado aciertos', color=COLOR_BLUE)
-            plt.xlabel('Tiempo')
-            plt.ylabel('Aciertos acumulados')
-            plt.title('Evolución de aciertos a lo Largo del Tiempo')
-            plt.xticks(ticks=range(len(df)), labels=df['fecha'])
-            plt.yticks(ticks=range(len(df)))
-            plt.tight_layout()
-            st.pyplot(plt)    
-
-            # Agrupamos por el dígito real y calculamos el porcentaje de aciertos y el conteo de predicciones
-            precision_y_conteo = df.groupby('real').agg({'acierto': 'mean', 'pred': 'count'})
-            # Multiplicamos por 100 para obtener el porcentaje
-            precision_y_conteo['acierto'] *= 100
-            # Configuración del ancho de las barras
-            bar_width = 0.35
-            # Configuramos las posiciones de las barras
-            indices = np.arange(len(precision_y_conteo))
-            # Creamos el gráfico
-            fig2, ax1 = plt.subplots()
-            # Barras para el porcentaje de aciertos
-            ax1.bar(indices - bar_width/2, precision_y_conteo['acierto'], bar_width, label='% de Aciertos', color='#213f99')
-            # Creamos el segundo eje para el número de intentos
-            ax2 = ax1.twinx()
-            # Barras para el número de intentos de predicción
-            ax2.bar(indices + bar_width/2, precision_y_conteo['pred'], bar_width, label='Número de Predicciones', color='orange')
-            # Configuración de las etiquetas y títulos
-            ax1.set_xlabel('Dígitos')
-            ax1.set_ylabel('% de Aciertos', color=COLOR_BLUE)
-            ax2.set_ylabel('Número de Predicciones', color='orange')
-            # Configuramos el segundo eje y para usar solo números enteros
-            ax2.yaxis.set_major_locator(MaxNLocator(integer=True))
-            ax1.set_xticks(indices)
-            ax1.set_xticklabels(precision_y_conteo.index)
-            #ax1.legend(loc='best')
-            #ax2.legend(loc='best')
-            # Título del gráfico
-            plt.title('Porcentaje de Aciertos y Número de Intentos por Dígito')
-            # Mostramos el gráfico
-            fig2.tight_layout()
-            st.pyplot(fig2)
-
-            # Mostramos el dataframe
-            st.dataframe(df, use_container_width=True, hide_index=True, column_order=['archivo', 'pred', 'conf', 'real', 'fecha'])
-
-        # Si no hay historial en sesión (lista vacía) mostramos mensaje de información 
-        else:
-            st.info('No hay estadísticas disponibles.')
-        
 if __name__ == '__main__':
     main()
     
\ No newline at end of file
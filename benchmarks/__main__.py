@@ -0,0 +1,57 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lanza los benchmarks desde la raíz del repositorio:
+
+    python -m benchmarks --output resultados.json
+    python -m benchmarks --only predict stats --repeat 20
+"""
+
+import argparse
+import json
+import sys
+
+from benchmarks.suite import BENCHMARKS, run
+
+def main() -> None:
+    """Entry point de los benchmarks"""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='Benchmarks a ejecutar')
+    parser.add_argument('--repeat', type=int, default=50, help='Repeticiones de cada medida')
+    parser.add_argument('--output', help='Archivo JSON de salida (por defecto stdout)')
+    args = parser.parse_args()
+
+    resultados = run(args.only, repeat=args.repeat)
+
+    # Resumen legible por stderr para no mezclarlo con el JSON
+    for r in resultados['results']:
+        params = ' '.join(f'{k}={v}' for k, v in r['params'].items())
+        if 'error' in r:
+            print(f"{r['name']:<26} {params:<20} ERROR {r['error']}", file=sys.stderr)
+            continue
+        print(f"{r['name']:<26} {params:<20} p50 {r['p50_ms']:9.3f} ms  p95 {r['p95_ms']:9.3f} ms  "
+              f"p99 {r['p99_ms']:9.3f} ms  {r['throughput']:12.1f} items/s  "
+              f"pico {r['peak_alloc_mb']:7.1f} MB  rss {r['rss_delta_mb']:+7.1f} MB",
+              file=sys.stderr)
+
+    salida = json.dumps(resultados, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(salida)
+    else:
+        print(salida)
+
+if __name__ == '__main__':
+    main()
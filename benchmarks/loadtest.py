@@ -0,0 +1,521 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prueba de carga de la app con sesiones simuladas de streamlit.testing.
+
+Cada sesión es un AppTest que recorre carga -> predicción -> evaluación ->
+estadísticas con un tiempo de reflexión aleatorio entre pasos. Se mide la
+duración de cada rerun, la espera hasta que empieza (sesiones que coinciden
+en el tiempo se atienden de una en una, como un único proceso de streamlit),
+las llamadas al modelo y la memoria del proceso, para varios tamaños de
+historial. No necesita red: usa los weights de models/ y el test de MNIST
+local o, si no está, dígitos sintéticos.
+
+    python -m benchmarks.loadtest --sesiones 8 --iteraciones 5 --think 0.5
+    python -m benchmarks.loadtest --historial 10 100000 --lote 32 --output carga.json
+
+AppTest no admite ejecuciones simultáneas en un mismo proceso, así que las
+sesiones se intercalan en un único hilo y nunca coinciden dos predicciones.
+Para medir el agrupador de peticiones, que es lo que junta las predicciones
+de sesiones simultáneas, después varios hilos clientes lanzan predicciones
+de una imagen directamente contra el agrupador de la app, y se informa de la
+latencia y del tamaño de los lotes que forma. Para simular varias réplicas se
+lanzan varios procesos con la misma KOPURU_HISTORY_DB.
+
+    python -m benchmarks.loadtest --clientes 16 --peticiones 100 --historial 10
+"""
+
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.suite import HISTORY_SIZES, PERCENTILES, current_rss_mb, peak_rss_mb, sample_digits, sample_history
+
+# Constantes
+APP_PATH = Path(__file__).resolve().parent.parent / 'Aplicacion.py'
+# Nombre del módulo con el que se ejecuta la app. No es __main__ para poder
+# llamar a main() desde el script de la sesión
+APP_MODULE = 'kopuru_loadtest_app'
+# Claves de st.session_state con los archivos que "sube" la sesión
+CLAVE_SUBIDAS = 'loadtest_subidas'
+CLAVE_ULTIMA_SUBIDA = 'loadtest_ultima_subida'
+UPLOADERS = ('Sube tu dígito', 'Sube tus dígitos o un ZIP con ellos')
+PASOS = ('inicio', 'carga', 'prediccion', 'evaluacion', 'estadisticas')
+TIMEOUT = 120
+INTERVALO_MEMORIA = 0.5
+NUM_IMAGENES = 1000
+CLIENTES = 8
+PETICIONES = 50
+# Pausa media en segundos entre las peticiones de cada cliente del agrupador
+PAUSA_CLIENTES = 0.002
+
+SESSION_SCRIPT = f'''
+import runpy
+from benchmarks import loadtest
+loadtest.patch_uploader()
+app = runpy.run_path({str(APP_PATH)!r}, run_name={APP_MODULE!r})
+try:
+    app['main']()
+finally:
+    loadtest.capture(app)
+'''
+
+# Estado compartido con el script de las sesiones: el registro de métricas, el historial y el agrupador
+_capturado: Dict[str, object] = {}
+
+# Funciones auxiliares
+def patch_uploader() -> None:
+    """Sustituye st.file_uploader por uno que devuelve los archivos guardados
+    por el harness en la sesión. Llama a on_change cuando cambian, como haría
+    el widget real"""
+    import streamlit as st
+
+    if getattr(st.file_uploader, 'loadtest', False):
+        return
+    original = st.file_uploader
+
+    def file_uploader(label, *args, accept_multiple_files=False, on_change=None, **kwargs):
+        original(label, *args, accept_multiple_files=accept_multiple_files, **kwargs)
+        if label not in UPLOADERS:
+            return [] if accept_multiple_files else None
+        subidas = [SimulatedUpload(*subida) for subida in st.session_state.get(CLAVE_SUBIDAS, [])]
+        ids = tuple(subida.file_id for subida in subidas)
+        if ids != st.session_state.get(CLAVE_ULTIMA_SUBIDA, ()):
+            st.session_state[CLAVE_ULTIMA_SUBIDA] = ids
+            if on_change is not None:
+                on_change()
+        if accept_multiple_files:
+            return subidas
+        return subidas[0] if subidas else None
+
+    file_uploader.loadtest = True
+    st.file_uploader = file_uploader
+
+def capture(app: Dict) -> None:
+    """Guarda el registro de métricas, el historial y el agrupador que usa la
+    app. Se llama desde el script de la sesión porque los cache_resource solo
+    se comparten dentro de una ejecución"""
+    from metrics import get_registry
+    from models.convnet_model import get_batcher
+
+    _capturado['registro'] = get_registry()
+    _capturado['historial'] = app['get_history_store']()
+    _capturado['batcher'] = get_batcher()
+
+def sample_uploads(n: int, seed: int = 0) -> List[bytes]:
+    """PNG de n dígitos del test de MNIST local, o sintéticos si no está"""
+    from models.mnist_data import SPLITS, find_idx, load_mnist
+
+    if all(find_idx(nombre) is not None for nombre in SPLITS['test']):
+        imagenes, _ = load_mnist('test', mmap=True)
+        idx = np.random.default_rng(seed).choice(len(imagenes), size=min(n, len(imagenes)), replace=False)
+        imagenes = np.asarray(imagenes[np.sort(idx)])
+    else:
+        imagenes = sample_digits(n, seed)
+    pngs = []
+    for img in imagenes:
+        buffer = BytesIO()
+        Image.fromarray(img).save(buffer, format='PNG')
+        pngs.append(buffer.getvalue())
+    return pngs
+
+def model_calls(registro) -> Dict[str, float]:
+    """Contadores del registro más el número de observaciones de cada histograma"""
+    llamadas = dict(registro.counters)
+    llamadas.update({f'{name}_count': fila['count'] for name, fila in registro.snapshot().items()})
+    return llamadas
+
+def summarize(muestras: List[Dict]) -> Dict:
+    """Percentiles de duración y espera de un conjunto de reruns, y la pendiente
+    de la duración frente al tamaño del historial"""
+    ms = np.array([m['ms'] for m in muestras])
+    espera = np.array([m['espera_ms'] for m in muestras])
+    historial = np.array([m['historial'] for m in muestras], dtype=np.float64)
+    resumen = {'reruns': len(muestras)}
+    resumen.update({f'p{p}_ms': float(np.percentile(ms, p)) for p in PERCENTILES})
+    resumen['mean_ms'] = float(ms.mean())
+    resumen.update({f'espera_p{p}_ms': float(np.percentile(espera, p)) for p in PERCENTILES})
+    # Un rerun que depende del tamaño del historial tiene pendiente positiva
+    resumen['ms_por_1k_evaluaciones'] = (float(np.polyfit(historial / 1000, ms, 1)[0])
+                                         if np.ptp(historial) > 0 else None)
+    return resumen
+
+# Clases
+class SimulatedUpload(BytesIO):
+    """Archivo subido simulado con los atributos de UploadedFile que usa la app"""
+
+    def __init__(self, file_id: str, nombre: str, contenido: bytes) -> None:
+        super().__init__(contenido)
+        self.name = nombre
+        self.file_id = file_id
+        self.size = len(contenido)
+        self.type = 'image/png'
+
+class MemorySampler(threading.Thread):
+    """Hilo que muestrea la memoria del proceso cada intervalo segundos"""
+
+    def __init__(self, intervalo: float = INTERVALO_MEMORIA) -> None:
+        super().__init__(daemon=True, name='loadtest-memoria')
+        self.intervalo = intervalo
+        self.muestras: List[Dict] = []
+        self.etiqueta: Dict = {}
+        self._parar = threading.Event()
+        self._inicio = time.perf_counter()
+
+    def run(self) -> None:
+        while not self._parar.is_set():
+            self.muestras.append({'t': time.perf_counter() - self._inicio, 'rss_mb': current_rss_mb(),
+                                  **self.etiqueta})
+            self._parar.wait(self.intervalo)
+
+    def stop(self) -> List[Dict]:
+        self._parar.set()
+        self.join()
+        return self.muestras
+
+class Session:
+    """Usuario simulado que recorre las tabs de la app
+
+    Parameters
+    ----------
+    n : int
+        Número de la sesión, forma parte de los nombres de archivo subidos
+    pngs : List[bytes]
+        Imágenes que puede subir
+    iteraciones : int
+        Veces que carga, predice y evalúa una imagen (o un lote)
+    lote : int, optional
+        Imágenes por subida, 0 para el modo individual, by default 0
+    seed : Union[int, Sequence[int]], optional
+        Semilla de la elección de imágenes y del dígito marcado, by default 0
+    """
+
+    def __init__(self, n: int, pngs: List[bytes], iteraciones: int, lote: int = 0,
+                 seed: Union[int, Sequence[int]] = 0) -> None:
+        from streamlit.testing.v1 import AppTest
+
+        self.n = n
+        self.pngs = pngs
+        self.lote = lote
+        self.rng = np.random.default_rng(seed)
+        self.at = AppTest.from_string(SESSION_SCRIPT, default_timeout=TIMEOUT)
+        self.pasos = iter([('inicio', 0)] + [(paso, i) for i in range(iteraciones) for paso in PASOS[1:]])
+
+    def _upload(self, i: int) -> None:
+        """Guarda en la sesión los archivos de la iteración i con nombres únicos.
+        Como en streamlit, cada subida tiene un file_id nuevo"""
+        idx = self.rng.integers(0, len(self.pngs), max(self.lote, 1))
+        self.at.session_state[CLAVE_SUBIDAS] = [(uuid.uuid4().hex, f's{self.n}-{i}-{j}.png', self.pngs[k])
+                                                for j, k in enumerate(idx)]
+
+    def _click(self, prefijo: str) -> None:
+        """Pulsa el primer botón cuya etiqueta empieza por prefijo"""
+        boton = next((b for b in self.at.button if b.label.startswith(prefijo)), None)
+        if boton is None:
+            raise RuntimeError(f'No hay ningún botón "{prefijo}"')
+        boton.click()
+
+    def step(self) -> Optional[str]:
+        """Ejecuta el siguiente paso. Devuelve su nombre o None si ha terminado"""
+        paso, i = next(self.pasos, (None, None))
+        if paso == 'inicio':
+            self.at.run()
+        elif paso == 'carga':
+            if self.lote:
+                next(r for r in self.at.radio if r.label == 'Modo de carga').set_value('Lote de imágenes')
+            self._upload(i)
+            self.at.run()
+        elif paso == 'prediccion':
+            self._click('Predecir')
+            self.at.run()
+        elif paso == 'evaluacion':
+            if not self.lote:
+                digito = next(n for n in self.at.number_input if n.label.startswith('Marca el dígito'))
+                digito.set_value(int(self.rng.integers(0, 10)))
+            self._click('Guardar evaluaci')
+            self.at.run()
+        elif paso == 'estadisticas':
+            formato = next(r for r in self.at.radio if r.label == 'Formato')
+            formato.set_value(formato.options[(formato.options.index(formato.value) + 1) % len(formato.options)])
+            self.at.run()
+        if paso is not None and self.at.exception:
+            raise RuntimeError(f'{paso}: {self.at.exception[0].message}')
+        return paso
+
+# Funciones
+def run_size(tamaño: int,
+             sesiones: int,
+             iteraciones: int,
+             think: float,
+             pngs: List[bytes],
+             lote: int = 0,
+             seed: int = 0) -> List[Dict]:
+    """Ejecuta las sesiones con un historial inicial de tamaño evaluaciones
+
+    Las sesiones se guardan en una cola ordenada por el momento en que su
+    usuario termina de pensar. Si un paso empieza más tarde porque el proceso
+    estaba atendiendo a otra sesión, el retraso se guarda como espera.
+
+    Returns
+    -------
+    List[Dict]
+        Una muestra por rerun con el paso, su duración, la espera y el tamaño del historial
+    """
+    historial = _capturado['historial']
+    historial.clear()
+    historial.add_many(sample_history(tamaño, seed))
+    rng = np.random.default_rng([seed, tamaño])
+    # Cada tamaño sube otras imágenes para que no salgan de la caché de predicciones
+    cola = [(time.perf_counter() + rng.exponential(think), n, Session(n, pngs, iteraciones, lote, [seed, tamaño, n]))
+            for n in range(sesiones)]
+    heapq.heapify(cola)
+    muestras = []
+    while cola:
+        listo, n, sesion = heapq.heappop(cola)
+        if (pendiente := listo - time.perf_counter()) > 0:
+            time.sleep(pendiente)
+        start = time.perf_counter()
+        paso = sesion.step()
+        fin = time.perf_counter()
+        if paso is None:
+            continue
+        muestras.append({'tamaño': tamaño, 'sesion': n, 'paso': paso, 'ms': (fin - start) * 1000,
+                         'espera_ms': (start - listo) * 1000, 'historial': len(historial)})
+        heapq.heappush(cola, (fin + rng.exponential(think), n, sesion))
+    return muestras
+
+def run_batcher(clientes: int,
+                peticiones: int,
+                pngs: List[bytes],
+                pausa: float = PAUSA_CLIENTES,
+                seed: int = 0) -> Dict:
+    """Lanza predicciones de una imagen desde varios hilos a la vez contra el
+    agrupador de la app, como harían sesiones simultáneas
+
+    Parameters
+    ----------
+    clientes : int
+        Hilos que lanzan predicciones a la vez
+    peticiones : int
+        Predicciones que lanza cada hilo, una detrás de otra
+    pngs : List[bytes]
+        Imágenes que se predicen
+    pausa : float, optional
+        Pausa media entre las predicciones de un hilo en segundos (exponencial), by default PAUSA_CLIENTES
+    seed : int, optional
+        Semilla de las pausas y de la elección de imágenes, by default 0
+
+    Returns
+    -------
+    Dict
+        Latencia por petición, peticiones por segundo y lotes formados por el
+        agrupador, con el número de lotes de cada tamaño
+    """
+    from ingestion import decode_digit, process_image
+
+    batcher = _capturado['batcher']
+    imagenes = process_image(np.stack([decode_digit(png) for png in pngs]))
+
+    def cliente(n: int) -> List[float]:
+        rng = np.random.default_rng([seed, n])
+        latencias = []
+        for _ in range(peticiones):
+            time.sleep(rng.exponential(pausa))
+            img = imagenes[rng.integers(len(imagenes))]
+            start = time.perf_counter()
+            batcher.submit(img).result(timeout=TIMEOUT)
+            latencias.append((time.perf_counter() - start) * 1000)
+        return latencias
+
+    lotes, peticiones_antes, tamaños_antes = batcher.batches, batcher.requests, Counter(batcher.batch_sizes)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes, thread_name_prefix='loadtest-cliente') as pool:
+        latencias = np.concatenate([np.array(l) for l in pool.map(cliente, range(clientes))])
+    segundos = time.perf_counter() - start
+    lotes = batcher.batches - lotes
+    tamaños = Counter(batcher.batch_sizes)
+    tamaños.subtract(tamaños_antes)
+    resumen = {'clientes': clientes, 'peticiones': len(latencias), 'segundos': segundos,
+               'peticiones_por_segundo': len(latencias) / segundos,
+               'max_batch_size': batcher.max_batch_size, 'max_wait_ms': batcher.max_wait * 1000,
+               'lotes': lotes, 'peticiones_por_lote': (batcher.requests - peticiones_antes) / lotes if lotes else None,
+               'tamaños_lote': {str(tamaño): n for tamaño, n in sorted(tamaños.items()) if n > 0}}
+    resumen.update({f'p{p}_ms': float(np.percentile(latencias, p)) for p in PERCENTILES})
+    return resumen
+
+def run(sesiones: int = 4,
+        iteraciones: int = 3,
+        think: float = 1.0,
+        tamaños: Tuple[int, ...] = HISTORY_SIZES,
+        lote: int = 0,
+        intervalo_memoria: float = INTERVALO_MEMORIA,
+        seed: int = 0,
+        clientes: int = CLIENTES,
+        peticiones: int = PETICIONES,
+        pausa_clientes: float = PAUSA_CLIENTES) -> Dict:
+    """Ejecuta la prueba de carga para cada tamaño de historial
+
+    Parameters
+    ----------
+    sesiones : int, optional
+        Sesiones simultáneas, by default 4
+    iteraciones : int, optional
+        Imágenes (o lotes) que carga, predice y evalúa cada sesión, by default 3
+    think : float, optional
+        Tiempo de reflexión medio entre pasos en segundos (exponencial), by default 1.0
+    tamaños : Tuple[int, ...], optional
+        Tamaños del historial inicial, by default HISTORY_SIZES
+    lote : int, optional
+        Imágenes por subida, 0 para el modo individual, by default 0
+    intervalo_memoria : float, optional
+        Segundos entre muestras de memoria, by default INTERVALO_MEMORIA
+    seed : int, optional
+        Semilla de los tiempos de reflexión y de las imágenes, by default 0
+    clientes : int, optional
+        Hilos que lanzan predicciones a la vez contra el agrupador, 0 para no
+        medirlo, by default CLIENTES
+    peticiones : int, optional
+        Predicciones de cada hilo cliente, by default PETICIONES
+    pausa_clientes : float, optional
+        Pausa media entre las predicciones de un hilo cliente, by default PAUSA_CLIENTES
+
+    Returns
+    -------
+    Dict
+        Resumen por tamaño y paso, llamadas al modelo, resumen del agrupador,
+        memoria y muestras en bruto
+    """
+    # Caché de predicciones en memoria para que las ejecuciones sean comparables
+    os.environ.setdefault('KOPURU_CACHE_DB', '')
+    # Historial temporal que se vacía y se rellena para cada tamaño
+    carpeta = tempfile.TemporaryDirectory(prefix='kopuru-loadtest-')
+    os.environ['KOPURU_HISTORY_DB'] = str(Path(carpeta.name) / 'historial.sqlite3')
+    pngs = sample_uploads(NUM_IMAGENES, seed)
+    memoria = MemorySampler(intervalo_memoria)
+    memoria.start()
+    try:
+        # Una sesión completa previa carga el modelo y las cachés, no se mide
+        memoria.etiqueta = {'tamaño': None}
+        calentamiento = Session(-1, pngs, 1, lote, [seed, len(pngs)])
+        while calentamiento.step() is not None:
+            pass
+        resultados, muestras = [], []
+        for tamaño in tamaños:
+            memoria.etiqueta = {'tamaño': tamaño}
+            antes = model_calls(_capturado['registro'])
+            start = time.perf_counter()
+            muestras_tamaño = run_size(tamaño, sesiones, iteraciones, think, pngs, lote, seed)
+            segundos = time.perf_counter() - start
+            despues = model_calls(_capturado['registro'])
+            resumen = {'tamaño': tamaño, 'segundos': segundos,
+                       'reruns_por_segundo': len(muestras_tamaño) / segundos,
+                       'total': summarize(muestras_tamaño),
+                       'pasos': {paso: summarize([m for m in muestras_tamaño if m['paso'] == paso])
+                                 for paso in PASOS if any(m['paso'] == paso for m in muestras_tamaño)},
+                       'llamadas_modelo': {k: v - antes.get(k, 0) for k, v in despues.items()
+                                           if v != antes.get(k, 0)},
+                       'rss_mb': current_rss_mb()}
+            resultados.append(resumen)
+            muestras.extend(muestras_tamaño)
+        memoria.etiqueta = {'tamaño': None, 'fase': 'agrupador'}
+        agrupador = run_batcher(clientes, peticiones, pngs, pausa_clientes, seed) if clientes else None
+    finally:
+        serie_memoria = memoria.stop()
+        carpeta.cleanup()
+    return {
+        'config': {'sesiones': sesiones, 'iteraciones': iteraciones, 'think': think, 'lote': lote,
+                   'historial': list(tamaños), 'seed': seed, 'clientes': clientes, 'peticiones': peticiones,
+                   'pausa_clientes': pausa_clientes},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'backend': os.environ.get('KOPURU_BACKEND', 'keras')},
+        'results': resultados,
+        'agrupador': agrupador,
+        # Pendiente de cada paso con las muestras de todos los tamaños
+        'ms_por_1k_evaluaciones': {paso: summarize([m for m in muestras if m['paso'] == paso])['ms_por_1k_evaluaciones']
+                                   for paso in PASOS if any(m['paso'] == paso for m in muestras)},
+        'peak_rss_mb': peak_rss_mb(),
+        'memoria': serie_memoria,
+        'muestras': muestras,
+    }
+
+def main() -> None:
+    """Entry point de la prueba de carga"""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadtest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sesiones', type=int, default=4, help='Sesiones simultáneas')
+    parser.add_argument('--iteraciones', type=int, default=3, help='Imágenes o lotes evaluados por sesión')
+    parser.add_argument('--think', type=float, default=1.0, help='Tiempo de reflexión medio entre pasos (s)')
+    parser.add_argument('--historial', type=int, nargs='+', default=list(HISTORY_SIZES),
+                        help='Tamaños del historial inicial')
+    parser.add_argument('--lote', type=int, default=0, help='Imágenes por subida (0 para el modo individual)')
+    parser.add_argument('--intervalo-memoria', type=float, default=INTERVALO_MEMORIA,
+                        help='Segundos entre muestras de memoria')
+    parser.add_argument('--clientes', type=int, default=CLIENTES,
+                        help='Hilos que lanzan predicciones a la vez contra el agrupador (0 para no medirlo)')
+    parser.add_argument('--peticiones', type=int, default=PETICIONES, help='Predicciones por hilo cliente')
+    parser.add_argument('--pausa-clientes', type=float, default=PAUSA_CLIENTES,
+                        help='Pausa media entre las predicciones de un hilo cliente (s)')
+    parser.add_argument('--seed', type=int, default=0, help='Semilla')
+    parser.add_argument('--output', help='Archivo JSON de salida (por defecto stdout)')
+    args = parser.parse_args()
+
+    resultados = run(args.sesiones, args.iteraciones, args.think, tuple(args.historial), args.lote,
+                     args.intervalo_memoria, args.seed, args.clientes, args.peticiones, args.pausa_clientes)
+
+    # Resumen legible por stderr para no mezclarlo con el JSON
+    for r in resultados['results']:
+        print(f"historial {r['tamaño']:>8,}  {r['reruns_por_segundo']:6.2f} reruns/s  rss {r['rss_mb']:7.1f} MB  "
+              f"llamadas {json.dumps(r['llamadas_modelo'])}", file=sys.stderr)
+        for paso, s in r['pasos'].items():
+            print(f"  {paso:<14} p50 {s['p50_ms']:9.1f} ms  p95 {s['p95_ms']:9.1f} ms  p99 {s['p99_ms']:9.1f} ms  "
+                  f"espera p95 {s['espera_p95_ms']:9.1f} ms", file=sys.stderr)
+    # Si un paso se vuelve más lento con el historial su pendiente crece
+    print('Duración frente al historial:', file=sys.stderr)
+    for paso, pendiente in resultados['ms_por_1k_evaluaciones'].items():
+        print(f"  {paso:<14} {'-' if pendiente is None else f'{pendiente:+.4f}'} ms por 1.000 evaluaciones",
+              file=sys.stderr)
+
+    if (agrupador := resultados['agrupador']) is not None:
+        print(f"agrupador: {agrupador['clientes']} clientes, {agrupador['peticiones_por_segundo']:.1f} peticiones/s, "
+              f"p50 {agrupador['p50_ms']:.1f} ms, p99 {agrupador['p99_ms']:.1f} ms, {agrupador['lotes']} lotes, "
+              f"{agrupador['peticiones_por_lote'] or 0:.2f} peticiones por lote", file=sys.stderr)
+        print(f"  tamaños de lote: {json.dumps(agrupador['tamaños_lote'])}", file=sys.stderr)
+
+    salida = json.dumps(resultados, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(salida)
+    else:
+        print(salida)
+
+if __name__ == '__main__':
+    # Con python -m este módulo es __main__, pero el script de las sesiones
+    # guarda lo capturado en benchmarks.loadtest. Ejecutamos ese
+    from benchmarks import loadtest
+    loadtest.main()
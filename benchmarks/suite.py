@@ -0,0 +1,316 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con los benchmarks de los caminos críticos de la app"""
+
+from io import BytesIO
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+# Constantes
+PERCENTILES = (50, 95, 99)
+HISTORY_SIZES = (10, 1_000, 100_000)
+BATCH_SIZES = (1, 32, 256)
+# Tamaño (alto, ancho) de una foto de móvil de 12 megapíxeles
+PHOTO_SIZE = (4032, 3024)
+# Cargar el modelo es lento, limitamos sus repeticiones
+LOAD_REPEAT = 5
+
+# Tipos
+Benchmark = Callable[[int], List[Dict]]
+
+# Funciones auxiliares
+def peak_rss_mb() -> float:
+    """Devuelve el pico de memoria residente del proceso en MB"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # En Linux ru_maxrss está en KB y en macOS en bytes
+    return maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+def current_rss_mb() -> float:
+    """Memoria residente actual del proceso en MB. Sin /proc devuelve el pico"""
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            paginas = int(f.read().split()[1])
+    except OSError:
+        return peak_rss_mb()
+    return paginas * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+
+def peak_alloc_mb(fn: Callable[[], object]) -> float:
+    """Pico de memoria reservada durante una ejecución de fn en MB, medido con
+    tracemalloc. Cuenta lo que pasa por el allocator de Python (NumPy y pandas
+    incluidos) pero no las reservas internas de TensorFlow"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    finally:
+        tracemalloc.stop()
+
+def measure(name: str,
+            fn: Callable[[], object],
+            repeat: int,
+            items: int = 1,
+            warmup: int = 1,
+            **params) -> Dict:
+    """Ejecuta fn varias veces y devuelve sus estadísticas de latencia
+
+    Parameters
+    ----------
+    name : str
+        Nombre del benchmark
+    fn : Callable[[], object]
+        Función a medir
+    repeat : int
+        Número de ejecuciones medidas
+    items : int, optional
+        Elementos que procesa cada ejecución para calcular el throughput, by default 1
+    warmup : int, optional
+        Ejecuciones previas que no se miden, by default 1
+
+    Returns
+    -------
+    Dict
+        Latencias p50/p95/p99 en ms, throughput en elementos/s, pico de memoria
+        reservada en una ejecución y RSS que queda retenida tras las ejecuciones.
+        Son de esta medida: ru_maxrss es el pico de todo el proceso y mezclaría
+        las medidas anteriores
+    """
+    rss_inicial = current_rss_mb()
+    for _ in range(warmup):
+        fn()
+    tiempos = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        tiempos[i] = time.perf_counter() - start
+    resultado = {'name': name, 'params': params, 'repeat': repeat, 'items': items}
+    resultado.update({f'p{p}_ms': float(np.percentile(tiempos, p) * 1000) for p in PERCENTILES})
+    resultado['mean_ms'] = float(tiempos.mean() * 1000)
+    resultado['throughput'] = float(items / tiempos.mean())
+    # La memoria se mide en una ejecución aparte: tracemalloc ralentiza las que se cronometran
+    resultado['peak_alloc_mb'] = peak_alloc_mb(fn)
+    resultado['rss_delta_mb'] = current_rss_mb() - rss_inicial
+    return resultado
+
+def sample_digits(n: int, seed: int = 0) -> np.ndarray:
+    """Genera n imágenes (28, 28) uint8 que pasan is_valid_image"""
+    rng = np.random.default_rng(seed)
+    imgs = rng.integers(0, 256, size=(n, 28, 28), dtype=np.uint8)
+    imgs[rng.random((n, 28, 28)) < 0.8] = 0
+    return imgs
+
+def sample_history(n: int, seed: int = 0) -> List[Dict]:
+    """Genera un historial de n evaluaciones con el formato de la app"""
+    rng = np.random.default_rng(seed)
+    preds = rng.integers(0, 10, n)
+    reales = np.where(rng.random(n) < 0.9, preds, rng.integers(0, 10, n))
+    confs = rng.random(n)
+    return [{'archivo': f'{i}.png', 'pred': int(p), 'conf': float(c), 'real': int(r), 'timestamp': 1704106800 + i}
+            for i, (p, r, c) in enumerate(zip(preds, reales, confs))]
+
+def sample_photo(size: Tuple[int, int] = PHOTO_SIZE, seed: int = 0) -> bytes:
+    """Genera una foto JPEG de size píxeles con un dígito oscuro sobre fondo claro"""
+    alto, ancho = size
+    foto = np.full((alto, ancho, 3), 220, dtype=np.uint8)
+    digito = np.kron(sample_digits(1, seed)[0] > 0, np.ones((alto // 56, alto // 56), dtype=bool))
+    y0, x0 = (alto - digito.shape[0]) // 2, (ancho - digito.shape[1]) // 2
+    foto[y0:y0 + digito.shape[0], x0:x0 + digito.shape[1]][digito] = 30
+    buffer = BytesIO()
+    Image.fromarray(foto).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+# Benchmarks #
+def bench_decode(repeat: int) -> List[Dict]:
+    """Decodificación de un PNG de 28x28 y de una foto grande: decodificación
+    completa frente a la ingesta con decodificación a resolución reducida"""
+    from ingestion import decode_digit
+
+    buffer = BytesIO()
+    Image.fromarray(sample_digits(1)[0]).save(buffer, format='PNG')
+    contenido = buffer.getvalue()
+    foto = sample_photo()
+    return [
+        measure('decode_image', lambda: np.array(Image.open(BytesIO(contenido))), repeat),
+        measure('decode_digit', lambda: decode_digit(contenido), repeat),
+        measure('decode_image', lambda: np.array(Image.open(BytesIO(foto))), repeat, size=PHOTO_SIZE),
+        measure('decode_digit', lambda: decode_digit(foto), repeat, size=PHOTO_SIZE),
+    ]
+
+def bench_preprocessing(repeat: int) -> List[Dict]:
+    """Validación y preprocesado de una imagen y de un lote"""
+    from ingestion import are_valid_images, is_valid_image, process_image
+
+    img = sample_digits(1)[0]
+    lote = sample_digits(256)
+    return [
+        measure('is_valid_image', lambda: is_valid_image(img), repeat),
+        measure('are_valid_images', lambda: are_valid_images(lote), repeat, items=len(lote), batch=len(lote)),
+        measure('process_image', lambda: process_image(img), repeat),
+        measure('process_image', lambda: process_image(lote), repeat, items=len(lote), batch=len(lote)),
+    ]
+
+def bench_predict(repeat: int) -> List[Dict]:
+    """model.predict de una imagen frente a lotes de distintos tamaños"""
+    from ingestion import process_image
+    from models.convnet_model import load_model
+
+    # Fuera del runtime de Streamlit cache_resource no memoiza, guardamos la referencia
+    model = load_model()
+    resultados = []
+    for batch in BATCH_SIZES:
+        x = process_image(sample_digits(batch))
+        resultados.append(measure('model_predict', lambda: model.predict(x, batch_size=batch, verbose=0),
+                                  repeat, items=batch, batch=batch))
+        resultados.append(measure('model_predict_on_batch', lambda: model.predict_on_batch(x),
+                                  repeat, items=batch, batch=batch))
+    return resultados
+
+def bench_load_model(repeat: int) -> List[Dict]:
+    """Carga en frío del modelo desde los weights y desde el archivo .keras"""
+    from models.convnet_model import MODEL_PATH, WEIGHTS_FILE, create_model, load_model
+
+    resultados = []
+    for from_weights in (True, False):
+        def cargar() -> None:
+            if from_weights:
+                create_model(MODEL_PATH / WEIGHTS_FILE, 'keras')
+            else:
+                load_model(from_weights=False)
+        try:
+            resultados.append(measure('load_model', cargar, min(repeat, LOAD_REPEAT), warmup=0, from_weights=from_weights))
+        except Exception as exc:
+            resultados.append({'name': 'load_model', 'params': {'from_weights': from_weights}, 'error': f'{type(exc).__name__}: {str(exc)[:200]}'})
+    return resultados
+
+def bench_model_summary(repeat: int) -> List[Dict]:
+    """Generación del resumen del modelo de la página Modelo. La caché de
+    describe_model se vacía antes de cada repetición para medir siempre el
+    cálculo completo: según la versión de Streamlit, fuera de su runtime
+    cache_data memoiza o no, y la medida mezclaría aciertos y fallos"""
+    from models.convnet_model import describe_model, get_model_summary
+
+    def sin_cache() -> None:
+        describe_model.clear()
+        get_model_summary()
+    return [measure('get_model_summary', sin_cache, repeat, cache='miss')]
+
+def bench_stats(repeat: int) -> List[Dict]:
+    """Trabajo de la pestaña de estadísticas: el DataFrame + groupby original
+    frente a las estadísticas incrementales del historial"""
+    from history import HistoryStore
+
+    resultados = []
+    for size in HISTORY_SIZES:
+        records = sample_history(size)
+
+        def dataframe_groupby() -> None:
+            df = pd.DataFrame(records)
+            df['acierto'] = df['pred'] == df['real']
+            np.cumsum(df['acierto'])
+            df.groupby('real').agg({'acierto': 'mean', 'pred': 'count'})
+
+        store = HistoryStore()
+        store.add_many(records)
+
+        def incremental() -> None:
+            stats = store.stats
+            stats.aciertos_acumulados.values
+            stats.precision_por_digito()
+            stats.conteo
+
+        resultados.append(measure('stats_dataframe_groupby', dataframe_groupby, repeat, items=size, history=size))
+        resultados.append(measure('stats_incremental', incremental, repeat, items=size, history=size))
+        resultados.append(measure('history_add', lambda: store.add({**records[0], 'archivo': f'nuevo-{time.perf_counter_ns()}'}),
+                                  repeat, history=size))
+        resultados.append(measure('history_table', lambda: store.to_frame(ultimos=1000), repeat, history=size))
+        resultados.append(measure('history_export_parquet', lambda: store.export('parquet'), repeat, items=size, history=size))
+    return resultados
+
+def bench_explain(repeat: int) -> List[Dict]:
+    """Mapa de oclusión de una imagen con todas las variantes en una pasada
+    frente a una llamada al modelo por parche, y saliencia por gradiente"""
+    from ingestion import process_image
+    from models.convnet_model import load_model
+    from models.explain import PARCHE, gradient_saliency, occlusion_batch, occlusion_map
+
+    # Fuera del runtime de Streamlit cache_resource no memoiza, guardamos la referencia
+    model = load_model(backend='keras')
+    img = sample_digits(1)[0]
+    variantes, _ = occlusion_batch(img)
+
+    def por_parche() -> None:
+        for variante in variantes:
+            model.predict_on_batch(process_image(variante))
+    return [
+        measure('occlusion_map', lambda: occlusion_map(model.predict_on_batch, img), repeat,
+                parche=PARCHE, variantes=len(variantes)),
+        measure('occlusion_loop', por_parche, min(repeat, LOAD_REPEAT), parche=PARCHE, variantes=len(variantes)),
+        measure('gradient_saliency', lambda: gradient_saliency(model, img), repeat),
+    ]
+
+BENCHMARKS: Dict[str, Benchmark] = {
+    'decode': bench_decode,
+    'preprocessing': bench_preprocessing,
+    'predict': bench_predict,
+    'load_model': bench_load_model,
+    'model_summary': bench_model_summary,
+    'stats': bench_stats,
+    'explain': bench_explain,
+}
+
+def environment() -> Dict:
+    """Datos del entorno para poder comparar resultados entre máquinas y commits"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    }
+
+def run(names: Optional[List[str]] = None, repeat: int = 50) -> Dict:
+    """Ejecuta los benchmarks indicados (todos por defecto)
+
+    Parameters
+    ----------
+    names : Optional[List[str]], optional
+        Nombres de los benchmarks a ejecutar, by default None
+    repeat : int, optional
+        Repeticiones de cada medida, by default 50
+
+    Returns
+    -------
+    Dict
+        Entorno, lista de resultados y pico de RSS del proceso
+    """
+    resultados = []
+    for name in names or BENCHMARKS:
+        resultados.extend(BENCHMARKS[name](repeat))
+    # El pico de RSS es de todo el proceso; el de cada medida está en sus resultados
+    return {'environment': environment(), 'results': resultados, 'peak_rss_mb': peak_rss_mb()}
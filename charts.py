@@ -0,0 +1,241 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con los gráficos de las pestañas de dígito y de estadísticas.
+
+Los gráficos se renderizan a PNG y se cachean por versión del historial, de
+modo que solo se vuelven a dibujar cuando se guarda una evaluación nueva.
+La tira de dígitos se cachea por las propias imágenes y las explicaciones
+por el digest de la imagen. Las series largas se reducen con LTTB a un
+número fijo de puntos para que el tiempo de renderizado no crezca con el
+historial.
+"""
+
+from io import BytesIO
+from typing import Callable, Tuple
+
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter, MaxNLocator
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# Constantes
+COLOR_BLUE = '#213f99'
+MAX_PUNTOS = 500
+MAX_TICKS = 8
+MAX_GRAFICOS_CACHEADOS = 16
+
+# Funciones auxiliares
+def lttb(y: np.ndarray, num_puntos: int = MAX_PUNTOS) -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce una serie con el algoritmo Largest-Triangle-Three-Buckets,
+    que conserva la forma visual de la curva con num_puntos puntos
+
+    Parameters
+    ----------
+    y : np.ndarray
+        Serie a reducir, el eje x es la posición de cada valor
+    num_puntos : int, optional
+        Número de puntos de la serie reducida, by default MAX_PUNTOS
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Posiciones y valores de los puntos elegidos
+    """
+    n = len(y)
+    x = np.arange(n)
+    if n <= num_puntos or num_puntos < 3:
+        return x, np.asarray(y)
+    y = np.asarray(y, dtype=np.float64)
+    # El primer y último punto se conservan, el resto se reparte en num_puntos - 2 cubos
+    bordes = np.linspace(1, n - 1, num_puntos - 1).astype(np.int64)
+    elegidos = np.empty(num_puntos, dtype=np.int64)
+    elegidos[0], elegidos[-1] = 0, n - 1
+    a = 0
+    for i in range(num_puntos - 2):
+        inicio, fin = bordes[i], bordes[i + 1]
+        # Punto medio del cubo siguiente (o el último punto para el último cubo)
+        if i + 2 < len(bordes):
+            siguiente = slice(bordes[i + 1], bordes[i + 2])
+            media_x, media_y = x[siguiente].mean(), y[siguiente].mean()
+        else:
+            media_x, media_y = x[-1], y[-1]
+        areas = np.abs((x[a] - media_x) * (y[inicio:fin] - y[a])
+                       - (x[a] - x[inicio:fin]) * (media_y - y[a]))
+        a = inicio + int(areas.argmax())
+        elegidos[i + 1] = a
+    return x[elegidos], y[elegidos]
+
+def fig_to_png(fig: Figure) -> bytes:
+    """Renderiza la figura a PNG. Las figuras se crean con Figure, fuera de
+    pyplot, así que no hay que cerrarlas: se liberan al dejar de usarlas"""
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
+
+# Gráficos cacheados #
+@st.cache_data(max_entries=MAX_GRAFICOS_CACHEADOS, show_spinner=False)
+def plot_digitos(imagenes: np.ndarray, titulo: str) -> bytes:
+    """Dibuja en una sola tira una o varias imágenes de dígitos
+
+    Parameters
+    ----------
+    imagenes : np.ndarray
+        Imágenes (N, 28, 28). Son pocas y pequeñas, así que se usan directamente como clave de la caché
+    titulo : str
+        Título del gráfico
+
+    Returns
+    -------
+    bytes
+        Gráfico en formato PNG
+    """
+    fig = Figure(figsize=(5, 2))
+    ax = fig.subplots()
+    ax.imshow(np.hstack(imagenes), cmap="gray")
+    ax.axis('off')
+    ax.set_title(titulo, fontsize=5)
+    return fig_to_png(fig)
+
+@st.cache_data(max_entries=MAX_GRAFICOS_CACHEADOS, show_spinner=False)
+def plot_explicacion(clave: str, _imagen: np.ndarray, _mapa: np.ndarray, titulo: str) -> bytes:
+    """Dibuja la imagen junto al mapa de explicación superpuesto
+
+    Parameters
+    ----------
+    clave : str
+        Digest de la imagen, modo de explicación y versión del modelo, se usa como clave de la caché
+    _imagen : np.ndarray
+        Imagen (28, 28)
+    _mapa : np.ndarray
+        Mapa (28, 28). Si tiene valores negativos se usa una escala divergente centrada en 0
+    titulo : str
+        Título del gráfico
+
+    Returns
+    -------
+    bytes
+        Gráfico en formato PNG
+    """
+    fig = Figure(figsize=(5, 2.5))
+    ax_imagen, ax_mapa = fig.subplots(1, 2)
+    ax_imagen.imshow(_imagen, cmap="gray")
+    ax_mapa.imshow(_imagen, cmap="gray")
+    if _mapa.min() < 0:
+        limite = max(float(np.abs(_mapa).max()), 1e-12)
+        capa = ax_mapa.imshow(_mapa, cmap='bwr', alpha=0.6, vmin=-limite, vmax=limite)
+    else:
+        capa = ax_mapa.imshow(_mapa, cmap='inferno', alpha=0.6)
+    fig.colorbar(capa, ax=ax_mapa, fraction=0.046, pad=0.04).ax.tick_params(labelsize=5)
+    for ax in (ax_imagen, ax_mapa):
+        ax.axis('off')
+    fig.suptitle(titulo, fontsize=6)
+    return fig_to_png(fig)
+
+# Los argumentos que empiezan por _ no se hashean, la clave de la caché es la versión del historial
+@st.cache_data(max_entries=MAX_GRAFICOS_CACHEADOS, show_spinner=False)
+def serie_confianzas(version: int, _confianzas: np.ndarray) -> pd.DataFrame:
+    """Devuelve la serie de confianzas reducida para st.line_chart
+
+    Parameters
+    ----------
+    version : int
+        Versión del historial, se usa como clave de la caché
+    _confianzas : np.ndarray
+        Confianza de cada evaluación
+
+    Returns
+    -------
+    pd.DataFrame
+        Columna conf indexada por el número de evaluación
+    """
+    x, y = lttb(_confianzas)
+    return pd.DataFrame({'conf': y}, index=x)
+
+@st.cache_data(max_entries=MAX_GRAFICOS_CACHEADOS, show_spinner=False)
+def plot_aciertos_acumulados(version: int, _aciertos_acumulados: np.ndarray, _fecha: Callable[[int], str]) -> bytes:
+    """Dibuja la curva de aciertos acumulados
+
+    Parameters
+    ----------
+    version : int
+        Versión del historial, se usa como clave de la caché
+    _aciertos_acumulados : np.ndarray
+        Serie de aciertos acumulados
+    _fecha : Callable[[int], str]
+        Devuelve la fecha de la evaluación i para las etiquetas del eje x
+
+    Returns
+    -------
+    bytes
+        Gráfico en formato PNG
+    """
+    x, y = lttb(_aciertos_acumulados)
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.plot(x, y, label='acumulado aciertos', color=COLOR_BLUE)
+    ax.set_xlabel('Tiempo')
+    ax.set_ylabel('Aciertos acumulados')
+    ax.set_title('Evolución de aciertos a lo Largo del Tiempo')
+    # Número de ticks acotado sea cual sea la longitud del historial
+    ax.xaxis.set_major_locator(MaxNLocator(nbins=MAX_TICKS, integer=True))
+    num_evaluaciones = len(_aciertos_acumulados)
+    ax.xaxis.set_major_formatter(FuncFormatter(
+        lambda valor, _: _fecha(int(valor)) if 0 <= int(valor) < num_evaluaciones else ''))
+    ax.yaxis.set_major_locator(MaxNLocator(nbins=MAX_TICKS, integer=True))
+    fig.tight_layout()
+    return fig_to_png(fig)
+
+@st.cache_data(max_entries=MAX_GRAFICOS_CACHEADOS, show_spinner=False)
+def plot_precision_por_digito(version: int, _digitos: np.ndarray, _precision: np.ndarray, _conteo: np.ndarray) -> bytes:
+    """Dibuja el porcentaje de aciertos y el número de intentos por dígito
+
+    Parameters
+    ----------
+    version : int
+        Versión del historial, se usa como clave de la caché
+    _digitos : np.ndarray
+        Dígitos reales evaluados
+    _precision : np.ndarray
+        Porcentaje de aciertos de cada dígito
+    _conteo : np.ndarray
+        Número de evaluaciones de cada dígito
+
+    Returns
+    -------
+    bytes
+        Gráfico en formato PNG
+    """
+    # Configuración del ancho de las barras
+    bar_width = 0.35
+    # Configuramos las posiciones de las barras
+    indices = np.arange(len(_digitos))
+    fig = Figure()
+    ax1 = fig.subplots()
+    # Barras para el porcentaje de aciertos
+    ax1.bar(indices - bar_width/2, _precision, bar_width, label='% de Aciertos', color=COLOR_BLUE)
+    # Creamos el segundo eje para el número de intentos
+    ax2 = ax1.twinx()
+    ax2.bar(indices + bar_width/2, _conteo, bar_width, label='Número de Predicciones', color='orange')
+    ax1.set_xlabel('Dígitos')
+    ax1.set_ylabel('% de Aciertos', color=COLOR_BLUE)
+    ax2.set_ylabel('Número de Predicciones', color='orange')
+    # Configuramos el segundo eje y para usar solo números enteros
+    ax2.yaxis.set_major_locator(MaxNLocator(integer=True))
+    ax1.set_xticks(indices)
+    ax1.set_xticklabels(_digitos)
+    ax1.set_title('Porcentaje de Aciertos y Número de Intentos por Dígito')
+    fig.tight_layout()
+    return fig_to_png(fig)
@@ -0,0 +1,588 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con el almacén persistente del historial de evaluaciones"""
+
+from datetime import datetime
+from io import BytesIO
+import math
+from numbers import Integral, Real
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# Constantes
+NUM_DIGITOS = 10
+COLUMNAS = ('archivo', 'pred', 'conf', 'real', 'timestamp')
+# La sesión no se exporta: solo delimita qué cuenta como duplicado
+COLUMNAS_DB = COLUMNAS + ('sesion',)
+CAPACIDAD_INICIAL = 1024
+# Las fechas se guardan como epoch en segundos y solo se formatean al mostrarlas
+ZONA_HORARIA = 'Europe/Madrid'
+ZONA = pytz.timezone(ZONA_HORARIA)
+FORMATO_FECHA = """%d/%m/%y\n%H:%M"""
+FORMATOS_EXPORTACION = ('parquet', 'arrow')
+
+ESQUEMA = '''CREATE TABLE IF NOT EXISTS {tabla} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                archivo TEXT NOT NULL,
+                pred INTEGER NOT NULL,
+                conf REAL NOT NULL,
+                real INTEGER NOT NULL,
+                timestamp REAL NOT NULL,
+                sesion TEXT NOT NULL DEFAULT '',
+                UNIQUE (sesion, archivo))'''
+
+# Tipos
+Fila = Tuple[str, int, float, int, int, str]
+Clave = Tuple[str, str]
+
+# Funciones auxiliares
+def _entero(valor, nombre: str, minimo: Optional[int] = None, maximo: Optional[int] = None) -> int:
+    """Convierte a int un valor entero (o un float sin decimales) y comprueba
+    que está en [minimo, maximo]. Lanza ValueError en otro caso, NaN incluido"""
+    if isinstance(valor, bool) or not isinstance(valor, Real):
+        raise ValueError(f'{nombre} tiene que ser un entero, no {valor!r}')
+    if not isinstance(valor, Integral) and not (math.isfinite(valor) and float(valor).is_integer()):
+        raise ValueError(f'{nombre} tiene que ser un entero, no {valor!r}')
+    valor = int(valor)
+    if (minimo is not None and valor < minimo) or (maximo is not None and valor > maximo):
+        raise ValueError(f'{nombre} tiene que estar entre {minimo} y {maximo}, no {valor}')
+    return valor
+
+def validate_record(record: Dict, ahora: int) -> Fila:
+    """Valida una evaluación y devuelve sus valores listos para guardar
+
+    Parameters
+    ----------
+    record : Dict
+        Evaluación con las claves archivo, pred, conf, real y, opcionalmente,
+        timestamp y sesion
+    ahora : int
+        Timestamp que se usa si la evaluación no lo trae
+
+    Returns
+    -------
+    Fila
+        archivo, pred, conf, real, timestamp y sesion
+
+    Raises
+    ------
+    ValueError
+        Si falta alguna clave, pred o real no son dígitos enteros entre 0 y 9,
+        conf no es una probabilidad, timestamp no es un número o sesion no es un texto
+    """
+    faltan = [columna for columna in COLUMNAS[:-1] if record.get(columna) is None]
+    if faltan:
+        raise ValueError(f'Faltan valores: {faltan}')
+    archivo = record['archivo']
+    if not isinstance(archivo, str) or not archivo:
+        raise ValueError(f'archivo tiene que ser un texto no vacío, no {archivo!r}')
+    conf = record['conf']
+    if isinstance(conf, bool) or not isinstance(conf, Real) or not 0 <= conf <= 1:
+        raise ValueError(f'conf tiene que ser una probabilidad entre 0 y 1, no {conf!r}')
+    timestamp = record.get('timestamp', ahora)
+    if isinstance(timestamp, bool) or not isinstance(timestamp, Real) or not math.isfinite(timestamp):
+        raise ValueError(f'timestamp tiene que ser un epoch en segundos, no {timestamp!r}')
+    sesion = record.get('sesion', '')
+    if not isinstance(sesion, str):
+        raise ValueError(f'sesion tiene que ser un texto, no {sesion!r}')
+    # conf se redondea a float32 para que las estadísticas coincidan con la columna
+    return (archivo,
+            _entero(record['pred'], 'pred', 0, NUM_DIGITOS - 1),
+            float(np.float32(conf)),
+            _entero(record['real'], 'real', 0, NUM_DIGITOS - 1),
+            int(timestamp),
+            sesion)
+
+def format_timestamps(timestamps: np.ndarray, formato: str = FORMATO_FECHA) -> np.ndarray:
+    """Formatea un array de epochs en segundos en la zona horaria de la app"""
+    # Las evaluaciones se guardan en ráfagas, así que solo se formatean los valores distintos
+    unicos, inversa = np.unique(np.asarray(timestamps, dtype=np.int64), return_inverse=True)
+    fechas = pd.to_datetime(unicos, unit='s', utc=True).tz_convert(ZONA_HORARIA)
+    return fechas.strftime(formato).to_numpy(dtype=object)[inversa]
+
+# Clases
+class GrowableArray:
+    """Array de NumPy preasignado que duplica su capacidad al llenarse,
+    de modo que añadir elementos cuesta O(1) amortizado
+
+    Parameters
+    ----------
+    dtype : np.dtype
+        Tipo de los elementos
+    capacidad : int, optional
+        Capacidad inicial, by default CAPACIDAD_INICIAL
+    """
+
+    def __init__(self, dtype: np.dtype, capacidad: int = CAPACIDAD_INICIAL) -> None:
+        self._data = np.empty(capacidad, dtype=dtype)
+        self._size = 0
+
+    def _reserve(self, size: int) -> None:
+        if size > len(self._data):
+            data = np.empty(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    def append(self, valor) -> None:
+        """Añade un elemento al final"""
+        self._reserve(self._size + 1)
+        self._data[self._size] = valor
+        self._size += 1
+
+    def extend(self, valores: np.ndarray) -> None:
+        """Añade varios elementos al final"""
+        valores = np.asarray(valores, dtype=self._data.dtype)
+        self._reserve(self._size + len(valores))
+        self._data[self._size:self._size + len(valores)] = valores
+        self._size += len(valores)
+
+    def clear(self) -> None:
+        """Vacía el array sin liberar la memoria reservada"""
+        self._size = 0
+
+    def truncate(self, size: int) -> None:
+        """Descarta los elementos a partir de la posición size"""
+        self._size = min(size, self._size)
+
+    @property
+    def values(self) -> np.ndarray:
+        """Vista (sin copia) de los elementos guardados"""
+        return self._data[:self._size]
+
+    def __len__(self) -> int:
+        return self._size
+
+class HistoryStats:
+    """Estadísticas del historial que se actualizan en O(1) por evaluación:
+    serie de confianzas, serie de aciertos acumulados, conteo y aciertos
+    por dígito real y matriz de confusión (filas real, columnas predicción)"""
+
+    def __init__(self) -> None:
+        self.confianzas = GrowableArray(np.float32)
+        self.aciertos_acumulados = GrowableArray(np.int64)
+        self.confusion = np.zeros((NUM_DIGITOS, NUM_DIGITOS), dtype=np.int64)
+        self.suma_conf = np.zeros(NUM_DIGITOS, dtype=np.float64)
+
+    def add(self, pred: int, real: int, conf: float) -> None:
+        """Actualiza las estadísticas con una nueva evaluación"""
+        acumulado = self.aciertos_acumulados.values[-1] if len(self.aciertos_acumulados) else 0
+        self.aciertos_acumulados.append(acumulado + (pred == real))
+        self.confianzas.append(conf)
+        self.confusion[real, pred] += 1
+        self.suma_conf[real] += conf
+
+    def snapshot(self) -> Tuple[int, np.ndarray, np.ndarray]:
+        """Copia del estado actual para poder deshacer inserciones con restore"""
+        return self.total, self.confusion.copy(), self.suma_conf.copy()
+
+    def restore(self, estado: Tuple[int, np.ndarray, np.ndarray]) -> None:
+        """Vuelve al estado guardado con snapshot"""
+        total, confusion, suma_conf = estado
+        self.confianzas.truncate(total)
+        self.aciertos_acumulados.truncate(total)
+        self.confusion[:] = confusion
+        self.suma_conf[:] = suma_conf
+
+    def clear(self) -> None:
+        """Reinicia todas las estadísticas"""
+        self.confianzas.clear()
+        self.aciertos_acumulados.clear()
+        self.confusion[:] = 0
+        self.suma_conf[:] = 0
+
+    @property
+    def conteo(self) -> np.ndarray:
+        """Número de evaluaciones por dígito real"""
+        return self.confusion.sum(axis=1)
+
+    @property
+    def aciertos(self) -> np.ndarray:
+        """Número de aciertos por dígito real"""
+        return np.diagonal(self.confusion)
+
+    @property
+    def total(self) -> int:
+        """Número total de evaluaciones"""
+        return len(self.confianzas)
+
+    def precision_por_digito(self) -> np.ndarray:
+        """Porcentaje de aciertos por dígito real (NaN si no hay evaluaciones)"""
+        conteo = self.conteo
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(conteo > 0, 100 * self.aciertos / conteo, np.nan)
+
+class HistoryStore:
+    """Historial de evaluaciones guardado en SQLite.
+
+    En memoria se guarda en columnas de NumPy preasignadas (pred y real en
+    uint8, conf en float32, timestamp en int64) y los nombres de archivo en una
+    tabla de cadenas a la que apunta una columna de índices int32. Las fechas se
+    formatean solo al mostrarlas. Un diccionario (sesión, nombre) -> índice
+    permite comprobar duplicados en O(1) y unas estadísticas (HistoryStats) se
+    actualizan en cada inserción. Un mismo archivo solo se guarda una vez por
+    sesión, pero sesiones distintas pueden guardar archivos con el mismo nombre.
+    Cada lote se valida completo antes de escribirlo y se guarda en una única
+    transacción: si algo falla no queda nada ni en disco ni en memoria.
+
+    Varios procesos pueden compartir la base de datos: sync carga lo que hayan
+    guardado los demás y un contador de generación en la tabla historial_meta
+    les avisa de que otro proceso ha borrado el historial.
+
+    Parameters
+    ----------
+    db_path : Optional[Path], optional
+        Ruta a la base de datos, None para un historial solo en memoria
+    """
+
+    def __init__(self, db_path: Optional[Path] = None) -> None:
+        if db_path is not None:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(db_path or ':memory:', timeout=10,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._create_schema()
+        self._lock = threading.Lock()
+        self._archivo = GrowableArray(np.int32)
+        self._pred = GrowableArray(np.uint8)
+        self._conf = GrowableArray(np.float32)
+        self._real = GrowableArray(np.uint8)
+        self._timestamp = GrowableArray(np.int64)
+        self._nombres: List[str] = []
+        self._sesiones: List[str] = []
+        self._archivos: Dict[Clave, int] = {}
+        self._last_id = 0
+        self._generacion = 0
+        # ids de las filas de la base de datos que no son válidas y no se cargan
+        self.descartadas: List[int] = []
+        self.stats = HistoryStats()
+        # Se incrementa con cada cambio para poder invalidar cachés derivadas
+        self.version = 0
+        self.sync()
+
+    def _create_schema(self) -> None:
+        """Crea las tablas si no existen y migra las de versiones anteriores"""
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            columnas = {fila[1] for fila in self._db.execute('PRAGMA table_info(historial)')}
+            if columnas and 'sesion' not in columnas:
+                # Las tablas antiguas deduplicaban por nombre de archivo en todo el
+                # historial (o no deduplicaban) y algunas guardaban además la fecha
+                # formateada. Se reconstruyen conservando los ids
+                self._db.execute(ESQUEMA.format(tabla='historial_nuevo'))
+                self._db.execute(f'INSERT OR IGNORE INTO historial_nuevo (id, {", ".join(COLUMNAS)}) '
+                                 f'SELECT id, {", ".join(COLUMNAS)} FROM historial ORDER BY id')
+                self._db.execute('DROP TABLE historial')
+                self._db.execute('ALTER TABLE historial_nuevo RENAME TO historial')
+            self._db.execute(ESQUEMA.format(tabla='historial'))
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_historial_timestamp ON historial (timestamp)')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS historial_meta (
+                                    clave TEXT PRIMARY KEY,
+                                    valor INTEGER NOT NULL)''')
+            self._db.execute("INSERT OR IGNORE INTO historial_meta VALUES ('generacion', 0)")
+            self._db.execute('COMMIT')
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+
+    def _index(self, archivo: str, pred: int, conf: float, real: int, timestamp: int, sesion: str) -> None:
+        """Añade una evaluación a las columnas en memoria y actualiza las estadísticas"""
+        self._archivos[sesion, archivo] = len(self._nombres)
+        self._archivo.append(len(self._nombres))
+        self._nombres.append(archivo)
+        self._sesiones.append(sesion)
+        self._pred.append(pred)
+        self._conf.append(conf)
+        self._real.append(real)
+        self._timestamp.append(timestamp)
+        self.stats.add(pred, real, conf)
+        self.version += 1
+
+    def _snapshot(self) -> Tuple:
+        """Estado en memoria antes de un lote, para deshacerlo con _restore"""
+        return len(self._nombres), self._last_id, self.version, self.stats.snapshot()
+
+    def _restore(self, estado: Tuple) -> None:
+        """Deshace en memoria las evaluaciones indexadas desde _snapshot"""
+        tamaño, self._last_id, self.version, stats = estado
+        for clave in zip(self._sesiones[tamaño:], self._nombres[tamaño:]):
+            del self._archivos[clave]
+        del self._nombres[tamaño:]
+        del self._sesiones[tamaño:]
+        for columna in (self._archivo, self._pred, self._conf, self._real, self._timestamp):
+            columna.truncate(tamaño)
+        self.stats.restore(stats)
+
+    def _reset(self) -> None:
+        """Vacía el historial en memoria"""
+        for columna in (self._archivo, self._pred, self._conf, self._real, self._timestamp):
+            columna.clear()
+        self._nombres.clear()
+        self._sesiones.clear()
+        self._archivos.clear()
+        self.descartadas.clear()
+        self.stats.clear()
+        self._last_id = 0
+        self.version += 1
+
+    def _load_new(self) -> int:
+        """Carga las filas guardadas por otros procesos desde la última lectura.
+        Se llama con el lock tomado y dentro de una transacción, para que la
+        generación y las filas sean coherentes. Si otro proceso ha borrado el
+        historial se vacía antes lo que hay en memoria"""
+        generacion, = self._db.execute("SELECT valor FROM historial_meta WHERE clave = 'generacion'").fetchone()
+        if generacion != self._generacion:
+            self._reset()
+            self._generacion = generacion
+        nuevas = 0
+        filas = self._db.execute(
+            f'SELECT id, {", ".join(COLUMNAS_DB)} FROM historial WHERE id > ? ORDER BY id',
+            (self._last_id,)).fetchall()
+        for id_, *valores in filas:
+            self._last_id = id_
+            try:
+                fila = validate_record(dict(zip(COLUMNAS_DB, valores)), 0)
+            except (ValueError, TypeError):
+                self.descartadas.append(id_)
+                continue
+            if (fila[5], fila[0]) in self._archivos:
+                continue
+            self._index(*fila)
+            nuevas += 1
+        return nuevas
+
+    def sync(self) -> int:
+        """Carga las evaluaciones que otros procesos hayan guardado desde la
+        última sincronización y aplica los borrados del historial que hayan
+        hecho. Las filas no válidas (por ejemplo escritas a mano o por una
+        versión anterior) no se cargan y sus ids se apuntan en descartadas.
+        Devuelve el número de evaluaciones nuevas"""
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                return self._load_new()
+            finally:
+                self._db.execute('COMMIT')
+
+    def saved(self, archivo: str, sesion: str = '') -> bool:
+        """Comprueba si la sesión ya ha guardado una evaluación del archivo"""
+        return (sesion, archivo) in self._archivos
+
+    def __contains__(self, archivo: str) -> bool:
+        return self.saved(archivo)
+
+    def __len__(self) -> int:
+        return len(self._pred)
+
+    def add_many(self, records: Iterable[Dict]) -> int:
+        """Guarda varias evaluaciones ignorando las de archivos que su sesión
+        ya ha guardado. El lote se valida completo antes de escribir nada y se
+        guarda en una transacción: si falla cualquier fila no se guarda ninguna
+
+        Parameters
+        ----------
+        records : Iterable[Dict]
+            Evaluaciones con las claves archivo, pred, conf, real y, opcionalmente,
+            timestamp (epoch en segundos, por defecto el momento actual) y sesion
+            (identificador de la sesión que la guarda, por defecto '')
+
+        Returns
+        -------
+        int
+            Número de evaluaciones guardadas
+
+        Raises
+        ------
+        ValueError
+            Si alguna evaluación no es válida (ver validate_record)
+        """
+        ahora = int(time.time())
+        filas = []
+        for i, record in enumerate(records):
+            try:
+                filas.append(validate_record(record, ahora))
+            except ValueError as exc:
+                raise ValueError(f'Evaluación {i} ({record.get("archivo")!r}) no válida: {exc}') from None
+        guardadas = 0
+        sql = (f'INSERT OR IGNORE INTO historial ({", ".join(COLUMNAS_DB)}) '
+               f'VALUES ({", ".join("?" * len(COLUMNAS_DB))})')
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                # Con la escritura ya bloqueada se cargan antes las filas de otros
+                # procesos: así los duplicados se detectan en memoria y los ids que
+                # se insertan a continuación son justo los siguientes a _last_id
+                self._load_new()
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            estado = self._snapshot()
+            try:
+                for valores in filas:
+                    if (valores[5], valores[0]) in self._archivos:
+                        continue
+                    cursor = self._db.execute(sql, valores)
+                    if cursor.rowcount:
+                        self._index(*valores)
+                        self._last_id = cursor.lastrowid
+                        guardadas += 1
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                self._restore(estado)
+                raise
+        return guardadas
+
+    def add(self, record: Dict) -> bool:
+        """Guarda una evaluación. Devuelve False si su sesión ya había guardado el archivo"""
+        return self.add_many([record]) == 1
+
+    def columns(self, ultimos: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Devuelve las columnas del historial en orden de inserción, sin formatear.
+        Si se indica ultimos solo se devuelven las evaluaciones más recientes"""
+        inicio = max(0, len(self) - ultimos) if ultimos is not None else 0
+        return {
+            'archivo': np.array([self._nombres[i] for i in self._archivo.values[inicio:]], dtype=object),
+            'pred': self._pred.values[inicio:].copy(),
+            'conf': self._conf.values[inicio:].copy(),
+            'real': self._real.values[inicio:].copy(),
+            'timestamp': self._timestamp.values[inicio:].copy(),
+        }
+
+    def to_frame(self, ultimos: Optional[int] = None, formato: str = FORMATO_FECHA) -> pd.DataFrame:
+        """Devuelve el historial como DataFrame con la fecha ya formateada para mostrarlo.
+        Si se indica ultimos solo se devuelven las evaluaciones más recientes"""
+        columnas = self.columns(ultimos)
+        columnas['fecha'] = format_timestamps(columnas.pop('timestamp'), formato)
+        return pd.DataFrame(columnas)
+
+    def fecha(self, i: int, formato: str = FORMATO_FECHA) -> str:
+        """Devuelve la fecha formateada de la evaluación i"""
+        return datetime.fromtimestamp(int(self._timestamp.values[i]), ZONA).strftime(formato)
+
+    def export(self, formato: str = 'parquet') -> bytes:
+        """Exporta el historial completo a Parquet o a un archivo Arrow IPC
+
+        Parameters
+        ----------
+        formato : str, optional
+            'parquet' o 'arrow', by default 'parquet'
+
+        Returns
+        -------
+        bytes
+            Contenido del archivo
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if formato not in FORMATOS_EXPORTACION:
+            raise ValueError(f'Formato no soportado: {formato}. Opciones: {FORMATOS_EXPORTACION}')
+        columnas = self.columns()
+        tabla = pa.table({
+            # Los nombres se guardan como diccionario, igual que en memoria
+            'archivo': pa.DictionaryArray.from_arrays(self._archivo.values, pa.array(self._nombres, pa.string())),
+            'pred': pa.array(columnas['pred']),
+            'conf': pa.array(columnas['conf']),
+            'real': pa.array(columnas['real']),
+            'timestamp': pa.array(columnas['timestamp'], pa.timestamp('s', tz='UTC')),
+        })
+        buffer = BytesIO()
+        if formato == 'parquet':
+            pq.write_table(tabla, buffer)
+        else:
+            with pa.ipc.new_file(buffer, tabla.schema) as writer:
+                writer.write_table(tabla)
+        return buffer.getvalue()
+
+    def import_(self, contenido: bytes, sesion: str = '') -> int:
+        """Importa un historial exportado en Parquet o Arrow IPC. Las
+        evaluaciones de archivos que la sesión ya ha guardado se ignoran
+
+        Parameters
+        ----------
+        contenido : bytes
+            Contenido del archivo exportado
+        sesion : str, optional
+            Sesión a la que se asignan las evaluaciones importadas, by default ''
+
+        Returns
+        -------
+        int
+            Número de evaluaciones importadas
+        """
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        if contenido[:4] == b'PAR1':
+            tabla = pq.read_table(BytesIO(contenido))
+        else:
+            tabla = pa.ipc.open_file(pa.BufferReader(contenido)).read_all()
+        faltan = set(COLUMNAS) - set(tabla.column_names)
+        if faltan:
+            raise ValueError(f'Faltan columnas en el historial importado: {sorted(faltan)}')
+        # Se comprueban los tipos antes de leer ninguna fila: pred y real enteros, conf numérica
+        tipos = {'pred': pa.types.is_integer, 'real': pa.types.is_integer, 'conf': pa.types.is_floating,
+                 'timestamp': lambda tipo: pa.types.is_timestamp(tipo) or pa.types.is_integer(tipo)}
+        for columna, es_valido in tipos.items():
+            if not es_valido(tabla[columna].type):
+                raise ValueError(f'La columna {columna} del historial importado tiene un tipo no válido: '
+                                 f'{tabla[columna].type}')
+        nulas = [columna for columna in COLUMNAS if tabla[columna].null_count]
+        if nulas:
+            raise ValueError(f'Hay valores vacíos en el historial importado: {nulas}')
+        timestamp = tabla['timestamp']
+        if pa.types.is_timestamp(timestamp.type):
+            timestamp = pc.cast(pc.cast(timestamp, pa.timestamp('s', tz='UTC')), pa.int64())
+        columnas = {
+            'archivo': tabla['archivo'].cast(pa.string()).to_pylist(),
+            'pred': tabla['pred'].to_numpy(),
+            'conf': tabla['conf'].to_numpy(),
+            'real': tabla['real'].to_numpy(),
+            'timestamp': timestamp.to_numpy(),
+        }
+        return self.add_many({**dict(zip(columnas, fila)), 'sesion': sesion} for fila in zip(*columnas.values()))
+
+    def summary(self) -> Dict[str, float]:
+        """Devuelve el total de evaluaciones, el porcentaje de aciertos
+        y la confianza media a partir de las estadísticas"""
+        total = self.stats.total
+        return {
+            'total': total,
+            'precision': self.stats.aciertos.sum() / total if total else 0.0,
+            'conf_media': self.stats.suma_conf.sum() / total if total else 0.0,
+        }
+
+    def clear(self) -> None:
+        """Borra todo el historial. Los demás procesos lo vacían en su próximo sync"""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('DELETE FROM historial')
+                self._db.execute("UPDATE historial_meta SET valor = valor + 1 WHERE clave = 'generacion'")
+                self._generacion, = self._db.execute(
+                    "SELECT valor FROM historial_meta WHERE clave = 'generacion'").fetchone()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._reset()
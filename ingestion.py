@@ -0,0 +1,208 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con la ingesta de imágenes: decodificación, normalización al
+formato MNIST, validación y preprocesado para el modelo.
+
+Se aceptan imágenes de cualquier tamaño en color, con transparencia o en
+escala de grises. Las fotos grandes se decodifican directamente a resolución
+reducida (draft de JPEG y reduce de PIL) en lugar de a resolución completa.
+Después el dígito se pasa a blanco sobre fondo negro, se recorta, se escala
+a una caja de 20x20 y se centra por su centro de masas en un lienzo de 28x28,
+igual que las imágenes de MNIST.
+"""
+
+from io import BytesIO
+from typing import Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Constantes
+LADO = 28
+# Lado de la caja en la que se escala el dígito, como en MNIST
+LADO_DIGITO = 20
+# Resolución máxima a la que se decodifican las fotos antes de normalizar
+LADO_DECODIFICADO = 256
+# Por debajo de esta fracción del máximo un píxel se considera fondo
+UMBRAL_FONDO = 0.2
+ERROR_NO_VALIDA = "La imagen no es válida. Carga una imagen con un dígito en blanco sobre fondo negro."
+
+# Funciones auxiliares
+def to_grayscale(img: Image.Image) -> np.ndarray:
+    """Convierte una imagen PIL en cualquier modo a un array de grises uint8.
+    Si la imagen tiene transparencia, el canal alfa hace de máscara del dígito
+
+    Parameters
+    ----------
+    img : Image.Image
+        Imagen decodificada
+
+    Returns
+    -------
+    np.ndarray
+        Array (alto, ancho) uint8
+    """
+    if img.mode == 'P':
+        img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    if img.mode in ('RGBA', 'LA', 'PA'):
+        alfa = np.asarray(img.getchannel('A'))
+        if alfa.min() < 255:
+            return alfa
+    if img.mode != 'L':
+        img = img.convert('L')
+    return np.asarray(img)
+
+def invert_if_light(gris: np.ndarray) -> np.ndarray:
+    """Invierte la imagen si el fondo (estimado por el borde) es claro,
+    es decir, si el dígito está dibujado oscuro sobre fondo claro"""
+    borde = np.concatenate([gris[0], gris[-1], gris[1:-1, 0], gris[1:-1, -1]])
+    if np.median(borde) > 127:
+        return 255 - gris
+    return gris
+
+# Funciones
+def normalize_digit(gris: np.ndarray) -> np.ndarray:
+    """Lleva una imagen de grises de cualquier tamaño al formato MNIST:
+    dígito blanco sobre fondo negro, escalado a 20x20 y centrado por su
+    centro de masas en un lienzo de 28x28
+
+    Las imágenes que ya son de 28x28 solo se invierten si hace falta.
+
+    Parameters
+    ----------
+    gris : np.ndarray
+        Imagen (alto, ancho) en escala de grises
+
+    Returns
+    -------
+    np.ndarray
+        Imagen (28, 28) uint8
+    """
+    gris = invert_if_light(np.asarray(gris, dtype=np.uint8))
+    if gris.shape == (LADO, LADO):
+        return gris
+    # Restamos el nivel de fondo y estiramos el contraste para que el fondo quede en negro puro
+    x = gris.astype(np.float32)
+    borde = np.concatenate([x[0], x[-1], x[1:-1, 0], x[1:-1, -1]])
+    x = np.clip(x - np.median(borde), 0, None)
+    if x.max() == 0:
+        return np.zeros((LADO, LADO), dtype=np.uint8)
+    x *= 255 / x.max()
+    x[x < UMBRAL_FONDO * 255] = 0
+    # Recortamos a la caja que contiene el dígito
+    filas, columnas = np.flatnonzero(x.any(axis=1)), np.flatnonzero(x.any(axis=0))
+    x = x[filas[0]:filas[-1] + 1, columnas[0]:columnas[-1] + 1]
+    # Escalamos el lado mayor a LADO_DIGITO conservando la proporción
+    escala = LADO_DIGITO / max(x.shape)
+    alto, ancho = max(1, round(x.shape[0] * escala)), max(1, round(x.shape[1] * escala))
+    digito = np.asarray(Image.fromarray(x.astype(np.uint8)).resize((ancho, alto), Image.LANCZOS), dtype=np.float32)
+    # Centramos por el centro de masas como en MNIST
+    masa = digito.sum()
+    if masa == 0:
+        return np.zeros((LADO, LADO), dtype=np.uint8)
+    cy = (digito.sum(axis=1) @ np.arange(alto)) / masa
+    cx = (digito.sum(axis=0) @ np.arange(ancho)) / masa
+    y0 = int(np.clip(round(LADO / 2 - cy), 0, LADO - alto))
+    x0 = int(np.clip(round(LADO / 2 - cx), 0, LADO - ancho))
+    lienzo = np.zeros((LADO, LADO), dtype=np.uint8)
+    lienzo[y0:y0 + alto, x0:x0 + ancho] = digito.round().astype(np.uint8)
+    return lienzo
+
+def decode_digit(contenido: bytes) -> np.ndarray:
+    """Decodifica una imagen en cualquier formato y tamaño y la normaliza
+    al formato MNIST. Las fotos grandes no se decodifican a resolución completa
+
+    Parameters
+    ----------
+    contenido : bytes
+        Bytes del archivo de imagen
+
+    Returns
+    -------
+    np.ndarray
+        Imagen (28, 28) uint8
+    """
+    img = Image.open(BytesIO(contenido))
+    if max(img.size) > LADO_DECODIFICADO:
+        # En JPEG draft escala en el dominio DCT y decodifica solo la luminancia,
+        # thumbnail usa reduce para el resto de formatos antes de remuestrear
+        img.draft('L', (LADO_DECODIFICADO, LADO_DECODIFICADO))
+        img.thumbnail((LADO_DECODIFICADO, LADO_DECODIFICADO), Image.BILINEAR, reducing_gap=2.0)
+    # Las fotos del móvil suelen venir giradas mediante la etiqueta EXIF
+    img = ImageOps.exif_transpose(img)
+    return normalize_digit(to_grayscale(img))
+
+def process_image(img_array:np.ndarray) -> np.ndarray:
+    """Preprocesa la imagen cargada para adecuarla a los requerimientos
+    del modelo
+
+    Acepta tanto una imagen (28, 28) como un lote de imágenes (N, 28, 28)
+
+    Parameters
+    ----------
+    img_array : np.ndarray
+        Imagen o lote de imágenes en formato array sin procesar
+
+    Returns
+    -------
+    np.ndarray
+        Imagen o lote reescalado con el formato (N, 28, 28, 1)
+        adecuado para alimentar el modelo
+    """
+    img_process = img_array.reshape(-1,28,28,1).astype(np.float32) / 255
+    return img_process
+
+# Validaciones
+def is_valid_image(img_array:np.ndarray) -> Tuple[bool, str]:
+    """Realiza validaciones al array de la imagen.
+    Devuelve una tupla con un bool y un mensaje de error
+
+    Parameters
+    ----------
+    img_array : np.ndarray
+        La imagen en formato array de numpy
+
+    Returns
+    -------
+    Tuple[bool, str]
+        True, "" si la imagen es válida
+        False, "mensaje de error" si la imagen no es válida
+    """
+    # Si hay más de un 95% de negro o menos de un 10% consideramos que el número no puede ser válido
+    if (np.count_nonzero(img_array == 0) > 0.95 * img_array.size) or (np.count_nonzero(img_array == 0) < 0.10 * img_array.size):
+        return False, ERROR_NO_VALIDA
+    # Comprobamos la shape de la imagen, que debe ser 28 x 28 píxeles
+    if img_array.shape != (28, 28):
+        return False, f"La dimensión de la imagen debe ser (28, 28). La imagen cargada es {img_array.shape}."
+    return True, ""
+
+def are_valid_images(img_batch:np.ndarray) -> np.ndarray:
+    """Versión vectorizada de is_valid_image para un lote de imágenes
+    con forma (N, 28, 28). Solo comprueba la proporción de negro ya que
+    la dimensión de cada imagen se comprueba al apilar el lote
+
+    Parameters
+    ----------
+    img_batch : np.ndarray
+        Lote de imágenes en formato array de numpy
+
+    Returns
+    -------
+    np.ndarray
+        Array de bools de longitud N, True si la imagen es válida
+    """
+    pixeles = img_batch.shape[1] * img_batch.shape[2]
+    ceros = np.count_nonzero(img_batch == 0, axis=(1, 2))
+    return (ceros <= 0.95 * pixeles) & (ceros >= 0.10 * pixeles)
@@ -0,0 +1,187 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con la instrumentación de latencias de la app.
+
+Cada etapa se mide con un temporizador (context manager o decorador) que
+guarda la duración en un histograma del registro compartido. El registro
+puede exportarse en formato de texto de Prometheus.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Deque, Dict, Iterator
+
+import numpy as np
+import streamlit as st
+
+# Constantes
+PERCENTILES = (50, 95, 99)
+# Muestras recientes que se guardan por histograma para calcular percentiles
+MAX_MUESTRAS = 4096
+PREFIJO = 'kopuru'
+# Variables de entorno para volcar periódicamente las métricas a un archivo
+METRICS_FILE_ENV = 'KOPURU_METRICS_FILE'
+METRICS_INTERVAL_ENV = 'KOPURU_METRICS_INTERVAL'
+
+# Clases
+class Histogram:
+    """Histograma con las últimas MAX_MUESTRAS observaciones, su número total y su suma"""
+
+    def __init__(self, max_muestras: int = MAX_MUESTRAS) -> None:
+        self.muestras: Deque[float] = deque(maxlen=max_muestras)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, valor: float) -> None:
+        """Añade una observación"""
+        self.muestras.append(valor)
+        self.count += 1
+        self.sum += valor
+
+    def percentiles(self) -> Dict[int, float]:
+        """Percentiles de las observaciones recientes"""
+        if not self.muestras:
+            return {p: float('nan') for p in PERCENTILES}
+        valores = np.percentile(np.fromiter(self.muestras, dtype=np.float64), PERCENTILES)
+        return dict(zip(PERCENTILES, valores.tolist()))
+
+class MetricsRegistry:
+    """Registro de histogramas de latencia (en segundos) y contadores"""
+
+    def __init__(self) -> None:
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, valor: float) -> None:
+        """Añade una observación al histograma name"""
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(valor)
+
+    def inc(self, name: str, valor: float = 1) -> None:
+        """Incrementa el contador name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + valor
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Mide la duración del bloque y la guarda en el histograma name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str) -> Callable:
+        """Decorador que mide cada llamada a la función en el histograma name"""
+        def decorator(fn: Callable) -> Callable:
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def hit_rate(self, name: str) -> float:
+        """Tasa de aciertos a partir de los contadores name_hits y name_misses"""
+        hits = self.counters.get(f'{name}_hits', 0)
+        total = hits + self.counters.get(f'{name}_misses', 0)
+        return hits / total if total else float('nan')
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Devuelve, por histograma, su número de observaciones, media y percentiles en ms"""
+        with self._lock:
+            resumen = {}
+            for name, hist in sorted(self.histograms.items()):
+                fila = {'count': hist.count, 'mean_ms': 1000 * hist.sum / hist.count if hist.count else float('nan')}
+                fila.update({f'p{p}_ms': 1000 * v for p, v in hist.percentiles().items()})
+                resumen[name] = fila
+            return resumen
+
+    def to_prometheus(self) -> str:
+        """Exporta el registro en formato de texto de Prometheus"""
+        lineas = []
+        with self._lock:
+            for name, hist in sorted(self.histograms.items()):
+                metrica = f'{PREFIJO}_{name}_seconds'
+                lineas.append(f'# TYPE {metrica} summary')
+                for p, v in hist.percentiles().items():
+                    lineas.append(f'{metrica}{{quantile="{p / 100}"}} {v}')
+                lineas.append(f'{metrica}_sum {hist.sum}')
+                lineas.append(f'{metrica}_count {hist.count}')
+            for name, valor in sorted(self.counters.items()):
+                metrica = f'{PREFIJO}_{name}_total'
+                lineas.append(f'# TYPE {metrica} counter')
+                lineas.append(f'{metrica} {valor}')
+        return '\n'.join(lineas) + '\n'
+
+    def write_prometheus(self, path: Path) -> None:
+        """Escribe el registro en path de forma atómica (para el textfile collector de node_exporter)"""
+        path = Path(path)
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        tmp.write_text(self.to_prometheus(), encoding='utf-8')
+        tmp.replace(path)
+
+    def reset(self) -> None:
+        """Borra todas las métricas"""
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+# Funciones
+def start_prometheus_export(registry: MetricsRegistry, path: Path, interval: float) -> threading.Thread:
+    """Lanza un hilo que vuelca el registro a path cada interval segundos"""
+    def volcar() -> None:
+        while True:
+            registry.write_prometheus(path)
+            time.sleep(interval)
+    thread = threading.Thread(target=volcar, name='prometheus-export', daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource(show_spinner=False)
+def get_registry() -> MetricsRegistry:
+    """Devuelve el registro de métricas compartido por todas las sesiones.
+    Si se define KOPURU_METRICS_FILE las métricas se vuelcan a ese archivo
+    cada KOPURU_METRICS_INTERVAL segundos (15 por defecto)
+
+    Returns
+    -------
+    MetricsRegistry
+        Registro de métricas del servidor
+    """
+    registry = MetricsRegistry()
+    if path := os.environ.get(METRICS_FILE_ENV):
+        start_prometheus_export(registry, Path(path), float(os.environ.get(METRICS_INTERVAL_ENV, 15)))
+    return registry
+
+def timer(name: str):
+    """Atajo para medir un bloque en el registro compartido"""
+    return get_registry().timer(name)
+
+def timed(name: str) -> Callable:
+    """Atajo para decorar una función y medirla en el registro compartido"""
+    def decorator(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
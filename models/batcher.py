@@ -0,0 +1,136 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Agrupador dinámico de peticiones de predicción (micro-batching).
+
+Las peticiones que llegan desde distintas sesiones se encolan y un hilo
+recolector las junta en lotes de como mucho max_batch_size imágenes,
+esperando como máximo max_wait segundos desde la primera. Cada lote se
+ejecuta con una sola llamada al modelo en un ThreadPoolExecutor y cada
+petición recibe su parte del resultado a través de un Future.
+"""
+
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+# Constantes
+MAX_BATCH_SIZE = 32
+MAX_WAIT = 0.005
+
+# Tipos
+Request = Tuple[np.ndarray, Future]
+
+# Clases
+class MicroBatcher:
+    """Junta peticiones concurrentes en lotes y las lanza contra el modelo.
+
+    Parameters
+    ----------
+    predict_fn : Callable[[np.ndarray], np.ndarray]
+        Función que recibe un lote (N, 28, 28, 1) y devuelve probabilidades (N, 10)
+    max_batch_size : int, optional
+        Número máximo de imágenes por lote, by default MAX_BATCH_SIZE
+    max_wait : float, optional
+        Segundos máximos que se espera a completar un lote, by default MAX_WAIT
+    workers : int, optional
+        Hilos que ejecutan lotes en paralelo, by default 1
+    """
+
+    def __init__(self,
+                 predict_fn: Callable[[np.ndarray], np.ndarray],
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_wait: float = MAX_WAIT,
+                 workers: int = 1) -> None:
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.requests = 0
+        # Número de lotes por número de imágenes, para ver cuánto se agrupa
+        self.batch_sizes: Counter = Counter()
+        self._queue: 'queue.Queue[Optional[Request]]' = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='micro-batch')
+        self._collector = threading.Thread(target=self._collect, name='micro-batcher', daemon=True)
+        self._collector.start()
+
+    def submit(self, img_processed: np.ndarray) -> Future:
+        """Encola una o varias imágenes procesadas para predecir
+
+        Parameters
+        ----------
+        img_processed : np.ndarray
+            Imágenes procesadas con forma (n, 28, 28, 1)
+
+        Returns
+        -------
+        Future
+            Se resuelve con las probabilidades (n, 10) de esas imágenes
+        """
+        future: Future = Future()
+        self._queue.put((img_processed.reshape(-1, 28, 28, 1), future))
+        return future
+
+    def _collect(self) -> None:
+        """Bucle del hilo recolector que forma los lotes"""
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            lote: List[Request] = [first]
+            size = len(first[0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Procesamos lo que ya tenemos y paramos
+                    self._executor.submit(self._run, lote)
+                    return
+                lote.append(request)
+                size += len(request[0])
+            self._executor.submit(self._run, lote)
+
+    def _run(self, lote: List[Request]) -> None:
+        """Ejecuta un lote y reparte el resultado entre sus peticiones"""
+        x = np.concatenate([imgs for imgs, _ in lote])
+        self.batches += 1
+        self.requests += len(lote)
+        self.batch_sizes[len(x)] += 1
+        try:
+            probs = np.asarray(self.predict_fn(x))
+        except Exception as exc:
+            for _, future in lote:
+                future.set_exception(exc)
+            return
+        inicio = 0
+        for imgs, future in lote:
+            future.set_result(probs[inicio:inicio + len(imgs)])
+            inicio += len(imgs)
+
+    def shutdown(self) -> None:
+        """Procesa las peticiones pendientes y detiene los hilos"""
+        self._queue.put(None)
+        self._collector.join()
+        self._executor.shutdown(wait=True)
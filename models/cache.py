@@ -0,0 +1,263 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caché de predicciones direccionada por contenido.
+
+La clave es un digest de los píxeles uint8 de la imagen sin procesar, de modo
+que el mismo dígito subido dos veces (aunque sea con otro nombre) no vuelve a
+pasar por el modelo. Las entradas viven en un LRU en memoria acotado y,
+opcionalmente, en una base de datos SQLite compartida entre procesos que
+sobrevive a los reinicios del servidor. La base de datos también está
+acotada: al superar max_disk_rows se borran las entradas usadas hace más
+tiempo, y las caducadas se borran al abrirla.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Constantes
+CACHE_DB_ENV = 'KOPURU_CACHE_DB'
+CACHE_DB_DEFAULT = '.cache/predicciones.sqlite3'
+CACHE_TTL_ENV = 'KOPURU_CACHE_TTL'
+CACHE_MAX_ROWS_ENV = 'KOPURU_CACHE_MAX_ROWS'
+MAX_SIZE = 4096
+MAX_DISK_ROWS = 100_000
+# Al superar el máximo se borra hasta dejar esta fracción, para no podar en cada inserción
+FRACCION_PODA = 0.9
+# SQLite no admite más de 999 parámetros por consulta en versiones antiguas
+SQL_CHUNK = 500
+
+# Tipos
+Prediction = Tuple[int, float]
+
+# Clases
+class PredictionCache:
+    """LRU de predicciones con TTL opcional, contadores de aciertos
+    y respaldo opcional en disco.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        Número máximo de entradas en memoria, by default MAX_SIZE
+    ttl : Optional[float], optional
+        Segundos de vida de cada entrada, None para que no caduquen
+    db_path : Optional[Path], optional
+        Ruta a la base de datos SQLite de respaldo, None para usar solo memoria
+    namespace : str, optional
+        Se añade a cada digest para separar las predicciones de distintos modelos
+    max_disk_rows : int, optional
+        Número máximo de entradas en disco, sumando todos los namespaces, by default MAX_DISK_ROWS
+    """
+
+    def __init__(self,
+                 max_size: int = MAX_SIZE,
+                 ttl: Optional[float] = None,
+                 db_path: Optional[Path] = None,
+                 namespace: str = '',
+                 max_disk_rows: int = MAX_DISK_ROWS) -> None:
+        self.max_size = max_size
+        self.max_disk_rows = max_disk_rows
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, Tuple[int, float, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path is not None:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            # WAL permite lectores y un escritor concurrentes desde varios procesos
+            self._db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS predicciones (
+                                    clave TEXT PRIMARY KEY,
+                                    pred INTEGER NOT NULL,
+                                    conf REAL NOT NULL,
+                                    creado REAL NOT NULL,
+                                    namespace TEXT NOT NULL DEFAULT '',
+                                    usado REAL NOT NULL DEFAULT 0)''')
+            # Las bases de datos anteriores no tenían namespace ni fecha de último uso
+            columnas = {fila[1] for fila in self._db.execute('PRAGMA table_info(predicciones)')}
+            if 'namespace' not in columnas:
+                self._db.execute("ALTER TABLE predicciones ADD COLUMN namespace TEXT NOT NULL DEFAULT ''")
+            if 'usado' not in columnas:
+                self._db.execute('ALTER TABLE predicciones ADD COLUMN usado REAL NOT NULL DEFAULT 0')
+                self._db.execute('UPDATE predicciones SET usado = creado')
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_predicciones_usado ON predicciones (usado)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_predicciones_namespace ON predicciones (namespace)')
+            self.purge_expired()
+            self._evict()
+
+    def digest(self, img_array: np.ndarray) -> str:
+        """Devuelve la clave de la caché para una imagen sin procesar
+
+        Parameters
+        ----------
+        img_array : np.ndarray
+            Imagen con sus píxeles uint8 originales
+
+        Returns
+        -------
+        str
+            Digest hexadecimal del namespace, la forma y los píxeles
+        """
+        img_array = np.ascontiguousarray(img_array, dtype=np.uint8)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.namespace.encode())
+        h.update(str(img_array.shape).encode())
+        h.update(img_array.data)
+        return h.hexdigest()
+
+    def _expired(self, creado: float, now: float) -> bool:
+        return self.ttl is not None and now - creado > self.ttl
+
+    def _put_memory(self, clave: str, pred: int, conf: float, creado: float) -> None:
+        self._entries[clave] = (pred, conf, creado)
+        self._entries.move_to_end(clave)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_many(self, claves: Iterable[str]) -> Dict[str, Prediction]:
+        """Busca varias claves a la vez, primero en memoria y después en disco
+
+        Parameters
+        ----------
+        claves : Iterable[str]
+            Digests a buscar
+
+        Returns
+        -------
+        Dict[str, Prediction]
+            Predicciones encontradas indexadas por clave
+        """
+        claves = list(dict.fromkeys(claves))
+        now = time.time()
+        encontradas: Dict[str, Prediction] = {}
+        pendientes: List[str] = []
+        with self._lock:
+            for clave in claves:
+                entrada = self._entries.get(clave)
+                if entrada is not None and not self._expired(entrada[2], now):
+                    self._entries.move_to_end(clave)
+                    encontradas[clave] = entrada[:2]
+                else:
+                    self._entries.pop(clave, None)
+                    pendientes.append(clave)
+            if self._db is not None:
+                for i in range(0, len(pendientes), SQL_CHUNK):
+                    chunk = pendientes[i:i + SQL_CHUNK]
+                    filas = self._db.execute(
+                        f'SELECT clave, pred, conf, creado FROM predicciones '
+                        f'WHERE clave IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+                    usadas = []
+                    for clave, pred, conf, creado in filas:
+                        if not self._expired(creado, now):
+                            # Promocionamos a memoria lo que encontramos en disco
+                            self._put_memory(clave, pred, conf, creado)
+                            encontradas[clave] = (pred, conf)
+                            usadas.append((now, clave))
+                    # La fecha de último uso decide qué se borra al llenarse el disco
+                    self._db.executemany('UPDATE predicciones SET usado = ? WHERE clave = ?', usadas)
+            self.hits += len(encontradas)
+            self.misses += len(claves) - len(encontradas)
+        return encontradas
+
+    def get(self, clave: str) -> Optional[Prediction]:
+        """Devuelve la predicción guardada para la clave o None si no está"""
+        return self.get_many([clave]).get(clave)
+
+    def put_many(self, items: Dict[str, Prediction]) -> None:
+        """Guarda varias predicciones en memoria y, si hay, en disco"""
+        now = time.time()
+        with self._lock:
+            for clave, (pred, conf) in items.items():
+                self._put_memory(clave, int(pred), float(conf), now)
+            if self._db is not None and items:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO predicciones (clave, pred, conf, creado, namespace, usado) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [(clave, int(pred), float(conf), now, self.namespace, now) for clave, (pred, conf) in items.items()])
+                self._evict()
+
+    def put(self, clave: str, pred: int, conf: float) -> None:
+        """Guarda una predicción"""
+        self.put_many({clave: (pred, conf)})
+
+    def _evict(self) -> int:
+        """Si el disco supera max_disk_rows borra las entradas usadas hace más
+        tiempo hasta dejar FRACCION_PODA del máximo. Devuelve cuántas se han borrado"""
+        filas = self._db.execute('SELECT COUNT(*) FROM predicciones').fetchone()[0]
+        if filas <= self.max_disk_rows:
+            return 0
+        sobran = filas - int(self.max_disk_rows * FRACCION_PODA)
+        return self._db.execute('DELETE FROM predicciones WHERE clave IN '
+                                '(SELECT clave FROM predicciones ORDER BY usado LIMIT ?)', (sobran,)).rowcount
+
+    def purge_expired(self) -> int:
+        """Elimina de disco las entradas caducadas y devuelve cuántas se han borrado.
+        Se llama al abrir la base de datos"""
+        if self._db is None or self.ttl is None:
+            return 0
+        with self._lock:
+            return self._db.execute('DELETE FROM predicciones WHERE creado < ?',
+                                    (time.time() - self.ttl,)).rowcount
+
+    def disk_size(self) -> int:
+        """Número de entradas en disco de todos los namespaces"""
+        if self._db is None:
+            return 0
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM predicciones').fetchone()[0]
+
+    def clear(self) -> None:
+        """Vacía la caché en memoria y, en disco, las entradas de este namespace.
+        Reinicia los contadores"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM predicciones WHERE namespace = ?', (self.namespace,))
+
+    def stats(self) -> Dict[str, float]:
+        """Devuelve tamaño, aciertos, fallos y tasa de aciertos de la caché"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+# Funciones
+def cache_from_env(namespace: str) -> PredictionCache:
+    """Crea la caché de un namespace con la configuración del entorno: la ruta
+    de la base de datos en KOPURU_CACHE_DB (vacía para usar solo memoria), la
+    caducidad en segundos en KOPURU_CACHE_TTL y el máximo de entradas en disco
+    en KOPURU_CACHE_MAX_ROWS"""
+    db_path = os.environ.get(CACHE_DB_ENV, CACHE_DB_DEFAULT)
+    ttl = os.environ.get(CACHE_TTL_ENV)
+    max_rows = os.environ.get(CACHE_MAX_ROWS_ENV)
+    return PredictionCache(db_path=Path(db_path) if db_path else None,
+                           ttl=float(ttl) if ttl else None,
+                           namespace=namespace,
+                           max_disk_rows=int(max_rows) if max_rows else MAX_DISK_ROWS)
@@ -0,0 +1,309 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Aumentado en test (TTA) y calibración de la confianza del modelo.
+
+El TTA genera pequeños desplazamientos, giros y escalados de cada imagen
+de 28x28. Todas las variantes se pasan al modelo en un único lote y sus
+probabilidades se promedian, así que cuesta una pasada del modelo con un
+lote K veces mayor en lugar de K pasadas.
+
+La confianza se calibra con temperature scaling: las probabilidades se
+pasan a log-probabilidades, se dividen por una temperatura T y se vuelve
+a aplicar softmax. La predicción no cambia, solo la confianza. T se ajusta
+fuera de la app minimizando la log-verosimilitud negativa sobre datos
+etiquetados y se guarda en un JSON junto a los weights. Si el archivo no
+existe se usa T = 1, es decir, la softmax sin calibrar.
+
+Por defecto T se ajusta con un tramo de validación: las últimas imágenes del
+train de MNIST, las que deja fuera validation_split de Keras. Ajustarla con
+el test y medir después con él da una calibración optimista.
+
+    python -m models.calibration --limit 5000
+"""
+
+import argparse
+from functools import lru_cache
+import json
+from pathlib import Path
+import sys
+import time
+from typing import Dict, Tuple
+
+import numpy as np
+
+# Constantes
+LADO = 28
+# Variantes del TTA: (desplazamiento vertical, desplazamiento horizontal, grados, escala).
+# La primera es la imagen original
+VARIANTES_TTA: Tuple[Tuple[float, float, float, float], ...] = (
+    (0, 0, 0, 1.0),
+    (1, 0, 0, 1.0), (-1, 0, 0, 1.0), (0, 1, 0, 1.0), (0, -1, 0, 1.0),
+    (0, 0, 10, 1.0), (0, 0, -10, 1.0),
+    (0, 0, 0, 0.9), (0, 0, 0, 1.1),
+)
+NUM_VARIANTES = len(VARIANTES_TTA)
+# Intervalo de búsqueda de la temperatura
+TEMPERATURA_MIN = 0.05
+TEMPERATURA_MAX = 20.0
+NUM_BINS_ECE = 15
+EPS = 1e-12
+# Imágenes del final del train de MNIST que forman el tramo de validación
+VALIDATION_SIZE = 5000
+SPLITS_CALIBRACION = ('validacion', 'train', 'test')
+
+# Funciones auxiliares
+@lru_cache(maxsize=4)
+def sampling_grid(variantes: Tuple[Tuple[float, float, float, float], ...] = VARIANTES_TTA) -> Tuple[np.ndarray, ...]:
+    """Precalcula, para cada variante, los índices y pesos de la interpolación
+    bilineal que llevan cada píxel de salida a su posición en la imagen original.
+    Los índices ya están desplazados en 1 para leer de la imagen con un borde de ceros
+
+    Returns
+    -------
+    Tuple[np.ndarray, ...]
+        y0, x0 (K, 28, 28) int y wy, wx (K, 28, 28) float32
+    """
+    centro = (LADO - 1) / 2
+    y, x = np.mgrid[0:LADO, 0:LADO].astype(np.float64)
+    ys, xs = [], []
+    for dy, dx, grados, escala in variantes:
+        # Transformación inversa: de la salida a la imagen original
+        theta = np.deg2rad(grados)
+        cy, cx = y - centro - dy, x - centro - dx
+        ys.append((np.cos(theta) * cy - np.sin(theta) * cx) / escala + centro)
+        xs.append((np.sin(theta) * cy + np.cos(theta) * cx) / escala + centro)
+    # Lo que cae fuera de la imagen lee del borde de ceros
+    sy = np.clip(np.stack(ys), -1, LADO)
+    sx = np.clip(np.stack(xs), -1, LADO)
+    y0, x0 = np.floor(sy), np.floor(sx)
+    wy, wx = (sy - y0).astype(np.float32), (sx - x0).astype(np.float32)
+    return y0.astype(np.intp) + 1, x0.astype(np.intp) + 1, wy, wx
+
+def augment(img_batch: np.ndarray) -> np.ndarray:
+    """Genera las variantes del TTA de un lote de imágenes sin bucles por imagen
+
+    Parameters
+    ----------
+    img_batch : np.ndarray
+        Imagen (28, 28) o lote (N, 28, 28) sin procesar
+
+    Returns
+    -------
+    np.ndarray
+        Lote (N * K, 28, 28) float32 en [0, 255] con las K variantes
+        de cada imagen seguidas
+    """
+    imgs = np.asarray(img_batch, dtype=np.float32).reshape(-1, LADO, LADO)
+    y0, x0, wy, wx = sampling_grid()
+    # Borde de 1 píxel a cada lado más uno extra para el vecino de la derecha/abajo
+    p = np.pad(imgs, ((0, 0), (1, 2), (1, 2)))
+    out = ((1 - wy) * (1 - wx) * p[:, y0, x0] + (1 - wy) * wx * p[:, y0, x0 + 1]
+           + wy * (1 - wx) * p[:, y0 + 1, x0] + wy * wx * p[:, y0 + 1, x0 + 1])
+    return out.reshape(-1, LADO, LADO)
+
+def aggregate(probs: np.ndarray, num_variantes: int = NUM_VARIANTES) -> np.ndarray:
+    """Promedia las probabilidades (N * K, 10) de las variantes de cada imagen"""
+    probs = np.asarray(probs)
+    return probs.reshape(-1, num_variantes, probs.shape[-1]).mean(axis=1)
+
+def apply_temperature(probs: np.ndarray, temperatura: float) -> np.ndarray:
+    """Reescala unas probabilidades con temperature scaling"""
+    probs = np.asarray(probs, dtype=np.float64)
+    if temperatura == 1.0:
+        return probs
+    logits = np.log(probs + EPS) / temperatura
+    logits -= logits.max(axis=-1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+def negative_log_likelihood(probs: np.ndarray, etiquetas: np.ndarray) -> float:
+    """Log-verosimilitud negativa media de las etiquetas reales"""
+    return float(-np.log(probs[np.arange(len(etiquetas)), etiquetas] + EPS).mean())
+
+def expected_calibration_error(probs: np.ndarray, etiquetas: np.ndarray, num_bins: int = NUM_BINS_ECE) -> float:
+    """Diferencia media, ponderada por número de imágenes, entre la confianza
+    y la precisión en num_bins intervalos de confianza"""
+    conf = probs.max(axis=1)
+    aciertos = probs.argmax(axis=1) == etiquetas
+    bins = np.minimum((conf * num_bins).astype(np.intp), num_bins - 1)
+    suma_conf = np.bincount(bins, weights=conf, minlength=num_bins)
+    suma_aciertos = np.bincount(bins, weights=aciertos, minlength=num_bins)
+    return float(np.abs(suma_conf - suma_aciertos).sum() / max(len(etiquetas), 1))
+
+def fit_temperature(probs: np.ndarray, etiquetas: np.ndarray, iteraciones: int = 60) -> float:
+    """Busca la temperatura que minimiza la log-verosimilitud negativa con
+    una búsqueda de sección áurea sobre log(T)"""
+    etiquetas = np.asarray(etiquetas, dtype=np.intp)
+
+    def nll(log_t: float) -> float:
+        return negative_log_likelihood(apply_temperature(probs, float(np.exp(log_t))), etiquetas)
+
+    a, b = np.log(TEMPERATURA_MIN), np.log(TEMPERATURA_MAX)
+    razon = (np.sqrt(5) - 1) / 2
+    c, d = b - razon * (b - a), a + razon * (b - a)
+    fc, fd = nll(c), nll(d)
+    for _ in range(iteraciones):
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - razon * (b - a)
+            fc = nll(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + razon * (b - a)
+            fd = nll(d)
+    return float(np.exp((a + b) / 2))
+
+def calibration_path(weights_path: Path) -> Path:
+    """Ruta del archivo de calibración de unos weights"""
+    weights_path = Path(weights_path)
+    return weights_path.with_name(f'{weights_path.stem}_calibration.json')
+
+# Clases
+class TemperatureCalibrator:
+    """Temperaturas de calibración de unos weights, una para la predicción
+    simple y otra para el TTA, cuyas probabilidades promediadas son menos
+    extremas y necesitan otra temperatura
+
+    Parameters
+    ----------
+    temperatura : float, optional
+        Temperatura de la predicción simple, by default 1.0
+    temperatura_tta : float, optional
+        Temperatura de la predicción con TTA, by default 1.0
+    """
+
+    def __init__(self, temperatura: float = 1.0, temperatura_tta: float = 1.0) -> None:
+        self.temperatura = temperatura
+        self.temperatura_tta = temperatura_tta
+
+    def temperature(self, tta: bool = False) -> float:
+        """Devuelve la temperatura de un modo de predicción"""
+        return self.temperatura_tta if tta else self.temperatura
+
+    def calibrate(self, probs: np.ndarray, tta: bool = False) -> np.ndarray:
+        """Calibra unas probabilidades (N, 10) o (10,)"""
+        return apply_temperature(probs, self.temperature(tta))
+
+    @classmethod
+    def load(cls, path: Path) -> 'TemperatureCalibrator':
+        """Lee un archivo de calibración. Si no existe se usa T = 1"""
+        path = Path(path)
+        if not path.exists():
+            return cls()
+        datos = json.loads(path.read_text(encoding='utf-8'))
+        return cls(float(datos.get('temperatura', 1.0)), float(datos.get('temperatura_tta', 1.0)))
+
+# Funciones
+@lru_cache(maxsize=8)
+def _load_calibrator(path: Path, mtime_ns: int) -> TemperatureCalibrator:
+    """Lee un archivo de calibración una sola vez por fecha de modificación"""
+    return TemperatureCalibrator.load(path)
+
+def get_calibrator(weights_path: Path) -> TemperatureCalibrator:
+    """Devuelve el calibrador de unos weights. Se vuelve a leer si el archivo
+    de calibración cambia, por ejemplo al ajustarlo de nuevo con la app arrancada"""
+    path = calibration_path(weights_path)
+    return _load_calibrator(path, path.stat().st_mtime_ns if path.exists() else 0)
+
+def fit(weights_path: Path,
+        imagenes: np.ndarray,
+        etiquetas: np.ndarray,
+        backend: str = 'keras',
+        batch_size: int = 256) -> Dict:
+    """Ajusta las temperaturas de unos weights y devuelve el contenido del archivo de calibración
+
+    Parameters
+    ----------
+    weights_path : Path
+        Archivo de weights a calibrar
+    imagenes : np.ndarray
+        Imágenes (N, 28, 28) uint8 etiquetadas que el modelo no haya visto al entrenar
+    etiquetas : np.ndarray
+        Dígitos reales (N,)
+    backend : str, optional
+        Backend con el que se calculan las probabilidades, by default 'keras'
+    batch_size : int, optional
+        Tamaño de los lotes del modelo, by default 256
+
+    Returns
+    -------
+    Dict
+        Temperaturas, versión de los weights y métricas antes y después de calibrar
+    """
+    from ingestion import process_image
+    from models.convnet_model import create_model
+    from models.registry import weights_version
+
+    model = create_model(weights_path, backend)
+    etiquetas = np.asarray(etiquetas, dtype=np.intp)
+    resultado: Dict = {'weights': weights_version(weights_path), 'backend': backend,
+                       'imagenes': int(len(etiquetas))}
+    for modo, tta in (('', False), ('_tta', True)):
+        probs = []
+        for inicio in range(0, len(imagenes), batch_size):
+            bloque = np.asarray(imagenes[inicio:inicio + batch_size])
+            x = augment(bloque) if tta else bloque
+            p = model.predict(process_image(x), batch_size=batch_size * (NUM_VARIANTES if tta else 1), verbose=0)
+            probs.append(aggregate(p) if tta else p)
+        probs = np.concatenate(probs).astype(np.float64)
+        temperatura = fit_temperature(probs, etiquetas)
+        calibradas = apply_temperature(probs, temperatura)
+        resultado[f'temperatura{modo}'] = temperatura
+        resultado[f'precision{modo}'] = float((probs.argmax(axis=1) == etiquetas).mean())
+        resultado[f'nll{modo}'] = {'antes': negative_log_likelihood(probs, etiquetas),
+                                   'despues': negative_log_likelihood(calibradas, etiquetas)}
+        resultado[f'ece{modo}'] = {'antes': expected_calibration_error(probs, etiquetas),
+                                   'despues': expected_calibration_error(calibradas, etiquetas)}
+    return resultado
+
+def main() -> None:
+    """Entry point del CLI"""
+    from models.convnet_model import BACKENDS, MODEL_PATH, WEIGHTS_FILE
+    from models.mnist_data import load_mnist
+
+    parser = argparse.ArgumentParser(prog='python -m models.calibration', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', type=Path, default=MODEL_PATH / WEIGHTS_FILE, help='Archivo de weights a calibrar')
+    parser.add_argument('--split', choices=SPLITS_CALIBRACION, default='validacion',
+                        help='Datos con los que se ajusta la temperatura. validacion (por defecto) son las '
+                             'últimas --validacion imágenes del train de MNIST, reservadas para validación; '
+                             'test da métricas optimistas si luego se evalúa con el mismo test')
+    parser.add_argument('--validacion', type=int, default=VALIDATION_SIZE,
+                        help='Imágenes del final del train que forman el split validacion')
+    parser.add_argument('--limit', type=int, help='Número máximo de imágenes a usar')
+    parser.add_argument('--backend', choices=BACKENDS, default='keras', help='Backend de inferencia')
+    parser.add_argument('--output', type=Path, help='Archivo de salida, por defecto junto a los weights')
+    parser.add_argument('--descargar', action='store_true',
+                        help='Descarga MNIST con keras si no está en data/ ni en KOPURU_MNIST_DIR')
+    args = parser.parse_args()
+
+    imagenes, etiquetas = load_mnist('test' if args.split == 'test' else 'train', mmap=True,
+                                     download=args.descargar or None)
+    if args.split == 'validacion':
+        imagenes, etiquetas = imagenes[-args.validacion:], etiquetas[-args.validacion:]
+    if args.limit:
+        imagenes, etiquetas = imagenes[:args.limit], etiquetas[:args.limit]
+    start = time.perf_counter()
+    resultado = fit(args.weights, imagenes, etiquetas, backend=args.backend)
+    resultado['segundos'] = time.perf_counter() - start
+    resultado['split'] = args.split
+    resultado['imagenes'] = len(imagenes)
+    salida = args.output or calibration_path(args.weights)
+    salida.write_text(json.dumps(resultado, indent=2), encoding='utf-8')
+    print(json.dumps(resultado, indent=2), file=sys.stderr)
+    print(f'Calibración guardada en {salida}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cascada de modelos con una primera etapa muy pequeña.
+
+La primera etapa es un MLP de una capa oculta en NumPy (unas 25k
+multiplicaciones por imagen, frente a los millones de la convnet). Si su
+confianza supera un umbral la imagen sale de la cascada con su predicción y
+solo las imágenes restantes pasan, en lote, por la convnet completa. El
+umbral se configura con KOPURU_CASCADE_THRESHOLD.
+
+El MLP se entrena fuera de la app y se guarda en models/ como .npz. Si el
+archivo no existe la cascada se desactiva y todo pasa por la convnet.
+
+    python -m models.cascade --epochs 10
+"""
+
+import argparse
+from functools import lru_cache
+import json
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from models.engine import softmax
+
+# Constantes
+FIRST_STAGE_PATH = Path(__file__).parent / 'first_stage_mlp.npz'
+CASCADE_THRESHOLD_ENV = 'KOPURU_CASCADE_THRESHOLD'
+# Con un umbral de 1 ninguna imagen sale en la primera etapa
+CASCADE_THRESHOLD = 0.99
+HIDDEN = 32
+BATCH_SIZE = 128
+UMBRALES_INFORME = (0.9, 0.95, 0.98, 0.99, 0.995, 0.999)
+
+# Clases
+class FirstStage:
+    """MLP 784 -> hidden (ReLU) -> 10 (softmax) que hace de primera etapa de la cascada
+
+    Parameters
+    ----------
+    weights : Dict[str, np.ndarray]
+        Matrices w1 (784, hidden), b1 (hidden,), w2 (hidden, 10) y b2 (10,)
+    version : str, optional
+        Nombre y hash del archivo del que se han leído los weights, by default ''
+    """
+
+    def __init__(self, weights: Dict[str, np.ndarray], version: str = '') -> None:
+        self.weights = {nombre: np.asarray(valor, dtype=np.float32) for nombre, valor in weights.items()}
+        self.version = version
+
+    @classmethod
+    def load(cls, path: Path = FIRST_STAGE_PATH) -> 'FirstStage':
+        """Lee la primera etapa de un archivo .npz"""
+        from models.registry import weights_version
+
+        with np.load(path) as datos:
+            return cls({nombre: datos[nombre] for nombre in ('w1', 'b1', 'w2', 'b2')}, weights_version(Path(path)))
+
+    def save(self, path: Path = FIRST_STAGE_PATH, **metadatos) -> None:
+        """Guarda los weights y, en formato JSON, los metadatos del entrenamiento"""
+        np.savez(path, **self.weights, metadatos=np.array(json.dumps(metadatos)))
+
+    def forward(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Pasada hacia delante sobre un lote (N, 784) en [0, 1].
+        Devuelve la capa oculta y las probabilidades (N, 10)"""
+        oculta = np.maximum(x @ self.weights['w1'] + self.weights['b1'], 0)
+        return oculta, softmax(oculta @ self.weights['w2'] + self.weights['b2'])
+
+    def predict(self, img_batch: np.ndarray) -> np.ndarray:
+        """Probabilidades (N, 10) de una imagen (28, 28) o un lote (N, 28, 28) sin procesar"""
+        x = np.asarray(img_batch, dtype=np.float32).reshape(-1, 784) / 255
+        return self.forward(x)[1]
+
+    @classmethod
+    def train(cls,
+              imagenes: np.ndarray,
+              etiquetas: np.ndarray,
+              hidden: int = HIDDEN,
+              epochs: int = 10,
+              batch_size: int = BATCH_SIZE,
+              lr: float = 1e-3,
+              seed: int = 0) -> 'FirstStage':
+        """Entrena el MLP con entropía cruzada y Adam
+
+        Parameters
+        ----------
+        imagenes : np.ndarray
+            Imágenes (N, 28, 28) uint8
+        etiquetas : np.ndarray
+            Dígitos reales (N,)
+        hidden : int, optional
+            Neuronas de la capa oculta, by default HIDDEN
+        epochs : int, optional
+            Pasadas por los datos, by default 10
+        batch_size : int, optional
+            Imágenes por paso, by default BATCH_SIZE
+        lr : float, optional
+            Tasa de aprendizaje de Adam, by default 1e-3
+        seed : int, optional
+            Semilla de la inicialización y del orden de los datos, by default 0
+
+        Returns
+        -------
+        FirstStage
+            Primera etapa entrenada
+        """
+        rng = np.random.default_rng(seed)
+        x = np.asarray(imagenes, dtype=np.float32).reshape(-1, 784) / 255
+        y = np.asarray(etiquetas, dtype=np.intp)
+        # Inicialización de He para la capa con ReLU
+        modelo = cls({
+            'w1': rng.normal(0, np.sqrt(2 / 784), (784, hidden)),
+            'b1': np.zeros(hidden),
+            'w2': rng.normal(0, np.sqrt(1 / hidden), (hidden, 10)),
+            'b2': np.zeros(10),
+        })
+        w = modelo.weights
+        m = {nombre: np.zeros_like(valor) for nombre, valor in w.items()}
+        v = {nombre: np.zeros_like(valor) for nombre, valor in w.items()}
+        beta1, beta2, eps, paso = 0.9, 0.999, 1e-8, 0
+        for _ in range(epochs):
+            orden = rng.permutation(len(x))
+            for inicio in range(0, len(x), batch_size):
+                idx = orden[inicio:inicio + batch_size]
+                xb, yb = x[idx], y[idx]
+                oculta, probs = modelo.forward(xb)
+                # Gradiente de la entropía cruzada respecto a los logits
+                d_logits = probs
+                d_logits[np.arange(len(yb)), yb] -= 1
+                d_logits /= len(yb)
+                d_oculta = (d_logits @ w['w2'].T) * (oculta > 0)
+                grads = {'w2': oculta.T @ d_logits, 'b2': d_logits.sum(axis=0),
+                         'w1': xb.T @ d_oculta, 'b1': d_oculta.sum(axis=0)}
+                paso += 1
+                for nombre, grad in grads.items():
+                    m[nombre] = beta1 * m[nombre] + (1 - beta1) * grad
+                    v[nombre] = beta2 * v[nombre] + (1 - beta2) * grad ** 2
+                    m_hat = m[nombre] / (1 - beta1 ** paso)
+                    v_hat = v[nombre] / (1 - beta2 ** paso)
+                    w[nombre] -= (lr * m_hat / (np.sqrt(v_hat) + eps)).astype(np.float32)
+        return modelo
+
+@lru_cache(maxsize=4)
+def _load_first_stage(path: Path, mtime_ns: int) -> FirstStage:
+    """Lee la primera etapa una sola vez por fecha de modificación del archivo"""
+    return FirstStage.load(path)
+
+# Funciones
+def get_first_stage(path: Path = FIRST_STAGE_PATH) -> Optional[FirstStage]:
+    """Devuelve la primera etapa de la cascada, o None si no se ha entrenado"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    return _load_first_stage(path, path.stat().st_mtime_ns)
+
+def get_cascade_threshold() -> float:
+    """Umbral de confianza de la primera etapa configurado en KOPURU_CASCADE_THRESHOLD"""
+    return float(os.environ.get(CASCADE_THRESHOLD_ENV, CASCADE_THRESHOLD))
+
+def early_exits(probs: np.ndarray, umbral: float) -> np.ndarray:
+    """Máscara de las imágenes que salen en la primera etapa"""
+    return np.asarray(probs).max(axis=-1) > umbral
+
+def report(modelo: FirstStage, imagenes: np.ndarray, etiquetas: np.ndarray) -> Dict:
+    """Precisión de la primera etapa y, para varios umbrales, la fracción de
+    imágenes que saldrían en ella y la precisión de esas imágenes"""
+    probs = modelo.predict(imagenes)
+    aciertos = probs.argmax(axis=1) == np.asarray(etiquetas)
+    umbrales = {}
+    for umbral in UMBRALES_INFORME:
+        salen = early_exits(probs, umbral)
+        umbrales[str(umbral)] = {'salida_temprana': float(salen.mean()),
+                                 'precision_salida': float(aciertos[salen].mean()) if salen.any() else None}
+    return {'precision': float(aciertos.mean()), 'umbrales': umbrales}
+
+def main() -> None:
+    """Entry point del CLI"""
+    from models.mnist_data import load_mnist
+
+    parser = argparse.ArgumentParser(prog='python -m models.cascade', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hidden', type=int, default=HIDDEN, help='Neuronas de la capa oculta')
+    parser.add_argument('--epochs', type=int, default=10, help='Pasadas por el train de MNIST')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Tasa de aprendizaje')
+    parser.add_argument('--output', type=Path, default=FIRST_STAGE_PATH, help='Archivo .npz de salida')
+    parser.add_argument('--descargar', action='store_true',
+                        help='Descarga MNIST con keras si no está en data/ ni en KOPURU_MNIST_DIR')
+    args = parser.parse_args()
+
+    x_train, y_train = load_mnist('train', download=args.descargar or None)
+    x_test, y_test = load_mnist('test', download=args.descargar or None)
+    start = time.perf_counter()
+    modelo = FirstStage.train(x_train, y_train, hidden=args.hidden, epochs=args.epochs, lr=args.lr)
+    resultado = {'segundos': time.perf_counter() - start, 'hidden': args.hidden, 'epochs': args.epochs,
+                 'test': report(modelo, x_test, y_test)}
+    modelo.save(args.output, **resultado)
+    print(json.dumps(resultado, indent=2), file=sys.stderr)
+    print(f'Primera etapa guardada en {args.output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
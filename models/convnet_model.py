@@ -14,38 +14,253 @@
 
 """Script que recoge funciones relacionadas con el modelo convnet"""
 
+from functools import partial
 from io import StringIO
+import os
 from pathlib import Path
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
 
+import numpy as np
 import streamlit as st
-from tensorflow import keras
+
+from metrics import MetricsRegistry, get_registry
+from models.batcher import MAX_BATCH_SIZE, MAX_WAIT, MicroBatcher
+from models.calibration import TemperatureCalibrator, get_calibrator as load_calibrator
+from models.engine import CONV_LAYERS, DENSE_LAYER, NumpyConvNet, load_weights
+from models.mnist_data import MNIST_DIR_ENV, MNIST_DOWNLOAD_ENV, mnist_available, mnist_dir
+from models.registry import ModelRegistry, Weights, weights_version
+from models.tflite_backend import load_tflite_model
+
+# TensorFlow tarda varios segundos en importarse, asi que solo lo importamos
+# cuando de verdad se necesita el modelo
+if TYPE_CHECKING:
+    from tensorflow import keras
 
 # Constantes
 MODEL_PATH = Path('models')
+WEIGHTS_FILE = 'convnet_mnist_104k_weights.h5'
+# Variable de entorno para desactivar la precarga del modelo en segundo plano
+WARM_UP_ENV = 'KOPURU_WARM_UP'
+# Backends de inferencia disponibles, se elige con KOPURU_BACKEND.
+# numpy usa el motor de models.engine y no necesita importar TensorFlow
+BACKEND_ENV = 'KOPURU_BACKEND'
+BACKENDS = ('keras', 'tflite-float16', 'tflite-int8', 'numpy')
+# Variables de entorno para configurar el agrupado de peticiones
+MAX_BATCH_ENV = 'KOPURU_MAX_BATCH'
+MAX_WAIT_MS_ENV = 'KOPURU_MAX_WAIT_MS'
+
+# Tiempos (en segundos) de importación, carga y primera inferencia del modelo
+MODEL_TIMINGS: Dict[str, float] = {}
 
 # Funciones
-@st.cache_resource()
-def load_model(from_weights: bool = True) -> keras.Model:
-    """Devuelve el modelo con los weights cargados.
+def get_keras():
+    """Importa keras de forma perezosa y registra el tiempo de la
+    primera importación de TensorFlow
+
+    Returns
+    -------
+    module
+        El módulo tensorflow.keras
+    """
+    start = time.perf_counter()
+    from tensorflow import keras
+    MODEL_TIMINGS.setdefault('import', time.perf_counter() - start)
+    return keras
+
+def get_backend() -> str:
+    """Devuelve el backend de inferencia configurado en KOPURU_BACKEND (keras por defecto).
+    Lanza ValueError si el backend no existe o si es tflite-int8 y no hay
+    imágenes de MNIST con las que calibrar la cuantización"""
+    backend = os.environ.get(BACKEND_ENV, 'keras')
+    if backend not in BACKENDS:
+        raise ValueError(f'Backend no soportado: {backend}. Opciones: {BACKENDS}')
+    if backend == 'tflite-int8' and not mnist_available('train'):
+        raise ValueError(f'{BACKEND_ENV}=tflite-int8 necesita el train de MNIST para calibrar la cuantización. '
+                         f'Cópialo en {mnist_dir().resolve()} (o indica su carpeta con {MNIST_DIR_ENV}), '
+                         f'usa {MNIST_DOWNLOAD_ENV}=1 para descargarlo o elige tflite-float16')
+    return backend
+
+def create_model(weights_path: Path,
+                 backend: str,
+                 weights: Optional[Weights] = None,
+                 registry: Optional[MetricsRegistry] = None) -> 'keras.Model':
+    """Construye el modelo de un backend a partir de unos weights. Es el
+    cargador del registro de modelos, que le pasa los weights publicados
+    en memoria compartida
+
+    Parameters
+    ----------
+    weights_path : Path
+        Archivo de weights de la versión, junto al que se guardan los modelos TFLite
+    backend : str
+        'keras', 'tflite-float16', 'tflite-int8' o 'numpy'
+    weights : Optional[Weights], optional
+        Kernels y bias por capa, by default se leen de weights_path
+    registry : Optional[MetricsRegistry], optional
+        Registro de métricas en el que se observa el tiempo de carga, by default
+        None para no registrarlo. El registro de modelos puede cargar desde
+        otros hilos, donde get_registry no memoiza, así que se pasa ya resuelto
 
     Returns
     -------
     keras.Model
-        El modelo con los coeficientes integrados.
+        El modelo con los coeficientes integrados. Con un backend TFLite se
+        devuelve un TFLiteModel y con numpy un NumpyConvNet, ambos con la
+        misma interfaz de predicción
     """
-    if from_weights:
+    start = time.perf_counter()
+    if weights is None:
+        weights = load_weights(weights_path)
+    if backend == 'numpy':
+        # El motor NumPy trabaja directamente sobre los arrays, sin copiarlos
+        model = NumpyConvNet(weights)
+    else:
+        get_keras()
         # Construimos el modelo
         model = build_model()
-        # Ruta a los weights del modelo
-        weights = MODEL_PATH / 'convnet_mnist_104k_weights.h5'
-        # Cargamos los weights
-        model.load_weights(weights, by_name=True, skip_mismatch=True)
-    else:
-        model = keras.models.load_model('convnet_mnist_104k.keras')
-    
+        # set_weights copia los weights a las variables de TensorFlow.
+        # Asignamos por orden de capa porque los nombres cambian si se construyen varios modelos
+        capas = [layer for layer in model.layers if layer.weights]
+        for layer, nombre in zip(capas, CONV_LAYERS + (DENSE_LAYER,)):
+            layer.set_weights(list(weights[nombre]))
+        if backend != 'keras':
+            model = load_tflite_model(model, weights_path, backend.removeprefix('tflite-'))
+    MODEL_TIMINGS['load'] = time.perf_counter() - start
+    if registry is not None:
+        registry.observe('model_load', MODEL_TIMINGS['load'])
+    return model
+
+@st.cache_resource(show_spinner=False)
+def get_model_registry() -> ModelRegistry:
+    """Devuelve el registro de versiones del modelo compartido por todas las sesiones.
+    La versión inicial es la elegida por última vez en el archivo compartido,
+    la de KOPURU_MODEL o WEIGHTS_FILE
+
+    Returns
+    -------
+    ModelRegistry
+        Registro con la versión activa y sus modelos cargados
+    """
+    # El cargador se ejecuta en el hilo que pide el modelo (precarga, agrupador,
+    # servidor HTTP), así que el registro de métricas se resuelve aquí
+    return ModelRegistry(loader=partial(create_model, registry=get_registry()), path=MODEL_PATH, default=WEIGHTS_FILE)
+
+def load_model(from_weights: bool = True, backend: Optional[str] = None) -> 'keras.Model':
+    """Devuelve el modelo con los weights cargados.
+
+    Parameters
+    ----------
+    from_weights : bool, optional
+        Devuelve el modelo de la versión activa del registro, que reconstruye
+        el modelo y carga los weights, en lugar de cargar el archivo .keras, by default True
+    backend : Optional[str], optional
+        'keras', 'tflite-float16', 'tflite-int8' o 'numpy'. Por defecto el de KOPURU_BACKEND.
+        Los backends TFLite se exportan la primera vez y se guardan junto a los weights
+
+    Returns
+    -------
+    keras.Model
+        El modelo con los coeficientes integrados. Con un backend TFLite
+        se devuelve un TFLiteModel con la misma interfaz de predicción
+    """
+    backend = backend or get_backend()
+    if from_weights:
+        # El registro carga cada backend una vez por versión
+        return get_model_registry().model(backend)
+    keras = get_keras()
+    start = time.perf_counter()
+    model = keras.models.load_model(MODEL_PATH / 'convnet_mnist_104k.keras')
+    MODEL_TIMINGS['load'] = time.perf_counter() - start
     return model
 
-def build_model() -> keras.Model:
+def warm_up(model_registry: Optional[ModelRegistry] = None) -> Dict[str, float]:
+    """Carga el modelo y lanza una inferencia de prueba para que la primera
+    predicción del usuario no pague la construcción del grafo
+
+    Parameters
+    ----------
+    model_registry : Optional[ModelRegistry], optional
+        Registro en el que cargar el modelo. Desde otro hilo hay que pasarlo,
+        ya que fuera del hilo del script cache_resource no memoiza, by default None
+
+    Returns
+    -------
+    Dict[str, float]
+        Tiempos de importación, carga y primera inferencia en segundos
+    """
+    model = (model_registry or get_model_registry()).model(get_backend())
+    start = time.perf_counter()
+    model.predict(np.zeros((1, 28, 28, 1), dtype=np.float32), verbose=0)
+    MODEL_TIMINGS.setdefault('first_inference', time.perf_counter() - start)
+    return get_model_timings()
+
+@st.cache_resource(show_spinner=False)
+def start_warm_up() -> Optional[threading.Thread]:
+    """Lanza warm_up en un hilo en segundo plano una única vez por servidor.
+    Se puede desactivar con la variable de entorno KOPURU_WARM_UP=0
+
+    Returns
+    -------
+    Optional[threading.Thread]
+        El hilo de precarga o None si está desactivada
+    """
+    if os.environ.get(WARM_UP_ENV, '1') == '0':
+        return None
+    thread = threading.Thread(target=warm_up, args=(get_model_registry(),), name='model-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+def create_batcher(model_registry: ModelRegistry, registry: MetricsRegistry) -> MicroBatcher:
+    """Crea un agrupador de peticiones que lanza los lotes contra el modelo
+    activo del registro. Los lotes son de como mucho KOPURU_MAX_BATCH imágenes
+    esperando como máximo KOPURU_MAX_WAIT_MS milisegundos
+
+    Parameters
+    ----------
+    model_registry : ModelRegistry
+        Registro con el modelo activo
+    registry : MetricsRegistry
+        Registro de métricas en el que se cuentan los lotes
+
+    Returns
+    -------
+    MicroBatcher
+        Agrupador que lanza los lotes contra el modelo cargado
+    """
+    def forward(x: np.ndarray) -> np.ndarray:
+        registry.inc('forward_batches')
+        registry.inc('forward_images', len(x))
+        # El préstamo permite cambiar de versión sin cortar los lotes en curso
+        with registry.timer('forward'), model_registry.lease(get_backend()) as model:
+            return model.predict_on_batch(x)
+
+    return MicroBatcher(
+        forward,
+        max_batch_size=int(os.environ.get(MAX_BATCH_ENV, MAX_BATCH_SIZE)),
+        max_wait=float(os.environ.get(MAX_WAIT_MS_ENV, MAX_WAIT * 1000)) / 1000,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_batcher() -> MicroBatcher:
+    """Devuelve el agrupador de peticiones compartido por todas las sesiones.
+    Las predicciones de sesiones concurrentes se juntan en lotes
+
+    Returns
+    -------
+    MicroBatcher
+        Agrupador que lanza los lotes contra el modelo cargado
+    """
+    # forward se ejecuta en el hilo del agrupador, donde cache_resource no
+    # memoiza. Los registros compartidos se obtienen aquí, en el hilo del script
+    return create_batcher(get_model_registry(), get_registry())
+
+def get_model_timings() -> Dict[str, float]:
+    """Devuelve una copia de los tiempos registrados del modelo"""
+    return dict(MODEL_TIMINGS)
+
+def build_model() -> 'keras.Model':
     """Reconstruye el modelo y lo devuelve para posteriormente ser cargado
     con los weights del modelo entrenado. Lo tenemos que hacer asi
     debido a incompatibilidades al guardado el modelo original:
@@ -57,6 +272,7 @@ def build_model() -> keras.Model:
     keras.Model
         Devuelve el modelo con los weights sin entrenar
     """
+    keras = get_keras()
     # Usamos la forma 'Functional API' de Keras    
     inputs = keras.Input(shape=(28, 28, 1))
     x = keras.layers.Conv2D(filters=32, kernel_size=3, activation="relu")(inputs)
@@ -69,20 +285,91 @@ def build_model() -> keras.Model:
     model = keras.Model(inputs=inputs, outputs=outputs)
     return model
 
-def get_model_summary() -> str:
-    """Devuelve el detalle del modelo como lo saca keras con
-    el método summary
+def get_model_version(weights_path: Optional[Path] = None) -> str:
+    """Devuelve la versión del modelo: nombre y hash de su archivo de weights
+
+    Parameters
+    ----------
+    weights_path : Optional[Path], optional
+        Archivo de weights, by default el de la versión activa del registro
 
     Returns
     -------
     str
-        detalle del modelo
+        Versión con el formato nombre:hash
+    """
+    return weights_version(weights_path) if weights_path else get_model_registry().version
+
+def get_calibrator() -> TemperatureCalibrator:
+    """Devuelve el calibrador de la versión activa, leído del JSON que hay
+    junto a sus weights. Sin archivo de calibración la temperatura es 1"""
+    return load_calibrator(get_model_registry().active_path)
+
+def layer_flops(layer) -> int:
+    """FLOPs de una pasada por una imagen de la capa, contando
+    cada multiplicación-suma como 2. Solo Conv2D y Dense aportan FLOPs"""
+    config = layer.get_config()
+    salida = layer.output.shape
+    if 'kernel_size' in config and 'filters' in config:
+        entrada = layer.input.shape[-1]
+        kh, kw = config['kernel_size']
+        return 2 * salida[1] * salida[2] * kh * kw * entrada * config['filters']
+    if 'units' in config:
+        return 2 * layer.input.shape[-1] * config['units']
+    return 0
+
+@st.cache_data(show_spinner=False)
+def describe_model(version: str) -> Dict[str, object]:
+    """Calcula una sola vez por versión del modelo su resumen de Keras
+    y una tabla con el tipo, la forma de salida, los parámetros
+    y los FLOPs de cada capa
+
+    Parameters
+    ----------
+    version : str
+        Versión del modelo devuelta por get_model_version, clave de la caché
+
+    Returns
+    -------
+    Dict[str, object]
+        'summary' con el resumen como texto y 'layers' con la tabla
+        como lista de diccionarios
     """
     # Captura la salida de model.summary()
     stream = StringIO()
-    model = load_model()
+    # El resumen solo lo ofrece el modelo de Keras
+    model = load_model(backend='keras')
     print_fn = lambda x, **kwargs: stream.write(x + '\n')
     model.summary(print_fn=print_fn)
     summary_string = stream.getvalue()
     stream.close()
-    return summary_string
+    layers = [{
+        'capa': layer.name,
+        'tipo': type(layer).__name__,
+        'salida': str(tuple(layer.output.shape)),
+        'parametros': layer.count_params(),
+        'flops': layer_flops(layer),
+    } for layer in model.layers]
+    return {'summary': summary_string, 'layers': layers}
+
+def get_model_summary() -> str:
+    """Devuelve el detalle del modelo como lo saca keras con
+    el método summary. Se calcula una vez por versión del modelo
+
+    Returns
+    -------
+    str
+        detalle del modelo
+    """
+    return describe_model(get_model_version())['summary']
+
+def get_model_layers() -> List[Dict]:
+    """Devuelve la tabla por capas del modelo: tipo, forma de salida,
+    parámetros y FLOPs. Se calcula una vez por versión del modelo
+
+    Returns
+    -------
+    List[Dict]
+        Una fila por capa
+    """
+    return describe_model(get_model_version())['layers']
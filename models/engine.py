@@ -0,0 +1,220 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Motor de inferencia independiente de Streamlit y de TensorFlow.
+
+Reproduce la arquitectura de build_model (3 Conv2D, 2 MaxPooling2D y una
+Dense con softmax) como una pasada hacia delante en NumPy puro, usando
+im2col con stride_tricks. Solo necesita numpy y h5py para leer los weights.
+
+Uso para comprobar la paridad numérica con el modelo de Keras:
+
+    python -m models.engine
+"""
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Tuple
+
+import h5py
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Constantes
+WEIGHTS_PATH = Path(__file__).parent / 'convnet_mnist_104k_weights.h5'
+CONV_LAYERS = ('conv2d', 'conv2d_1', 'conv2d_2')
+DENSE_LAYER = 'dense'
+BATCH_SIZE = 256
+
+# Funciones auxiliares
+def load_weights(weights_path: Path = WEIGHTS_PATH) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Lee los kernels y bias de cada capa del archivo .h5 guardado por Keras.
+
+    Parameters
+    ----------
+    weights_path : Path, optional
+        Ruta al archivo de weights, by default WEIGHTS_PATH
+
+    Returns
+    -------
+    Dict[str, Tuple[np.ndarray, np.ndarray]]
+        Diccionario nombre de capa -> (kernel, bias) en float32
+    """
+    weights = {}
+    with h5py.File(weights_path, 'r') as f:
+        for layer in CONV_LAYERS + (DENSE_LAYER,):
+            group = f[layer][layer]
+            weights[layer] = (
+                np.asarray(group['kernel:0'], dtype=np.float32),
+                np.asarray(group['bias:0'], dtype=np.float32),
+            )
+    return weights
+
+def conv2d_relu(x: np.ndarray, kernel: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    """Convolución 'valid' con stride 1 seguida de ReLU mediante im2col.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Entrada con forma (N, H, W, C)
+    kernel : np.ndarray
+        Kernel con forma (kh, kw, C, F) como lo guarda Keras
+    bias : np.ndarray
+        Bias con forma (F,)
+
+    Returns
+    -------
+    np.ndarray
+        Salida con forma (N, H - kh + 1, W - kw + 1, F)
+    """
+    kh, kw, c, f = kernel.shape
+    # Ventanas sin copia: (N, oh, ow, C, kh, kw)
+    windows = sliding_window_view(x, (kh, kw), axis=(1, 2))
+    n, oh, ow = windows.shape[:3]
+    # Reordenamos a (N, oh, ow, kh, kw, C) para que coincida con el orden del kernel
+    cols = windows.transpose(0, 1, 2, 4, 5, 3).reshape(n * oh * ow, kh * kw * c)
+    out = cols @ kernel.reshape(kh * kw * c, f)
+    out += bias
+    np.maximum(out, 0, out=out)
+    return out.reshape(n, oh, ow, f)
+
+def max_pool2d(x: np.ndarray, pool_size: int = 2) -> np.ndarray:
+    """MaxPooling 'valid' con stride igual al tamaño de la ventana.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Entrada con forma (N, H, W, C)
+    pool_size : int, optional
+        Tamaño de la ventana, by default 2
+
+    Returns
+    -------
+    np.ndarray
+        Salida con forma (N, H // pool_size, W // pool_size, C)
+    """
+    n, h, w, c = x.shape
+    oh, ow = h // pool_size, w // pool_size
+    x = x[:, :oh * pool_size, :ow * pool_size]
+    return x.reshape(n, oh, pool_size, ow, pool_size, c).max(axis=(2, 4))
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    """Softmax numéricamente estable por filas"""
+    e = np.exp(x - x.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+# Clases
+class NumpyConvNet:
+    """Red convolucional de build_model implementada en NumPy.
+
+    Expone un método predict con la misma firma básica que keras.Model
+    para poder sustituir al modelo de Keras donde solo se necesita inferencia.
+    """
+
+    def __init__(self, weights: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> None:
+        self.weights = weights
+
+    @classmethod
+    def from_h5(cls, weights_path: Path = WEIGHTS_PATH) -> 'NumpyConvNet':
+        """Construye el motor a partir de un archivo de weights de Keras"""
+        return cls(load_weights(weights_path))
+
+    def forward(self, x: np.ndarray) -> np.ndarray:
+        """Pasada hacia delante sobre un lote (N, 28, 28, 1) ya procesado.
+        Devuelve las probabilidades (N, 10)"""
+        x = conv2d_relu(x, *self.weights['conv2d'])
+        x = max_pool2d(x)
+        x = conv2d_relu(x, *self.weights['conv2d_1'])
+        x = max_pool2d(x)
+        x = conv2d_relu(x, *self.weights['conv2d_2'])
+        # Flatten en orden (H, W, C) igual que keras con channels_last
+        x = x.reshape(x.shape[0], -1)
+        kernel, bias = self.weights[DENSE_LAYER]
+        return softmax(x @ kernel + bias)
+
+    def predict_on_batch(self, x: np.ndarray) -> np.ndarray:
+        """Igual que keras.Model.predict_on_batch: una sola pasada sobre el lote"""
+        return self.forward(np.asarray(x, dtype=np.float32).reshape(-1, 28, 28, 1))
+
+    def predict(self, x: np.ndarray, batch_size: int = BATCH_SIZE, **kwargs) -> np.ndarray:
+        """Devuelve las probabilidades para un lote de imágenes procesadas,
+        troceándolo en micro-batches para acotar la memoria de im2col.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Imágenes procesadas con forma (N, 28, 28, 1) o (N, 28, 28)
+        batch_size : int, optional
+            Tamaño de los micro-batches, by default BATCH_SIZE
+
+        Returns
+        -------
+        np.ndarray
+            Probabilidades con forma (N, 10)
+        """
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 28, 28, 1)
+        if len(x) == 0:
+            return np.empty((0, 10), dtype=np.float32)
+        return np.concatenate([self.forward(x[i:i + batch_size])
+                               for i in range(0, len(x), batch_size)])
+
+@lru_cache(maxsize=1)
+def get_engine() -> NumpyConvNet:
+    """Devuelve el motor con los weights por defecto, cargados una sola vez por proceso"""
+    return NumpyConvNet.from_h5()
+
+def predict_batch(array: np.ndarray, batch_size: int = BATCH_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """Predice un lote de imágenes procesadas sin Streamlit ni TensorFlow.
+
+    Parameters
+    ----------
+    array : np.ndarray
+        Imágenes procesadas (escaladas a [0, 1]) con forma (N, 28, 28, 1)
+    batch_size : int, optional
+        Tamaño de los micro-batches, by default BATCH_SIZE
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Dígitos predichos y confianzas, ambos de longitud N
+    """
+    probs = get_engine().predict(array, batch_size=batch_size)
+    return probs.argmax(axis=1), probs.max(axis=1)
+
+def check_parity(num_images: int = 512, atol: float = 1e-5, seed: int = 0) -> float:
+    """Compara las probabilidades del motor NumPy con las del modelo de Keras
+    sobre imágenes aleatorias. Devuelve la máxima diferencia absoluta y lanza
+    AssertionError si supera atol o si alguna predicción no coincide.
+    Requiere TensorFlow, que solo se importa aquí."""
+    from models.convnet_model import build_model
+
+    rng = np.random.default_rng(seed)
+    # Imágenes dispersas para parecerse a un dígito blanco sobre fondo negro
+    imgs = rng.random((num_images, 28, 28, 1), dtype=np.float32)
+    imgs[imgs < 0.7] = 0
+    keras_model = build_model()
+    keras_model.load_weights(WEIGHTS_PATH, by_name=True, skip_mismatch=True)
+    expected = keras_model.predict(imgs, batch_size=BATCH_SIZE, verbose=0)
+    got = get_engine().predict(imgs)
+    max_diff = float(np.abs(expected - got).max())
+    # Sin assert: python -O los elimina y la comprobación no se haría
+    if max_diff > atol:
+        raise AssertionError(f'Diferencia máxima {max_diff:.2e} mayor que {atol:.0e}')
+    distintas = int((expected.argmax(axis=1) != got.argmax(axis=1)).sum())
+    if distintas:
+        raise AssertionError(f'{distintas} predicciones no coinciden (diferencia máxima {max_diff:.2e})')
+    return max_diff
+
+if __name__ == '__main__':
+    print(f'Paridad con Keras correcta. Diferencia máxima: {check_parity():.2e}')
@@ -0,0 +1,175 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con la lectura del dataset MNIST local.
+
+Se buscan los archivos IDX originales (por ejemplo t10k-images-idx3-ubyte,
+opcionalmente comprimidos en .gz) en la carpeta data/ o en la indicada en
+KOPURU_MNIST_DIR. Si no están se lanza FileNotFoundError, salvo que se pida
+expresamente la copia de keras.datasets.mnist (download=True o
+KOPURU_MNIST_DOWNLOAD=1), que se guarda en ~/.keras/datasets y se descarga
+la primera vez.
+"""
+
+import gzip
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Constantes
+DATA_PATH = Path('data')
+MNIST_DIR_ENV = 'KOPURU_MNIST_DIR'
+MNIST_DOWNLOAD_ENV = 'KOPURU_MNIST_DOWNLOAD'
+SPLITS = {
+    'train': ('train-images-idx3-ubyte', 'train-labels-idx1-ubyte'),
+    'test': ('t10k-images-idx3-ubyte', 't10k-labels-idx1-ubyte'),
+}
+# Tipos de dato de la cabecera IDX
+IDX_DTYPES = {0x08: np.uint8, 0x09: np.int8, 0x0B: '>i2', 0x0C: '>i4', 0x0D: '>f4', 0x0E: '>f8'}
+
+# Funciones
+def read_idx(path: Path) -> np.ndarray:
+    """Lee un archivo IDX (o IDX comprimido en .gz) completo en memoria
+
+    Parameters
+    ----------
+    path : Path
+        Ruta al archivo
+
+    Returns
+    -------
+    np.ndarray
+        Array con la forma indicada en la cabecera del archivo
+    """
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        contenido = f.read()
+    dtype, ndim = contenido[2], contenido[3]
+    shape = tuple(int.from_bytes(contenido[4 + 4 * i:8 + 4 * i], 'big') for i in range(ndim))
+    return np.frombuffer(contenido, dtype=IDX_DTYPES[dtype], offset=4 + 4 * ndim).reshape(shape)
+
+def read_idx_header(path: Path) -> Tuple[np.dtype, Tuple[int, ...], int]:
+    """Lee la cabecera de un archivo IDX sin comprimir
+
+    Returns
+    -------
+    Tuple[np.dtype, Tuple[int, ...], int]
+        Tipo de dato, forma del array y offset de los datos en bytes
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        ndim = magic[3]
+        cabecera = f.read(4 * ndim)
+    shape = tuple(int.from_bytes(cabecera[4 * i:4 + 4 * i], 'big') for i in range(ndim))
+    return np.dtype(IDX_DTYPES[magic[2]]), shape, 4 + 4 * ndim
+
+def open_idx(path: Path) -> np.ndarray:
+    """Abre un archivo IDX sin cargarlo en memoria: los datos se mapean con
+    np.memmap y solo se leen del disco las páginas a las que se accede.
+    Los archivos comprimidos en .gz no se pueden mapear y se leen completos
+
+    Parameters
+    ----------
+    path : Path
+        Ruta al archivo
+
+    Returns
+    -------
+    np.ndarray
+        np.memmap de solo lectura (o array en memoria si el archivo es .gz)
+    """
+    if str(path).endswith('.gz'):
+        return read_idx(path)
+    dtype, shape, offset = read_idx_header(path)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def labels_path(images_path: Path) -> Optional[Path]:
+    """Ruta del archivo de etiquetas que acompaña a un archivo de imágenes
+    IDX (train-images-idx3-ubyte -> train-labels-idx1-ubyte), si existe"""
+    images_path = Path(images_path)
+    if 'images-idx3' not in images_path.name:
+        return None
+    nombre = images_path.name.replace('images-idx3', 'labels-idx1').removesuffix('.gz')
+    for candidato in (images_path.with_name(nombre), images_path.with_name(f'{nombre}.gz')):
+        if candidato.exists():
+            return candidato
+    return None
+
+def find_idx(nombre: str) -> Optional[Path]:
+    """Busca un archivo IDX (o su versión .gz) en la carpeta de datos"""
+    carpeta = mnist_dir()
+    for candidato in (carpeta / nombre, carpeta / f'{nombre}.gz'):
+        if candidato.exists():
+            return candidato
+    return None
+
+def mnist_dir() -> Path:
+    """Carpeta en la que se buscan los archivos IDX"""
+    return Path(os.environ.get(MNIST_DIR_ENV, DATA_PATH))
+
+def download_enabled() -> bool:
+    """Indica si KOPURU_MNIST_DOWNLOAD permite descargar MNIST con keras"""
+    return os.environ.get(MNIST_DOWNLOAD_ENV, '').lower() in ('1', 'true', 'yes', 'si', 'sí')
+
+def mnist_available(split: str = 'train') -> bool:
+    """Indica si load_mnist puede devolver el split: están los archivos locales
+    o KOPURU_MNIST_DOWNLOAD permite descargarlo"""
+    return all(find_idx(nombre) is not None for nombre in SPLITS[split]) or download_enabled()
+
+def load_mnist(split: str = 'test', mmap: bool = False, download: Optional[bool] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Devuelve las imágenes (N, 28, 28) uint8 y las etiquetas (N,) de MNIST
+
+    Parameters
+    ----------
+    split : str, optional
+        'train' o 'test', by default 'test'
+    mmap : bool, optional
+        Mapea los archivos IDX locales con np.memmap en lugar de leerlos
+        completos, by default False
+    download : Optional[bool], optional
+        Si no están los archivos locales, usa (y descarga si hace falta) la
+        copia de keras. Por defecto lo decide KOPURU_MNIST_DOWNLOAD
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Imágenes y etiquetas
+
+    Raises
+    ------
+    FileNotFoundError
+        Si faltan los archivos locales y no se ha pedido la descarga
+    """
+    nombre_imagenes, nombre_etiquetas = SPLITS[split]
+    imagenes, etiquetas = find_idx(nombre_imagenes), find_idx(nombre_etiquetas)
+    if imagenes is not None and etiquetas is not None:
+        reader = open_idx if mmap else read_idx
+        return reader(imagenes), reader(etiquetas)
+    if not (download_enabled() if download is None else download):
+        raise FileNotFoundError(
+            f'No se encuentran {nombre_imagenes} y {nombre_etiquetas} (ni su versión .gz) en '
+            f'{mnist_dir().resolve()}. Cópialos en {DATA_PATH}/ o indica su carpeta con {MNIST_DIR_ENV}; '
+            f'para descargarlos con keras usa {MNIST_DOWNLOAD_ENV}=1')
+    # Copia de keras en ~/.keras/datasets
+    from tensorflow import keras
+    (x_train, y_train), (x_test, y_test) = keras.datasets.mnist.load_data()
+    return (x_train, y_train) if split == 'train' else (x_test, y_test)
+
+def load_sample(n: int, split: str = 'train', seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Devuelve una muestra aleatoria de n imágenes y etiquetas de MNIST"""
+    imagenes, etiquetas = load_mnist(split)
+    idx = np.random.default_rng(seed).choice(len(imagenes), size=min(n, len(imagenes)), replace=False)
+    return imagenes[idx], etiquetas[idx]
@@ -0,0 +1,123 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Camino de predicción de lotes compartido por la app y el servidor HTTP.
+
+Para cada lote se buscan primero las imágenes en la caché de predicciones;
+de las que faltan, las que la primera etapa de la cascada predice con
+seguridad salen con su predicción, y solo el resto pasa por la convnet, en
+una sola llamada. Las probabilidades de la convnet se calibran y todas las
+predicciones nuevas se guardan en la caché. Quién llama decide cómo se lanza
+la convnet (directamente o a través del agrupador de peticiones).
+"""
+
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from ingestion import process_image
+from metrics import MetricsRegistry
+from models.cache import PredictionCache
+from models.calibration import TemperatureCalibrator, aggregate, augment
+from models.cascade import FirstStage, early_exits
+
+# Tipos
+Forward = Callable[[np.ndarray], np.ndarray]
+
+# Funciones
+def cache_namespace(version: str,
+                    backend: str,
+                    etapa: Optional[FirstStage],
+                    umbral: float,
+                    temperatura: float,
+                    tta: bool = False) -> str:
+    """Namespace de la caché de predicciones. Incluye todo lo que cambia la
+    predicción o la confianza guardadas: versión del modelo, backend, modo de
+    predicción (con la primera etapa y su umbral si hay cascada) y temperatura"""
+    if tta:
+        modo = 'tta'
+    elif etapa is not None:
+        modo = f'cascada:{etapa.version}@{umbral:g}'
+    else:
+        modo = 'simple'
+    return f'{version}:{backend}:{modo}:T={temperatura:.4g}'
+
+def predict_images(imagenes: np.ndarray,
+                   forward: Forward,
+                   cache: PredictionCache,
+                   calibrator: TemperatureCalibrator,
+                   registry: MetricsRegistry,
+                   etapa: Optional[FirstStage] = None,
+                   umbral: float = 1.0,
+                   tta: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """Predice un lote pasando por la caché, la cascada y la convnet
+
+    Parameters
+    ----------
+    imagenes : np.ndarray
+        Lote de imágenes sin procesar con forma (N, 28, 28)
+    forward : Forward
+        Función que recibe el lote procesado (M, 28, 28, 1) y devuelve las
+        probabilidades (M, 10) de la convnet
+    cache : PredictionCache
+        Caché del namespace que corresponde a la configuración (ver cache_namespace)
+    calibrator : TemperatureCalibrator
+        Calibrador de la versión del modelo
+    registry : MetricsRegistry
+        Registro en el que se cuentan aciertos de la caché y salidas tempranas
+    etapa : Optional[FirstStage], optional
+        Primera etapa de la cascada, by default None para no usarla
+    umbral : float, optional
+        Confianza a partir de la cual una imagen sale en la primera etapa, by default 1.0
+    tta : bool, optional
+        Promedia la predicción de varias variantes de cada imagen. Todas las
+        variantes del lote van a la convnet en la misma llamada, by default False
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Arrays de dígitos predichos y de confianzas calibradas, ambos de longitud N
+    """
+    with registry.timer('cache_lookup_batch'):
+        claves = [cache.digest(img) for img in imagenes]
+        resultados = cache.get_many(claves)
+    faltan = np.array([clave not in resultados for clave in claves], dtype=bool)
+    registry.inc('prediction_cache_hits', len(claves) - int(faltan.sum()))
+    registry.inc('prediction_cache_misses', int(faltan.sum()))
+    if faltan.any():
+        pendientes = imagenes[faltan]
+        probs = np.empty((len(pendientes), 10), dtype=np.float64)
+        completas = np.ones(len(pendientes), dtype=bool)
+        # Las imágenes en las que la primera etapa está segura no pasan por la convnet
+        if etapa is not None and not tta:
+            with registry.timer('first_stage_batch'):
+                probs_etapa = etapa.predict(pendientes)
+            salen = early_exits(probs_etapa, umbral)
+            probs[salen], completas = probs_etapa[salen], ~salen
+            registry.inc('cascade_requests', len(pendientes))
+            registry.inc('cascade_early_exits', int(salen.sum()))
+        if completas.any():
+            with registry.timer('preprocess_batch'):
+                img_processed = process_image(augment(pendientes[completas]) if tta else pendientes[completas])
+            probs_modelo = np.asarray(forward(img_processed))
+            if tta:
+                probs_modelo = aggregate(probs_modelo)
+            probs[completas] = calibrator.calibrate(probs_modelo, tta)
+        nuevas = {clave: (int(pred), float(conf))
+                  for clave, pred, conf in zip(np.array(claves)[faltan], probs.argmax(axis=1), probs.max(axis=1))}
+        cache.put_many(nuevas)
+        resultados.update(nuevas)
+    preds = np.array([resultados[clave][0] for clave in claves], dtype=np.int64)
+    confs = np.array([resultados[clave][1] for clave in claves], dtype=np.float32)
+    return preds, confs
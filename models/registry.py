@@ -0,0 +1,465 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Registro de versiones del modelo con cambio en caliente y weights compartidos.
+
+Cada archivo de weights (*.h5) de la carpeta models/ es una versión. El
+registro carga la versión activa y permite cambiarla sin reiniciar: la nueva
+versión se carga antes del cambio y la anterior se libera cuando terminan las
+predicciones que la estaban usando. La versión elegida se guarda en un archivo
+que comparten todos los procesos del servidor, que la adoptan en su siguiente
+sync().
+
+Los weights de cada versión se publican en un segmento de memoria compartida
+(multiprocessing.shared_memory) con un nombre derivado de su hash, de modo que
+todas las réplicas de una máquina leen una única copia de solo lectura. El
+motor NumPy usa directamente las vistas sobre ese segmento; Keras y TFLite
+copian los weights a sus propios tensores al cargarlos. Al salir, el proceso
+que creó un segmento borra su nombre; las réplicas que sigan adjuntas
+conservan su mapeo y las nuevas lo vuelven a publicar.
+
+Gestión desde la línea de comandos:
+
+    python -m models.registry                  # lista las versiones
+    python -m models.registry --activate otro_weights.h5
+    python -m models.registry --unlink         # borra los segmentos publicados
+"""
+
+import argparse
+import atexit
+from contextlib import contextmanager
+from functools import lru_cache
+import hashlib
+import json
+from multiprocessing import resource_tracker, shared_memory
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from models.engine import load_weights
+
+# Constantes
+MODEL_PATH = Path('models')
+WEIGHTS_PATTERN = '*.h5'
+# Versión activa al arrancar si no hay ninguna elegida en el archivo compartido
+MODEL_ENV = 'KOPURU_MODEL'
+# Archivo con la versión activa compartido por todos los procesos
+ACTIVE_FILE_ENV = 'KOPURU_ACTIVE_MODEL_FILE'
+ACTIVE_FILE_DEFAULT = '.cache/modelo_activo'
+# Segundos máximos que se espera a que terminen las predicciones de la versión anterior
+DRAIN_TIMEOUT = 30.0
+SHM_PREFIX = 'kopuru_'
+# Cabecera del segmento: magic (se escribe al final, marca que está listo),
+# 4 bytes reservados y longitud del manifiesto JSON
+SHM_MAGIC = b'KPRW'
+HEADER_SIZE = 12
+ALIGNMENT = 64
+ATTACH_TIMEOUT = 10.0
+
+# Tipos
+Weights = Dict[str, Tuple[np.ndarray, np.ndarray]]
+Loader = Callable[[Path, str, Weights], object]
+
+# Segmentos creados por este proceso, que se borran al salir
+_OWNED: Set[str] = set()
+# Segmentos que no se han podido cerrar porque aún había vistas sobre ellos
+_PENDIENTES: List[shared_memory.SharedMemory] = []
+
+# Funciones auxiliares
+@lru_cache(maxsize=None)
+def file_digest(path: Path, mtime_ns: int, size: int) -> str:
+    """Hash blake2b de un archivo. mtime_ns y size forman parte de la clave
+    de la caché para volver a calcularlo si el archivo cambia"""
+    h = hashlib.blake2b(digest_size=8)
+    with open(path, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+def weights_version(path: Path) -> str:
+    """Versión de un archivo de weights: su nombre y su hash, nombre:hash"""
+    path = Path(path)
+    stat = path.stat()
+    return f'{path.name}:{file_digest(path, stat.st_mtime_ns, stat.st_size)}'
+
+def discover_weights(path: Path = MODEL_PATH) -> List[Path]:
+    """Archivos de weights disponibles en la carpeta de modelos"""
+    return sorted(Path(path).glob(WEIGHTS_PATTERN))
+
+def _untrack(shm: shared_memory.SharedMemory) -> None:
+    """Evita que el resource_tracker borre el segmento al salir del proceso.
+    En Python < 3.13 lo registra también al adjuntarse a un segmento existente,
+    y lo borraría aunque otras réplicas lo sigan usando"""
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+def _unlink_owned() -> None:
+    """Borra al salir del proceso los segmentos que ha creado"""
+    for name in list(_OWNED):
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+    _OWNED.clear()
+
+def _own(name: str) -> None:
+    """Apunta un segmento creado por este proceso para borrarlo al salir"""
+    if not _OWNED:
+        atexit.register(_unlink_owned)
+    _OWNED.add(name)
+
+def _in_use(shm: shared_memory.SharedMemory) -> bool:
+    """Indica si quedan arrays de numpy sobre el segmento. numpy suelta el
+    buffer de shm.buf nada más crear cada vista y se queda como base el mmap,
+    así que SharedMemory.close no las detecta y las dejaría apuntando a memoria
+    liberada. Sin vistas, al mmap solo lo referencian el SharedMemory, su
+    memoryview y el argumento de getrefcount"""
+    return sys.getrefcount(shm.buf.obj) > 3
+
+def _close(shm: shared_memory.SharedMemory) -> None:
+    """Cierra el mapeo de un segmento. Si todavía lo usa algún modelo (por
+    ejemplo uno cuya predicción no terminó al drenar) queda pendiente y se
+    vuelve a intentar en el siguiente cierre"""
+    _PENDIENTES.append(shm)
+    for pendiente in list(_PENDIENTES):
+        if not _in_use(pendiente):
+            pendiente.close()
+            _PENDIENTES.remove(pendiente)
+
+# Clases
+class SharedWeights:
+    """Weights de una versión publicados en memoria compartida.
+
+    El primer proceso que publica una versión crea el segmento y copia los
+    weights; los demás se adjuntan a él. Los arrays expuestos en weights son
+    vistas de solo lectura sobre el segmento, sin copia.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, weights: Weights, creado: bool) -> None:
+        self.name = shm.name
+        self.weights = weights
+        self.creado = creado
+        self._shm = shm
+
+    @staticmethod
+    def segment_name(version: str) -> str:
+        """Nombre del segmento de una versión, derivado de su hash"""
+        return SHM_PREFIX + hashlib.blake2b(version.encode(), digest_size=8).hexdigest()
+
+    @classmethod
+    def publish(cls, version: str, weights_path: Path) -> 'SharedWeights':
+        """Adjunta el segmento de la versión o, si no existe, lo crea a partir
+        del archivo de weights
+
+        Parameters
+        ----------
+        version : str
+            Versión devuelta por weights_version
+        weights_path : Path
+            Archivo de weights de la versión
+
+        Returns
+        -------
+        SharedWeights
+            Weights de la versión en memoria compartida
+        """
+        name = cls.segment_name(version)
+        try:
+            return cls.attach(name)
+        except FileNotFoundError:
+            pass
+        arrays = load_weights(weights_path)
+        manifiesto, offset = {}, 0
+        for layer, (kernel, bias) in arrays.items():
+            manifiesto[layer] = []
+            for array in (kernel, bias):
+                manifiesto[layer].append([array.dtype.str, list(array.shape), offset])
+                offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        cabecera = json.dumps(manifiesto).encode()
+        inicio = -(-(HEADER_SIZE + len(cabecera)) // ALIGNMENT) * ALIGNMENT
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=inicio + offset)
+        except FileExistsError:
+            # Otro proceso lo ha creado a la vez
+            return cls.attach(name)
+        _untrack(shm)
+        _own(name)
+        buf = shm.buf
+        buf[HEADER_SIZE:HEADER_SIZE + len(cabecera)] = cabecera
+        for layer, (kernel, bias) in arrays.items():
+            for array, (_, _, off) in zip((kernel, bias), manifiesto[layer]):
+                np.ndarray(array.shape, array.dtype, buffer=buf, offset=inicio + off)[...] = array
+        buf[8:12] = len(cabecera).to_bytes(4, 'little')
+        # El magic se escribe el último: marca que el segmento está listo
+        buf[0:4] = SHM_MAGIC
+        return cls(shm, cls._views(buf, manifiesto, inicio), creado=True)
+
+    @classmethod
+    def attach(cls, name: str) -> 'SharedWeights':
+        """Se adjunta a un segmento ya publicado. Lanza FileNotFoundError si no existe"""
+        shm = shared_memory.SharedMemory(name=name)
+        _untrack(shm)
+        deadline = time.monotonic() + ATTACH_TIMEOUT
+        while bytes(shm.buf[0:4]) != SHM_MAGIC:
+            if time.monotonic() > deadline:
+                shm.close()
+                raise TimeoutError(f'El segmento {name} no se ha terminado de publicar')
+            time.sleep(0.01)
+        longitud = int.from_bytes(shm.buf[8:12], 'little')
+        manifiesto = json.loads(bytes(shm.buf[HEADER_SIZE:HEADER_SIZE + longitud]))
+        inicio = -(-(HEADER_SIZE + longitud) // ALIGNMENT) * ALIGNMENT
+        return cls(shm, cls._views(shm.buf, manifiesto, inicio), creado=False)
+
+    @staticmethod
+    def _views(buf: memoryview, manifiesto: Dict, inicio: int) -> Weights:
+        """Vistas de solo lectura sobre el segmento a partir del manifiesto"""
+        weights = {}
+        for layer, entradas in manifiesto.items():
+            vistas = []
+            for dtype, shape, offset in entradas:
+                vista = np.ndarray(tuple(shape), np.dtype(dtype), buffer=buf, offset=inicio + offset)
+                vista.flags.writeable = False
+                vistas.append(vista)
+            weights[layer] = tuple(vistas)
+        return weights
+
+    def close(self) -> None:
+        """Suelta los weights y cierra el mapeo en este proceso. Si algún
+        modelo usa todavía sus vistas el cierre se aplaza (ver _close)"""
+        self.weights = {}
+        _close(self._shm)
+
+    @staticmethod
+    def unlink_all() -> List[str]:
+        """Borra todos los segmentos publicados en la máquina (solo Linux,
+        donde viven en /dev/shm). Devuelve sus nombres"""
+        borrados = []
+        for path in Path('/dev/shm').glob(f'{SHM_PREFIX}*'):
+            try:
+                shm = shared_memory.SharedMemory(name=path.name)
+            except FileNotFoundError:
+                continue
+            shm.close()
+            shm.unlink()
+            borrados.append(path.name)
+        return borrados
+
+class ModelRegistry:
+    """Versiones del modelo disponibles y versión activa, con cambio en caliente.
+
+    Parameters
+    ----------
+    loader : Loader
+        Función (weights_path, backend, weights) -> modelo que construye el
+        modelo de un backend a partir de los weights compartidos
+    path : Path, optional
+        Carpeta con los archivos de weights, by default MODEL_PATH
+    default : Optional[str], optional
+        Versión activa inicial si no hay ninguna elegida en el archivo compartido
+        ni en KOPURU_MODEL, by default la primera por orden alfabético
+    active_file : Optional[Path], optional
+        Archivo compartido con la versión activa, by default el de KOPURU_ACTIVE_MODEL_FILE.
+        None para no compartirla
+    drain_timeout : float, optional
+        Segundos que se espera a que termine la versión anterior, by default DRAIN_TIMEOUT
+    """
+
+    def __init__(self,
+                 loader: Loader,
+                 path: Path = MODEL_PATH,
+                 default: Optional[str] = None,
+                 active_file: Optional[Path] = None,
+                 drain_timeout: float = DRAIN_TIMEOUT) -> None:
+        self.loader = loader
+        self.path = Path(path)
+        self.drain_timeout = drain_timeout
+        if active_file is None and (ruta := os.environ.get(ACTIVE_FILE_ENV, ACTIVE_FILE_DEFAULT)):
+            active_file = Path(ruta)
+        self.active_file = active_file
+        self._active_mtime = None
+        # _lock protege la carga de modelos y _swap_lock serializa los cambios de versión
+        self._lock = threading.Lock()
+        self._swap_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._generation = 0
+        self._inflight: Dict[int, int] = {}
+        self._models: Dict[str, object] = {}
+        self._shared: Optional[SharedWeights] = None
+        disponibles = discover_weights(self.path)
+        if not disponibles:
+            raise FileNotFoundError(f'No hay archivos de weights en {self.path}')
+        elegido = self._read_active_file()
+        self.active = elegido or os.environ.get(MODEL_ENV) or default or disponibles[0].name
+        self.version = weights_version(self.active_path)
+
+    @property
+    def active_path(self) -> Path:
+        """Ruta al archivo de weights de la versión activa"""
+        return self.path / self.active
+
+    def versions(self) -> List[Dict]:
+        """Versiones disponibles: archivo, versión (nombre:hash), tamaño y si está activa"""
+        return [{'archivo': p.name, 'version': weights_version(p), 'size_kb': p.stat().st_size / 1024,
+                 'activa': p.name == self.active} for p in discover_weights(self.path)]
+
+    def _shared_weights(self) -> SharedWeights:
+        """Weights de la versión activa en memoria compartida"""
+        if self._shared is None:
+            self._shared = SharedWeights.publish(self.version, self.active_path)
+        return self._shared
+
+    def model(self, backend: str) -> object:
+        """Devuelve el modelo de la versión activa para un backend, cargándolo
+        la primera vez. No cuenta como predicción en curso, para eso usar lease"""
+        modelo = self._models.get(backend)
+        if modelo is not None:
+            return modelo
+        with self._lock:
+            if backend not in self._models:
+                self._models[backend] = self.loader(self.active_path, backend, self._shared_weights().weights)
+            return self._models[backend]
+
+    @contextmanager
+    def lease(self, backend: str) -> Iterator[object]:
+        """Presta el modelo activo durante una predicción. Un cambio de versión
+        espera a que se devuelvan los préstamos de la versión anterior"""
+        while True:
+            # El modelo y la generación se leen juntos: un cambio de versión
+            # los actualiza a la vez con _cond tomado
+            with self._cond:
+                modelo = self._models.get(backend)
+                if modelo is not None:
+                    generation = self._generation
+                    self._inflight[generation] = self._inflight.get(generation, 0) + 1
+                    break
+            # La primera vez se carga fuera de _cond y se vuelve a leer
+            self.model(backend)
+        try:
+            yield modelo
+        finally:
+            with self._cond:
+                self._inflight[generation] -= 1
+                self._cond.notify_all()
+
+    def activate(self, archivo: str, persist: bool = True) -> bool:
+        """Cambia la versión activa sin reiniciar. Los modelos de la nueva versión
+        se cargan antes del cambio para los backends ya en uso, y la versión
+        anterior se libera cuando terminan sus predicciones en curso. La versión
+        solo se guarda en el archivo compartido si se ha podido cargar
+
+        Parameters
+        ----------
+        archivo : str
+            Nombre del archivo de weights de la nueva versión
+        persist : bool, optional
+            Guarda la versión en el archivo compartido para que la adopten
+            los demás procesos, by default True
+
+        Returns
+        -------
+        bool
+            True si las predicciones de la versión anterior terminaron antes de DRAIN_TIMEOUT
+        """
+        if not (self.path / archivo).is_file():
+            raise FileNotFoundError(f'No existe la versión {archivo} en {self.path}')
+        version = weights_version(self.path / archivo)
+        with self._swap_lock:
+            if version == self.version:
+                if persist:
+                    self._write_active_file(archivo)
+                return True
+            shared = SharedWeights.publish(version, self.path / archivo)
+            try:
+                nuevos = {backend: self.loader(self.path / archivo, backend, shared.weights)
+                          for backend in list(self._models)}
+            except BaseException:
+                shared.close()
+                raise
+            with self._lock, self._cond:
+                anterior, shared_anterior = self._generation, self._shared
+                self.active, self.version = archivo, version
+                self._models, self._shared = nuevos, shared
+                self._generation += 1
+            if persist:
+                self._write_active_file(archivo)
+            # Drenamos las predicciones que todavía usan la versión anterior
+            with self._cond:
+                drenado = self._cond.wait_for(lambda: self._inflight.get(anterior, 0) == 0, timeout=self.drain_timeout)
+                self._inflight.pop(anterior, None)
+            if shared_anterior is not None:
+                shared_anterior.close()
+        return drenado
+
+    def sync(self) -> bool:
+        """Adopta la versión elegida en el archivo compartido si ha cambiado
+        desde la última lectura. Devuelve True si se ha cambiado de versión"""
+        archivo = self._read_active_file()
+        if archivo is None or archivo == self.active:
+            return False
+        self.activate(archivo, persist=False)
+        return True
+
+    def _read_active_file(self) -> Optional[str]:
+        """Lee la versión del archivo compartido solo si ha cambiado desde la última lectura"""
+        if self.active_file is None:
+            return None
+        try:
+            mtime = self.active_file.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if mtime == self._active_mtime:
+            return None
+        self._active_mtime = mtime
+        archivo = self.active_file.read_text(encoding='utf-8').strip()
+        return archivo if (self.path / archivo).is_file() else None
+
+    def _write_active_file(self, archivo: str) -> None:
+        """Guarda la versión en el archivo compartido de forma atómica"""
+        if self.active_file is None:
+            return
+        self.active_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.active_file.with_suffix('.tmp')
+        tmp.write_text(archivo, encoding='utf-8')
+        tmp.replace(self.active_file)
+        self._active_mtime = self.active_file.stat().st_mtime_ns
+
+def main() -> None:
+    """Entry point del CLI de gestión de versiones"""
+    parser = argparse.ArgumentParser(prog='python -m models.registry', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--activate', help='Archivo de weights que pasa a ser la versión activa')
+    parser.add_argument('--unlink', action='store_true', help='Borra los segmentos de memoria compartida publicados')
+    args = parser.parse_args()
+
+    if args.unlink:
+        for nombre in SharedWeights.unlink_all():
+            print(f'Borrado {nombre}')
+        return
+    registry = ModelRegistry(loader=lambda *args: None)
+    if args.activate:
+        registry.activate(args.activate)
+    for fila in registry.versions():
+        print(f"{'*' if fila['activa'] else ' '} {fila['archivo']:<40} {fila['version']:<60} {fila['size_kb']:8.1f} KB")
+
+if __name__ == '__main__':
+    main()
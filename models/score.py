@@ -0,0 +1,262 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Puntúa un dataset completo fuera de la interfaz.
+
+La entrada puede ser un archivo de imágenes IDX de MNIST (*-images-idx3-ubyte)
+o una carpeta con imágenes. Los archivos IDX se mapean con np.memmap, así que
+nunca se cargan completos en memoria. El trabajo se reparte por bloques entre
+un pool de procesos que cargan el modelo una sola vez cada uno, y las
+predicciones se escriben a CSV o Parquet a medida que llegan.
+
+    python -m models.score data/t10k-images-idx3-ubyte --output predicciones.parquet
+    python -m models.score carpeta/ --output predicciones.csv --workers 4
+"""
+
+import argparse
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import sys
+import time
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ingestion import decode_digit, process_image
+from models.convnet_model import BACKENDS, get_backend, get_model_registry, load_model
+from models.mnist_data import labels_path, open_idx
+from models.tflite_backend import tflite_path
+
+# Constantes
+SHARD_SIZE = 8192
+BATCH_SIZE = 256
+IMAGE_SUFFIXES = ('.png', '.tif', '.jpg', '.bmp', '.jpeg')
+FORMATOS = ('.csv', '.parquet')
+
+# Estado de cada proceso trabajador. Fuera del runtime de Streamlit
+# cache_resource no memoiza, así que guardamos aquí la referencia al modelo
+_MODEL = None
+_IDX: Dict[str, np.ndarray] = {}
+
+# Funciones auxiliares
+def init_worker(backend: str, threads: Optional[int] = None) -> None:
+    """Inicializa un proceso trabajador: limita los hilos de TensorFlow
+    para no sobresuscribir la CPU entre procesos y carga el modelo"""
+    global _MODEL
+    if threads and backend == 'keras':
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    _MODEL = load_model(backend=backend)
+
+def predict_array(imagenes: np.ndarray, batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Predice un bloque (N, 28, 28) con el modelo del proceso"""
+    probs = _MODEL.predict(process_image(imagenes), batch_size=batch_size, verbose=0)
+    return probs.argmax(axis=1).astype(np.int8), probs.max(axis=1).astype(np.float32)
+
+def score_idx_shard(path: str, start: int, end: int, batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Predice las imágenes [start, end) de un archivo IDX. El archivo se
+    mapea una vez por proceso y el bloque es una vista sin copia"""
+    if path not in _IDX:
+        _IDX[path] = open_idx(path)
+    return predict_array(_IDX[path][start:end], batch_size)
+
+def score_files_shard(paths: List[str], batch_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Decodifica y predice un bloque de archivos de imagen. Las imágenes
+    que no se pueden leer se devuelven con pred -1 y conf NaN"""
+    imagenes = np.zeros((len(paths), 28, 28), dtype=np.uint8)
+    leidas = np.zeros(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        try:
+            imagenes[i] = decode_digit(Path(path).read_bytes())
+            leidas[i] = True
+        except Exception:
+            continue
+    preds = np.full(len(paths), -1, dtype=np.int8)
+    confs = np.full(len(paths), np.nan, dtype=np.float32)
+    if leidas.any():
+        preds[leidas], confs[leidas] = predict_array(imagenes[leidas], batch_size)
+    return preds, confs
+
+# Clases
+class PredictionWriter:
+    """Escribe las predicciones por bloques en CSV o Parquet sin acumularlas en memoria"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.formato = self.path.suffix.lower()
+        if self.formato not in FORMATOS:
+            raise ValueError(f'Formato de salida no soportado: {self.formato}. Opciones: {FORMATOS}')
+        self._parquet = None
+        self._header = True
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Añade un bloque de predicciones al archivo"""
+        if self.formato == '.csv':
+            df.to_csv(self.path, mode='w' if self._header else 'a', header=self._header, index=False)
+            self._header = False
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        tabla = pa.Table.from_pandas(df, preserve_index=False)
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self.path, tabla.schema)
+        self._parquet.write_table(tabla)
+
+    def close(self) -> None:
+        """Cierra el archivo"""
+        if self._parquet is not None:
+            self._parquet.close()
+
+    def __enter__(self) -> 'PredictionWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+# Funciones
+def plan_shards(entrada: Path, shard_size: int, batch_size: int) -> Tuple[int, Iterator[Tuple[Callable, tuple, Dict[str, np.ndarray]]]]:
+    """Divide la entrada en bloques de trabajo
+
+    Returns
+    -------
+    Tuple[int, Iterator]
+        Número total de imágenes e iterador de (función, argumentos, columnas
+        identificativas del bloque para la salida)
+    """
+    if entrada.is_dir():
+        archivos = sorted(p for p in entrada.rglob('*') if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+
+        def bloques_archivos():
+            for start in range(0, len(archivos), shard_size):
+                bloque = archivos[start:start + shard_size]
+                yield (score_files_shard, ([str(p) for p in bloque], batch_size),
+                       {'archivo': np.array([str(p.relative_to(entrada)) for p in bloque], dtype=object)})
+        return len(archivos), bloques_archivos()
+
+    total = len(open_idx(entrada))
+    etiquetas = open_idx(ruta) if (ruta := labels_path(entrada)) is not None else None
+
+    def bloques_idx():
+        for start in range(0, total, shard_size):
+            end = min(start + shard_size, total)
+            columnas = {'indice': np.arange(start, end)}
+            if etiquetas is not None:
+                columnas['real'] = np.asarray(etiquetas[start:end], dtype=np.int8)
+            yield score_idx_shard, (str(entrada), start, end, batch_size), columnas
+    return total, bloques_idx()
+
+def score(entrada: Path,
+          output: Path,
+          workers: int = os.cpu_count() or 1,
+          shard_size: int = SHARD_SIZE,
+          batch_size: int = BATCH_SIZE,
+          backend: Optional[str] = None) -> Dict[str, float]:
+    """Puntúa un archivo IDX o una carpeta de imágenes y escribe las predicciones
+
+    Parameters
+    ----------
+    entrada : Path
+        Archivo de imágenes IDX o carpeta con imágenes
+    output : Path
+        Archivo de salida .csv o .parquet
+    workers : int, optional
+        Procesos trabajadores, 0 para predecir en el propio proceso, by default os.cpu_count()
+    shard_size : int, optional
+        Imágenes por bloque de trabajo, by default SHARD_SIZE
+    batch_size : int, optional
+        Tamaño de los lotes que se pasan al modelo, by default BATCH_SIZE
+    backend : Optional[str], optional
+        Backend de inferencia, by default el de KOPURU_BACKEND
+
+    Returns
+    -------
+    Dict[str, float]
+        Estadísticas de la ejecución: imágenes, segundos, imágenes por segundo,
+        imágenes ilegibles y precisión si hay etiquetas
+    """
+    entrada, backend = Path(entrada), backend or get_backend()
+    start = time.perf_counter()
+    total, bloques = plan_shards(entrada, shard_size, batch_size)
+    aciertos = etiquetadas = ilegibles = 0
+
+    def escribir(writer: PredictionWriter, columnas: Dict[str, np.ndarray], resultado: Tuple[np.ndarray, np.ndarray]) -> None:
+        nonlocal aciertos, etiquetadas, ilegibles
+        preds, confs = resultado
+        writer.write(pd.DataFrame({**columnas, 'pred': preds, 'conf': confs}))
+        ilegibles += int((preds < 0).sum())
+        if 'real' in columnas:
+            aciertos += int((preds == columnas['real']).sum())
+            etiquetadas += len(preds)
+
+    with PredictionWriter(output) as writer:
+        if workers == 0:
+            init_worker(backend)
+            for fn, args, columnas in bloques:
+                escribir(writer, columnas, fn(*args))
+        else:
+            # El modelo TFLite se exporta una sola vez antes de lanzar los procesos
+            if backend.startswith('tflite') and not tflite_path(get_model_registry().active_path,
+                                                                backend.removeprefix('tflite-')).exists():
+                load_model(backend=backend)
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_worker, initargs=(backend, threads)) as pool:
+                # Como mucho 2 bloques en vuelo por proceso, las salidas se escriben en orden
+                pendientes: Deque[Tuple[Future, Dict[str, np.ndarray]]] = deque()
+                for fn, args, columnas in bloques:
+                    pendientes.append((pool.submit(fn, *args), columnas))
+                    if len(pendientes) >= 2 * workers:
+                        future, cols = pendientes.popleft()
+                        escribir(writer, cols, future.result())
+                while pendientes:
+                    future, cols = pendientes.popleft()
+                    escribir(writer, cols, future.result())
+
+    segundos = time.perf_counter() - start
+    stats = {'imagenes': total, 'segundos': segundos, 'imagenes_por_segundo': total / segundos if segundos else 0.0,
+             'ilegibles': ilegibles, 'workers': workers, 'backend': backend}
+    if etiquetadas:
+        stats['accuracy'] = aciertos / etiquetadas
+    return stats
+
+def main() -> None:
+    """Entry point del CLI"""
+    parser = argparse.ArgumentParser(prog='python -m models.score', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('entrada', type=Path, help='Archivo de imágenes IDX o carpeta con imágenes')
+    parser.add_argument('--output', type=Path, required=True, help='Archivo de salida .csv o .parquet')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Procesos trabajadores, 0 para predecir en el propio proceso')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE, help='Imágenes por bloque de trabajo')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Tamaño de los lotes del modelo')
+    parser.add_argument('--backend', choices=BACKENDS, help='Backend de inferencia (por defecto KOPURU_BACKEND)')
+    parser.add_argument('--stats', type=Path, help='Archivo JSON donde guardar las estadísticas')
+    args = parser.parse_args()
+
+    stats = score(args.entrada, args.output, workers=args.workers, shard_size=args.shard_size,
+                  batch_size=args.batch_size, backend=args.backend)
+    salida = json.dumps(stats, indent=2)
+    if args.stats:
+        args.stats.write_text(salida, encoding='utf-8')
+    print(salida, file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Backend de inferencia TFLite cuantizado.
+
+Exporta la convnet a TFLite en float16 o en int8 (cuantización post-entrenamiento
+calibrada con una muestra de MNIST) y sirve las predicciones con el intérprete
+ligero. Los modelos exportados se guardan junto a los weights y se reutilizan.
+
+Informe de paridad y precisión frente al modelo float32:
+
+    python -m models.tflite_backend
+"""
+
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from models.registry import weights_version
+
+# Constantes
+MODEL_PATH = Path('models')
+QUANTIZATIONS = ('float16', 'int8')
+CALIBRATION_SIZE = 500
+REPORT_SIZE = 2000
+BATCH_SIZE = 256
+
+# Funciones auxiliares
+def get_interpreter_class():
+    """Devuelve la clase Interpreter más ligera disponible: LiteRT,
+    tflite_runtime o, en su defecto, la incluida en TensorFlow"""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+def tflite_path(weights_path: Path, quantization: str) -> Path:
+    """Ruta del modelo TFLite exportado a partir de unos weights. Incluye el
+    hash de los weights para no servir un modelo exportado de un archivo de
+    weights que después se ha sustituido"""
+    weights_path = Path(weights_path)
+    digest = weights_version(weights_path).rpartition(':')[2]
+    return weights_path.with_name(f'{weights_path.stem}_{digest}_{quantization}.tflite')
+
+def export_tflite(keras_model, quantization: str, calibration: np.ndarray = None) -> bytes:
+    """Convierte un modelo de Keras a TFLite
+
+    Parameters
+    ----------
+    keras_model : keras.Model
+        Modelo con los weights cargados
+    quantization : str
+        'float16' o 'int8'
+    calibration : np.ndarray, optional
+        Imágenes procesadas (N, 28, 28, 1) para calibrar la cuantización int8
+
+    Returns
+    -------
+    bytes
+        Modelo TFLite serializado
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'Cuantización no soportada: {quantization}. Opciones: {QUANTIZATIONS}')
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        if calibration is None:
+            raise ValueError('La cuantización int8 necesita imágenes de calibración')
+        # Entrada y salida siguen en float32 para que el backend sea intercambiable con Keras
+        converter.representative_dataset = lambda: ([img[np.newaxis]] for img in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+# Clases
+class TFLiteModel:
+    """Envuelve un intérprete TFLite con la misma interfaz de predicción que keras.Model.
+
+    El intérprete no es thread-safe, así que las llamadas se serializan con un lock.
+    """
+
+    def __init__(self, model_content: bytes, num_threads: int = None) -> None:
+        self.model_content = model_content
+        self._interpreter = get_interpreter_class()(model_content=model_content, num_threads=num_threads)
+        self._input = self._interpreter.get_input_details()[0]['index']
+        self._output = self._interpreter.get_output_details()[0]['index']
+        self._batch = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: Path, num_threads: int = None) -> 'TFLiteModel':
+        """Carga un modelo TFLite desde disco"""
+        return cls(Path(path).read_bytes(), num_threads=num_threads)
+
+    def predict_on_batch(self, x: np.ndarray) -> np.ndarray:
+        """Devuelve las probabilidades (N, 10) de un lote procesado (N, 28, 28, 1)"""
+        x = np.ascontiguousarray(x, dtype=np.float32).reshape(-1, 28, 28, 1)
+        with self._lock:
+            # Solo se redimensiona el tensor de entrada cuando cambia el tamaño del lote
+            if self._batch != len(x):
+                self._interpreter.resize_tensor_input(self._input, x.shape)
+                self._interpreter.allocate_tensors()
+                self._batch = len(x)
+            self._interpreter.set_tensor(self._input, x)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output).copy()
+
+    def predict(self, x: np.ndarray, batch_size: int = BATCH_SIZE, **kwargs) -> np.ndarray:
+        """Igual que keras.Model.predict: trocea x en lotes de batch_size"""
+        x = np.asarray(x, dtype=np.float32).reshape(-1, 28, 28, 1)
+        if len(x) == 0:
+            return np.empty((0, 10), dtype=np.float32)
+        return np.concatenate([self.predict_on_batch(x[i:i + batch_size])
+                               for i in range(0, len(x), batch_size)])
+
+# Funciones
+def load_tflite_model(keras_model, weights_path: Path, quantization: str) -> TFLiteModel:
+    """Carga el modelo TFLite exportado de unos weights, exportándolo antes si no existe
+
+    Parameters
+    ----------
+    keras_model : keras.Model
+        Modelo float32 con los weights cargados, solo se usa si hay que exportar
+    weights_path : Path
+        Ruta de los weights a partir de los que se exporta
+    quantization : str
+        'float16' o 'int8'
+
+    Returns
+    -------
+    TFLiteModel
+        Modelo listo para predecir
+    """
+    path = tflite_path(weights_path, quantization)
+    if not path.exists():
+        calibration = None
+        if quantization == 'int8':
+            from models.mnist_data import load_sample
+            imagenes, _ = load_sample(CALIBRATION_SIZE, split='train')
+            calibration = imagenes.reshape(-1, 28, 28, 1).astype(np.float32) / 255
+        path.write_bytes(export_tflite(keras_model, quantization, calibration))
+    return TFLiteModel.from_file(path)
+
+def parity_report(num_images: int = REPORT_SIZE) -> List[Dict]:
+    """Compara los backends TFLite con el modelo float32 sobre el test de MNIST
+
+    Parameters
+    ----------
+    num_images : int, optional
+        Número de imágenes de test a evaluar, by default REPORT_SIZE
+
+    Returns
+    -------
+    List[Dict]
+        Por backend: precisión, coincidencia de predicciones con float32,
+        diferencia máxima de probabilidades, latencia por imagen y tamaño
+    """
+    from models.convnet_model import WEIGHTS_FILE, build_model
+    from models.mnist_data import load_sample
+
+    weights_path = MODEL_PATH / WEIGHTS_FILE
+    keras_model = build_model()
+    keras_model.load_weights(weights_path, by_name=True, skip_mismatch=True)
+    imagenes, etiquetas = load_sample(num_images, split='test')
+    x = imagenes.reshape(-1, 28, 28, 1).astype(np.float32) / 255
+
+    backends = {'keras-float32': keras_model}
+    backends.update({f'tflite-{q}': load_tflite_model(keras_model, weights_path, q) for q in QUANTIZATIONS})
+    referencia = None
+    informe = []
+    for nombre, modelo in backends.items():
+        modelo.predict(x[:BATCH_SIZE], batch_size=BATCH_SIZE, verbose=0)
+        start = time.perf_counter()
+        probs = modelo.predict(x, batch_size=BATCH_SIZE, verbose=0)
+        segundos = time.perf_counter() - start
+        if referencia is None:
+            referencia = probs
+        informe.append({
+            'backend': nombre,
+            'accuracy': float((probs.argmax(axis=1) == etiquetas).mean()),
+            'agreement': float((probs.argmax(axis=1) == referencia.argmax(axis=1)).mean()),
+            'max_abs_diff': float(np.abs(probs - referencia).max()),
+            'us_per_image': 1e6 * segundos / len(x),
+            'size_kb': (weights_path.stat().st_size if nombre == 'keras-float32'
+                        else len(modelo.model_content)) / 1024,
+        })
+    return informe
+
+if __name__ == '__main__':
+    for fila in parity_report():
+        print('  '.join(f'{k}={v:.4f}' if isinstance(v, float) else f'{k}={v}' for k, v in fila.items()))
@@ -15,28 +15,93 @@
 """Script que recoge el código relacionado con la visualización de las
 características del modelo entrenado"""
 
+import math
+import os
 import time
 
+import pandas as pd
 import streamlit as st
 
-from models.convnet_model import get_model_summary
+from models.convnet_model import (get_model_layers, get_model_registry, get_model_summary,
+                                  get_model_timings, start_warm_up)
 from streamlit_func import show_sidebar, config_page
 
+# Constantes
+# Número máximo de veces que se reenvía el resumen al navegador durante el streaming
+MAX_ACTUALIZACIONES = 12
+# Duración total aproximada del streaming en segundos
+DURACION_STREAM = 1.0
+# Solo los procesos arrancados con KOPURU_OPERATOR=1 pueden cambiar la versión activa
+OPERATOR_ENV = 'KOPURU_OPERATOR'
+
 # funciones auxiliares
 def stream_model_info() -> None:
-    """Streamea la información del modelo"""
+    """Streamea la información del modelo por bloques de líneas. El número
+    de actualizaciones está acotado por MAX_ACTUALIZACIONES, sea cual sea
+    la longitud del resumen"""
+    lineas = get_model_summary().splitlines(keepends=True)
+    paso = max(1, math.ceil(len(lineas) / MAX_ACTUALIZACIONES))
+    pausa = DURACION_STREAM / math.ceil(len(lineas) / paso)
     stream_container = st.empty()
-    with stream_container:
-        output = ""
-        for letter in get_model_summary():
-            output += letter
-            st.code(output)
-            time.sleep(0.01)
+    for fin in range(paso, len(lineas) + paso, paso):
+        stream_container.code(''.join(lineas[:fin]))
+        time.sleep(pausa)
 
 def print_model_info() -> None:
     """Printea toda la información del modelo"""
     st.code(get_model_summary())
 
+def show_model_layers() -> None:
+    """Muestra la tabla por capas con la forma de salida, los parámetros y los FLOPs"""
+    df = pd.DataFrame(get_model_layers())
+    st.dataframe(df, use_container_width=True, hide_index=True,
+                 column_config={'parametros': st.column_config.NumberColumn('parámetros', format='%d'),
+                                'flops': st.column_config.NumberColumn('FLOPs por imagen', format='%d')})
+    col_params, col_flops = st.columns(2)
+    col_params.metric('Parámetros', f"{df['parametros'].sum():,}")
+    col_flops.metric('MFLOPs por imagen', f"{df['flops'].sum() / 1e6:.2f}")
+
+def operator_mode() -> bool:
+    """Indica si el proceso se ha arrancado en modo operador (KOPURU_OPERATOR=1)"""
+    return os.environ.get(OPERATOR_ENV, '').lower() in ('1', 'true', 'yes', 'si', 'sí')
+
+def activate_version() -> None:
+    """Callback del botón Activar: cambia la versión activa por la elegida"""
+    if not operator_mode():
+        return
+    drenado = get_model_registry().activate(st.session_state['version_elegida'])
+    if not drenado:
+        st.session_state['aviso_version'] = 'Algunas predicciones de la versión anterior no terminaron a tiempo.'
+
+def show_model_versions() -> None:
+    """Muestra las versiones disponibles del modelo. En modo operador permite
+    cambiar la activa sin reiniciar el servidor; el cambio lo adoptan también
+    los demás procesos y todas las sesiones"""
+    registry = get_model_registry()
+    versiones = registry.versions()
+    st.dataframe(pd.DataFrame(versiones), use_container_width=True, hide_index=True,
+                 column_config={'size_kb': st.column_config.NumberColumn('tamaño (KB)', format='%.1f')})
+    if not operator_mode():
+        st.caption(f'Versión activa: {registry.active}. Para cambiarla arranca el servidor con '
+                   f'{OPERATOR_ENV}=1 o usa python -m models.registry --activate')
+        return
+    archivos = [v['archivo'] for v in versiones]
+    col_version, col_boton = st.columns([3, 1])
+    elegida = col_version.selectbox('Versión activa', archivos, index=archivos.index(registry.active),
+                                    key='version_elegida', label_visibility='collapsed')
+    col_boton.button('Activar', disabled=elegida == registry.active, on_click=activate_version)
+    if aviso := st.session_state.pop('aviso_version', None):
+        st.warning(aviso)
+
+def show_model_timings() -> None:
+    """Muestra los tiempos de importación, carga y primera inferencia del modelo"""
+    timings = get_model_timings()
+    col_import, col_load, col_inference = st.columns(3)
+    for col, clave, etiqueta in zip((col_import, col_load, col_inference),
+                                    ('import', 'load', 'first_inference'),
+                                    ('Importar TensorFlow', 'Cargar modelo', 'Primera inferencia')):
+        col.metric(etiqueta, f'{timings[clave]:.2f} s' if clave in timings else '-')
+
 def main_model() -> None:
     """Entry point de la app"""
 
@@ -44,10 +109,16 @@ def main_model() -> None:
     config_page()
     # Configuramos la sidebar también importando de streamlit_func
     show_sidebar()
+    # Adoptamos la versión del modelo elegida desde otro proceso, si ha cambiado
+    get_model_registry().sync()
+    # Precargamos el modelo en segundo plano si no se ha hecho ya
+    start_warm_up()
 
     st.title('Red Neuronal Convolucional')
     st.subheader('Dataset')
     st.image('img/MNIST Dataset example.JPG')
+    st.subheader('Versiones')
+    show_model_versions()
     st.subheader('Arquitectura')
 
     if st.session_state.get('session_flag') is None:
@@ -61,5 +132,11 @@ def main_model() -> None:
         # mostramos todo directamente
         print_model_info()
 
+    st.subheader('Capas')
+    show_model_layers()
+
+    st.subheader('Tiempos de carga')
+    show_model_timings()
+
 if __name__ == '__main__':
     main_model()
\ No newline at end of file
@@ -0,0 +1,80 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con la página de métricas de latencia de la app"""
+
+import math
+
+import pandas as pd
+import streamlit as st
+
+from metrics import get_registry
+from models.convnet_model import get_model_timings
+from streamlit_func import show_sidebar, config_page
+
+# funciones auxiliares
+def show_summary() -> None:
+    """Muestra la tasa de aciertos de la caché, el tamaño medio de los lotes,
+    la fracción de salidas tempranas de la cascada y el tiempo de carga del modelo"""
+    registry = get_registry()
+    hit_rate = registry.hit_rate('prediction_cache')
+    batches = registry.counters.get('forward_batches', 0)
+    media_lote = registry.counters.get('forward_images', 0) / batches if batches else math.nan
+    cascada = registry.counters.get('cascade_requests', 0)
+    salida_temprana = registry.counters.get('cascade_early_exits', 0) / cascada if cascada else math.nan
+    carga = get_model_timings().get('load')
+
+    col_cache, col_lote, col_cascada, col_carga = st.columns(4)
+    col_cache.metric('Aciertos de caché', '-' if math.isnan(hit_rate) else f'{hit_rate:.1%}')
+    col_lote.metric('Imágenes por lote', '-' if math.isnan(media_lote) else f'{media_lote:.1f}')
+    col_cascada.metric('Salida temprana', '-' if math.isnan(salida_temprana) else f'{salida_temprana:.1%}',
+                       help='Predicciones resueltas por la primera etapa de la cascada sin pasar por la convnet')
+    col_carga.metric('Carga del modelo', '-' if carga is None else f'{carga:.2f} s')
+
+def show_latencies() -> None:
+    """Muestra los percentiles de latencia de cada etapa"""
+    snapshot = get_registry().snapshot()
+    if not snapshot:
+        st.info('Todavía no hay métricas registradas.')
+        return
+    df = pd.DataFrame.from_dict(snapshot, orient='index')
+    df.index.name = 'etapa'
+    st.dataframe(df, use_container_width=True,
+                 column_config={col: st.column_config.NumberColumn(format='%.2f')
+                                for col in df.columns if col.endswith('_ms')})
+
+def main_metricas() -> None:
+    """Entry point de la página"""
+
+    # Configuración de la app como función en streamlit_func
+    config_page()
+    # Configuramos la sidebar también importando de streamlit_func
+    show_sidebar()
+
+    st.title('Métricas')
+    st.write('Latencias por etapa de las peticiones atendidas por este servidor.')
+    show_summary()
+    st.subheader('Latencias por etapa (ms)')
+    show_latencies()
+
+    registry = get_registry()
+    col_exportar, col_reiniciar = st.columns(2)
+    col_exportar.download_button('Exportar en formato Prometheus', registry.to_prometheus(),
+                                 file_name='metrics.prom', mime='text/plain')
+    if col_reiniciar.button('Reiniciar métricas'):
+        registry.reset()
+        st.rerun()
+
+if __name__ == '__main__':
+    main_metricas()
@@ -0,0 +1,181 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con la página de evaluación del modelo sobre el test de MNIST"""
+
+import time
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from ingestion import process_image
+from metrics import timer
+from models.calibration import NUM_VARIANTES, aggregate, augment
+from models.cascade import FirstStage, early_exits, get_cascade_threshold, get_first_stage
+from models.convnet_model import get_backend, get_model_registry, get_model_version
+from models.mnist_data import MNIST_DIR_ENV, SPLITS, load_mnist, mnist_dir
+from streamlit_func import show_sidebar, config_page
+
+# Constantes
+CHUNK_SIZE = 1000
+BATCH_SIZE = 256
+
+# funciones auxiliares
+@st.cache_resource(show_spinner=False)
+def get_evaluations() -> Dict[str, Dict]:
+    """Resultados de las evaluaciones ya terminadas, compartidos por todas las
+    sesiones. La clave incluye el hash del archivo de weights, así que unos
+    weights nuevos se evalúan de nuevo"""
+    return {}
+
+def show_progress(confusion: np.ndarray, placeholder_metricas, placeholder_matriz) -> None:
+    """Muestra la precisión acumulada y la matriz de confusión parcial"""
+    total = int(confusion.sum())
+    aciertos = int(np.trace(confusion))
+    with placeholder_metricas.container():
+        col_total, col_precision = st.columns(2)
+        col_total.metric('Imágenes evaluadas', f'{total:,}')
+        col_precision.metric('Precisión', f'{aciertos / total:.2%}' if total else '-')
+    placeholder_matriz.dataframe(pd.DataFrame(confusion), use_container_width=True)
+
+def evaluate(imagenes: np.ndarray, etiquetas: np.ndarray, placeholder_metricas, placeholder_matriz,
+             tta: bool = False, etapa: Optional[FirstStage] = None) -> Dict:
+    """Evalúa el modelo por bloques de CHUNK_SIZE imágenes, actualizando la
+    barra de progreso, la precisión y la matriz de confusión tras cada bloque
+
+    Parameters
+    ----------
+    imagenes : np.ndarray
+        Imágenes (N, 28, 28) uint8, puede ser un np.memmap
+    etiquetas : np.ndarray
+        Dígitos reales (N,)
+    tta : bool, optional
+        Promedia la predicción de las variantes del TTA de cada imagen, by default False
+    etapa : Optional[FirstStage], optional
+        Primera etapa de la cascada. Las imágenes en las que está segura no
+        pasan por la convnet, by default None
+
+    Returns
+    -------
+    Dict
+        Matriz de confusión final, imágenes evaluadas, salidas tempranas y duración
+    """
+    confusion = np.zeros((10, 10), dtype=np.int64)
+    salidas_tempranas = 0
+    progreso = st.progress(0.0, text='Evaluando...')
+    # Toda la evaluación usa la misma versión aunque se cambie la activa mientras tanto
+    with get_model_registry().lease(get_backend()) as model:
+        start = time.perf_counter()
+        for inicio in range(0, len(imagenes), CHUNK_SIZE):
+            fin = min(inicio + CHUNK_SIZE, len(imagenes))
+            with timer('evaluate_chunk'):
+                bloque = np.asarray(imagenes[inicio:fin])
+                preds = np.empty(len(bloque), dtype=np.int64)
+                completas = np.ones(len(bloque), dtype=bool)
+                if etapa is not None:
+                    probs_etapa = etapa.predict(bloque)
+                    salen = early_exits(probs_etapa, get_cascade_threshold())
+                    preds[salen], completas = probs_etapa[salen].argmax(axis=1), ~salen
+                    salidas_tempranas += int(salen.sum())
+                if tta:
+                    probs = aggregate(model.predict(process_image(augment(bloque[completas])),
+                                                    batch_size=BATCH_SIZE * NUM_VARIANTES, verbose=0))
+                elif completas.any():
+                    probs = model.predict(process_image(bloque[completas]), batch_size=BATCH_SIZE, verbose=0)
+                if completas.any():
+                    preds[completas] = probs.argmax(axis=1)
+            reales = np.asarray(etiquetas[inicio:fin], dtype=np.int64)
+            confusion += np.bincount(10 * reales + preds, minlength=100).reshape(10, 10)
+            progreso.progress(fin / len(imagenes), text=f'Evaluando... {fin:,} / {len(imagenes):,}')
+            show_progress(confusion, placeholder_metricas, placeholder_matriz)
+    progreso.empty()
+    return {'confusion': confusion, 'total': int(confusion.sum()), 'salidas_tempranas': salidas_tempranas,
+            'segundos': time.perf_counter() - start}
+
+def main_evaluacion() -> None:
+    """Entry point de la página"""
+
+    # Configuración de la app como función en streamlit_func
+    config_page()
+    # Configuramos la sidebar también importando de streamlit_func
+    show_sidebar()
+    # Adoptamos la versión del modelo elegida desde otro proceso, si ha cambiado
+    get_model_registry().sync()
+
+    st.title('Evaluación')
+    st.write('Precisión del modelo activo sobre el conjunto de test de MNIST.')
+
+    # La página nunca descarga: una descarga de ~11 MB bloquearía el script de la sesión
+    try:
+        imagenes, etiquetas = load_mnist('test', mmap=True, download=False)
+    except FileNotFoundError:
+        st.error(f'No se ha encontrado el test de MNIST en `{mnist_dir()}`. Copia en esa carpeta '
+                 f'`{SPLITS["test"][0]}` y `{SPLITS["test"][1]}` (también valen comprimidos en .gz), '
+                 f'o indica otra carpeta con la variable de entorno `{MNIST_DIR_ENV}`, y recarga la página. '
+                 'Se pueden descargar de https://yann.lecun.com/exdb/mnist/')
+        st.stop()
+    except Exception as exc:
+        st.error(f'No se ha podido leer el test de MNIST de `{mnist_dir()}`: {exc}')
+        st.stop()
+
+    # Con menos de CHUNK_SIZE imágenes el mínimo es el total disponible
+    num_imagenes = st.number_input('Imágenes a evaluar', min_value=min(CHUNK_SIZE, len(imagenes)),
+                                   max_value=len(imagenes), value=len(imagenes), step=CHUNK_SIZE)
+    tta = st.toggle('Aumentado en test (TTA)', help='Promedia la predicción de varias versiones desplazadas, '
+                                                   'giradas y escaladas de cada imagen')
+    # La cascada solo está disponible si se ha entrenado la primera etapa y no se usa con TTA
+    etapa = get_first_stage()
+    cascada = st.toggle('Cascada', disabled=etapa is None or tta,
+                        help='Las imágenes en las que la primera etapa supera el umbral de confianza '
+                             f'({get_cascade_threshold():g}) no pasan por la convnet. '
+                             'Se entrena con python -m models.cascade')
+    etapa = etapa if cascada and not tta else None
+    if tta:
+        modo = 'tta'
+    elif etapa is not None:
+        modo = f'cascada:{etapa.version}@{get_cascade_threshold():g}'
+    else:
+        modo = 'simple'
+    clave = f'{get_model_version()}:{get_backend()}:{num_imagenes}:{modo}'
+    evaluaciones = get_evaluations()
+
+    placeholder_metricas = st.empty()
+    st.write('Matriz de confusión (filas: dígito real, columnas: predicción)')
+    placeholder_matriz = st.empty()
+
+    if (resultado := evaluaciones.get(clave)) is None:
+        show_progress(np.zeros((10, 10), dtype=np.int64), placeholder_metricas, placeholder_matriz)
+        if st.button(f'Evaluar {num_imagenes:,} imágenes'):
+            resultado = evaluate(imagenes[:num_imagenes], etiquetas[:num_imagenes],
+                                 placeholder_metricas, placeholder_matriz, tta=tta, etapa=etapa)
+            evaluaciones[clave] = resultado
+    else:
+        show_progress(resultado['confusion'], placeholder_metricas, placeholder_matriz)
+        if st.button('Volver a evaluar'):
+            del evaluaciones[clave]
+            st.rerun()
+
+    if resultado is not None:
+        confusion = resultado['confusion']
+        st.caption(f"{resultado['total']:,} imágenes en {resultado['segundos']:.2f} s "
+                   f"({resultado['total'] / resultado['segundos']:,.0f} imágenes/s)"
+                   + (f". Salida temprana: {resultado['salidas_tempranas'] / resultado['total']:.1%}"
+                      if etapa is not None else ''))
+        st.subheader('Precisión por dígito')
+        st.bar_chart(pd.Series(np.diag(confusion) / np.maximum(confusion.sum(axis=1), 1), name='precision'))
+
+if __name__ == '__main__':
+    main_evaluacion()
@@ -0,0 +1,390 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Servidor HTTP de inferencia para otros servicios, sin pasar por la interfaz.
+
+Usa la librería estándar (ThreadingHTTPServer con HTTP/1.1 y keep-alive) y
+la misma ingesta que la app: decode_digit para las imágenes codificadas,
+process_image para el preprocesado y la validación de is_valid_image en su
+versión por lotes. Las predicciones siguen el mismo camino que los lotes
+de la app (models.pipeline): caché de predicciones, primera etapa de la
+cascada y convnet, con el mismo namespace de caché, así que una imagen ya
+predicha por la app o por el servidor no vuelve a pasar por el modelo. Lo que
+llega a la convnet de cada petición se encola entero en el agrupador de
+peticiones, que lo junta con lo que llegue a la vez y lanza una sola llamada.
+Lanzado con su propio proceso, el servidor tiene su propia caché en memoria
+y comparte con la app la de disco (KOPURU_CACHE_DB). Los aciertos de la caché
+y las salidas tempranas se cuentan en /metrics.
+
+Se arranca junto a la app con su propio proceso:
+
+    python -m server --port 8502
+
+o dentro del proceso de Streamlit, compartiendo el modelo cargado, definiendo
+KOPURU_HTTP_PORT antes de lanzar la app.
+
+Endpoints:
+
+    GET  /healthz   200 mientras el proceso responde
+    GET  /readyz    200 cuando el modelo está cargado y calentado, 503 antes
+    GET  /metrics   métricas en formato de texto de Prometheus
+    POST /predict   una imagen o un lote, según el Content-Type:
+        application/octet-stream  N imágenes 28x28 uint8 en crudo (N * 784 bytes)
+        image/png (o image/*)      una imagen en cualquier formato y tamaño
+        application/json           {"images": [[[...]]]} con arrays 28x28 o
+                                   {"png": ["<base64>", ...]} con imágenes codificadas
+
+La respuesta es un JSON con preds y confs (null en las imágenes no válidas),
+errors con el motivo de cada imagen descartada y la versión del modelo. Una
+petición mal formada responde 4xx con el motivo; un error inesperado se
+registra con logging, se cuenta en http_errors y responde 500.
+"""
+
+import argparse
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import streamlit as st
+
+from ingestion import ERROR_NO_VALIDA, are_valid_images, decode_digit
+from metrics import MetricsRegistry, get_registry
+from models.batcher import MicroBatcher
+from models.cache import PredictionCache, cache_from_env
+from models.calibration import get_calibrator as load_calibrator
+from models.cascade import get_cascade_threshold, get_first_stage
+from models.convnet_model import create_batcher, get_backend, get_batcher, get_model_registry, warm_up
+from models.pipeline import cache_namespace, predict_images
+from models.registry import ModelRegistry
+
+# Constantes
+HTTP_PORT_ENV = 'KOPURU_HTTP_PORT'
+HTTP_HOST_ENV = 'KOPURU_HTTP_HOST'
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 8502
+# Segundos que se mantiene abierta una conexión keep-alive sin peticiones
+KEEP_ALIVE_TIMEOUT = 30
+PREDICT_TIMEOUT = 60
+# Segundos mínimos entre dos comprobaciones de la versión activa compartida
+SYNC_INTERVAL = 1.0
+# Tamaño máximo del cuerpo de una petición (unas 85.000 imágenes en crudo)
+MAX_BODY = 64 * 1024 ** 2
+PIXELES = 28 * 28
+# Tipos de array admitidos en JSON: enteros con y sin signo y reales
+DTYPES_PIXELES = 'iuf'
+
+logger = logging.getLogger(__name__)
+
+# Clases
+class RequestError(Exception):
+    """Petición mal formada. Se responde con su código HTTP y el mensaje"""
+
+    def __init__(self, mensaje: str, status: int = 400) -> None:
+        super().__init__(mensaje)
+        self.status = status
+
+class InferenceService:
+    """Predicción de lotes con el modelo activo, compartida por las peticiones
+
+    Parameters
+    ----------
+    model_registry : ModelRegistry
+        Registro con el modelo activo
+    batcher : MicroBatcher
+        Agrupador que lanza los lotes contra ese modelo
+    registry : MetricsRegistry
+        Registro de métricas
+    """
+
+    def __init__(self, model_registry: ModelRegistry, batcher: MicroBatcher, registry: MetricsRegistry) -> None:
+        self.model_registry = model_registry
+        self.batcher = batcher
+        self.registry = registry
+        self.ready = threading.Event()
+        self.warm_up_error: Optional[str] = None
+        # Una caché por namespace: cambia con la versión del modelo, la cascada o la calibración
+        self._caches: Dict[str, PredictionCache] = {}
+        self._caches_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._last_sync = 0.0
+
+    def cache(self, namespace: str) -> PredictionCache:
+        """Devuelve la caché de predicciones de un namespace, creándola la primera vez"""
+        with self._caches_lock:
+            if namespace not in self._caches:
+                self._caches[namespace] = cache_from_env(namespace)
+            return self._caches[namespace]
+
+    def sync_model(self) -> None:
+        """Adopta la versión del modelo elegida desde otro proceso, como hace la
+        app en cada rerun. Se comprueba como mucho cada SYNC_INTERVAL segundos y
+        las peticiones que llegan mientras otra comprueba no la esperan"""
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._last_sync >= SYNC_INTERVAL:
+                self._last_sync = time.monotonic()
+                self.model_registry.sync()
+        except Exception:
+            # Se sigue sirviendo la versión actual
+            logger.exception('No se ha podido adoptar la versión activa compartida')
+        finally:
+            self._sync_lock.release()
+
+    def warm_up(self) -> None:
+        """Carga el modelo y lanza una inferencia de prueba. Hasta que termina
+        /readyz responde 503"""
+        try:
+            warm_up(self.model_registry)
+        except Exception as exc:
+            self.warm_up_error = f'{type(exc).__name__}: {exc}'
+            raise
+        self.ready.set()
+
+    def start_warm_up(self) -> threading.Thread:
+        """Lanza warm_up en un hilo en segundo plano"""
+        thread = threading.Thread(target=self.warm_up, name='http-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def predict(self, imagenes: np.ndarray) -> Dict:
+        """Valida y predice un lote (N, 28, 28) uint8 pasando por la caché,
+        la cascada y la convnet, igual que los lotes de la app
+
+        Returns
+        -------
+        Dict
+            preds y confs calibradas (None en las imágenes no válidas),
+            errors por índice y versión del modelo
+        """
+        self.sync_model()
+        validas = are_valid_images(imagenes)
+        preds: List[Optional[int]] = [None] * len(imagenes)
+        confs: List[Optional[float]] = [None] * len(imagenes)
+        if validas.any():
+            calibrador = load_calibrator(self.model_registry.active_path)
+            etapa, umbral = get_first_stage(), get_cascade_threshold()
+            namespace = cache_namespace(self.model_registry.version, get_backend(), etapa, umbral,
+                                        calibrador.temperature(False))
+
+            def forward(img_processed: np.ndarray) -> np.ndarray:
+                # Lo que no sale de la caché ni de la cascada entra entero en el agrupador:
+                # una sola llamada al modelo, junto con las peticiones que lleguen a la vez
+                return self.batcher.submit(img_processed).result(timeout=PREDICT_TIMEOUT)
+
+            preds_validas, confs_validas = predict_images(imagenes[validas], forward, self.cache(namespace),
+                                                          calibrador, self.registry, etapa=etapa, umbral=umbral)
+            for i, pred, conf in zip(np.flatnonzero(validas), preds_validas, confs_validas):
+                preds[i], confs[i] = int(pred), float(conf)
+        return {'preds': preds, 'confs': confs,
+                'errors': {str(i): ERROR_NO_VALIDA for i in np.flatnonzero(~validas)},
+                'version': self.model_registry.version}
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """Atiende las peticiones de una conexión. Con HTTP/1.1 la conexión se
+    reutiliza entre peticiones mientras el cliente no la cierre"""
+
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEP_ALIVE_TIMEOUT
+    service: InferenceService
+
+    def send_body(self, status: int, cuerpo: bytes, content_type: str) -> None:
+        """Responde con Content-Length, necesario para mantener la conexión abierta"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def send_json(self, status: int, datos: Dict) -> None:
+        self.send_body(status, json.dumps(datos).encode(), 'application/json')
+
+    def read_body(self) -> bytes:
+        """Lee el cuerpo completo de la petición según su Content-Length"""
+        try:
+            longitud = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            longitud = -1
+        if longitud < 0:
+            self.close_connection = True
+            raise RequestError('Content-Length no válido')
+        if longitud > MAX_BODY:
+            # No leemos el cuerpo, así que la conexión no se puede reutilizar
+            self.close_connection = True
+            raise RequestError(f'El cuerpo supera el máximo de {MAX_BODY} bytes', 413)
+        return self.rfile.read(longitud)
+
+    def do_GET(self) -> None:
+        servicio = self.service
+        if self.path == '/healthz':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/readyz':
+            if servicio.ready.is_set():
+                self.send_json(200, {'status': 'ready', 'version': servicio.model_registry.version})
+            else:
+                self.send_json(503, {'status': 'error' if servicio.warm_up_error else 'warming_up',
+                                     'error': servicio.warm_up_error})
+        elif self.path == '/metrics':
+            self.send_body(200, servicio.registry.to_prometheus().encode(), 'text/plain; version=0.0.4')
+        else:
+            self.send_json(404, {'error': f'Ruta no encontrada: {self.path}'})
+
+    def do_POST(self) -> None:
+        servicio = self.service
+        try:
+            if self.path != '/predict':
+                self.read_body()
+                raise RequestError(f'Ruta no encontrada: {self.path}', 404)
+            cuerpo = self.read_body()
+            with servicio.registry.timer('http_predict'):
+                imagenes = parse_images(cuerpo, self.headers.get('Content-Type', ''))
+                resultado = servicio.predict(imagenes)
+        except RequestError as exc:
+            self.send_json(exc.status, {'error': str(exc)})
+            return
+        except TimeoutError:
+            self.send_json(503, {'error': 'El modelo no ha respondido a tiempo'})
+            return
+        except Exception as exc:
+            # Un fallo inesperado no debe cortar la conexión sin respuesta
+            logger.exception('Error al atender %s', self.path)
+            servicio.registry.inc('http_errors')
+            self.send_json(500, {'error': f'Error interno: {type(exc).__name__}'})
+            return
+        servicio.registry.inc('http_requests')
+        servicio.registry.inc('http_images', len(imagenes))
+        self.send_json(200, resultado)
+
+    def log_message(self, format: str, *args) -> None:
+        # Sin una línea por petición en stderr, el tráfico se sigue con /metrics
+        pass
+
+# Funciones
+def decode_images(contenidos: List[bytes]) -> np.ndarray:
+    """Decodifica y normaliza al formato MNIST una lista de imágenes codificadas"""
+    imagenes = np.empty((len(contenidos), 28, 28), dtype=np.uint8)
+    for i, contenido in enumerate(contenidos):
+        try:
+            imagenes[i] = decode_digit(contenido)
+        except Exception as exc:
+            raise RequestError(f'No se ha podido leer la imagen {i}: {exc}')
+    return imagenes
+
+def parse_images(cuerpo: bytes, content_type: str) -> np.ndarray:
+    """Convierte el cuerpo de una petición en un lote (N, 28, 28) uint8
+
+    Parameters
+    ----------
+    cuerpo : bytes
+        Cuerpo de la petición
+    content_type : str
+        application/octet-stream, image/* o application/json
+
+    Returns
+    -------
+    np.ndarray
+        Imágenes sin procesar
+
+    Raises
+    ------
+    RequestError
+        Si el cuerpo no corresponde a ningún formato admitido
+    """
+    tipo = content_type.split(';')[0].strip().lower()
+    if tipo == 'application/octet-stream':
+        if not cuerpo or len(cuerpo) % PIXELES:
+            raise RequestError(f'El cuerpo debe tener N * {PIXELES} bytes, tiene {len(cuerpo)}')
+        return np.frombuffer(cuerpo, dtype=np.uint8).reshape(-1, 28, 28)
+    if tipo.startswith('image/'):
+        return decode_images([cuerpo])
+    if tipo == 'application/json':
+        try:
+            datos = json.loads(cuerpo)
+            if 'png' in datos:
+                return decode_images([base64.b64decode(imagen, validate=True) for imagen in datos['png']])
+            imagenes = np.asarray(datos['images'])
+        except (ValueError, TypeError, KeyError) as exc:
+            raise RequestError(f'JSON no válido, se espera "images" o "png": {exc}')
+        if imagenes.ndim == 2:
+            imagenes = imagenes[None]
+        if imagenes.dtype.kind not in DTYPES_PIXELES:
+            raise RequestError(f'Los píxeles deben ser números, se ha recibido {imagenes.dtype}')
+        if imagenes.shape[1:] != (28, 28) or len(imagenes) == 0:
+            raise RequestError(f'Las imágenes deben ser arrays (28, 28), se ha recibido {imagenes.shape}')
+        if not np.isfinite(imagenes).all() or imagenes.min() < 0 or imagenes.max() > 255:
+            raise RequestError('Los píxeles deben ser valores finitos entre 0 y 255')
+        return imagenes.astype(np.uint8)
+    raise RequestError(f'Content-Type no soportado: {content_type or "ninguno"}', 415)
+
+def create_server(service: InferenceService, host: str = HTTP_HOST, port: int = HTTP_PORT) -> ThreadingHTTPServer:
+    """Crea el servidor HTTP con un hilo por conexión"""
+    handler = type('Handler', (InferenceHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+@st.cache_resource(show_spinner=False)
+def start_http_server() -> Optional[ThreadingHTTPServer]:
+    """Arranca el servidor en un hilo del proceso de Streamlit, una única vez
+    por servidor, si se ha definido KOPURU_HTTP_PORT. Comparte con la app el
+    modelo cargado y el agrupador de peticiones
+
+    Returns
+    -------
+    Optional[ThreadingHTTPServer]
+        El servidor o None si no se ha configurado el puerto
+    """
+    if not (puerto := os.environ.get(HTTP_PORT_ENV)):
+        return None
+    # Fuera del hilo del script cache_resource no memoiza, así que los
+    # objetos compartidos se obtienen aquí y se pasan al servicio
+    servicio = InferenceService(get_model_registry(), get_batcher(), get_registry())
+    server = create_server(servicio, os.environ.get(HTTP_HOST_ENV, HTTP_HOST), int(puerto))
+    servicio.start_warm_up()
+    threading.Thread(target=server.serve_forever, name='http-inference', daemon=True).start()
+    return server
+
+def main() -> None:
+    """Entry point del servidor independiente"""
+    parser = argparse.ArgumentParser(prog='python -m server', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get(HTTP_HOST_ENV, HTTP_HOST), help='Dirección de escucha')
+    parser.add_argument('--port', type=int, default=int(os.environ.get(HTTP_PORT_ENV, HTTP_PORT)),
+                        help='Puerto de escucha')
+    args = parser.parse_args()
+
+    # Sin el runtime de Streamlit cada llamada a un cache_resource crea un objeto
+    # nuevo: creamos una vez el registro del modelo y el agrupador que lo usa
+    model_registry, registry = get_model_registry(), get_registry()
+    servicio = InferenceService(model_registry, create_batcher(model_registry, registry), registry)
+    server = create_server(servicio, args.host, args.port)
+    servicio.start_warm_up()
+    print(f'Sirviendo en http://{args.host}:{server.server_port}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        servicio.batcher.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Script con el estado de sesión de la app.
+
+Cada tab se ejecuta por separado, así que el estado que comparten (la
+imagen o el lote cargado y las predicciones) vive en un único objeto
+tipado guardado en st.session_state en lugar de en claves sueltas.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import uuid
+
+import numpy as np
+import streamlit as st
+
+# Constantes
+CLAVE_SESION = 'app'
+
+# Clases
+@dataclass
+class AppSession:
+    """Estado compartido por las tabs de una sesión
+
+    Attributes
+    ----------
+    id : str
+        Identificador de la sesión. El historial solo descarta como duplicados
+        los archivos que la misma sesión ya ha guardado
+    lote : bool
+        True si se ha elegido el modo de carga por lote
+    nombre_imagen : Optional[str]
+        Nombre de la imagen (o descripción del lote) cargada y validada, None si no hay
+    img_array : Optional[np.ndarray]
+        Imagen (28, 28) normalizada en modo individual
+    nombres_lote : List[str]
+        Nombres de las imágenes válidas del lote
+    lote_array : Optional[np.ndarray]
+        Imágenes (N, 28, 28) válidas del lote
+    ultima_prediccion : Optional[Dict]
+        Predicción de la imagen individual: archivo, pred y conf
+    predicciones_lote : Optional[List[Dict]]
+        Predicciones del lote, una por imagen
+    historial_importado : Optional[str]
+        Id del último archivo de historial importado, para no importarlo en cada rerun
+    aviso : Optional[str]
+        Mensaje que una tab deja para mostrarlo tras volver a ejecutar la app
+    """
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    lote: bool = False
+    nombre_imagen: Optional[str] = None
+    img_array: Optional[np.ndarray] = None
+    nombres_lote: List[str] = field(default_factory=list)
+    lote_array: Optional[np.ndarray] = None
+    ultima_prediccion: Optional[Dict] = None
+    predicciones_lote: Optional[List[Dict]] = None
+    historial_importado: Optional[str] = None
+    aviso: Optional[str] = None
+
+    def reset_predictions(self) -> None:
+        """Borra las predicciones cuando se cambia de imagen cargada o de modo"""
+        self.ultima_prediccion = None
+        self.predicciones_lote = None
+
+    def clear_upload(self) -> None:
+        """Olvida la imagen o el lote cargado. Se llama al principio de cada
+        ejecución completa, antes de volver a leer los archivos subidos"""
+        self.nombre_imagen = None
+        self.img_array = None
+        self.nombres_lote = []
+        self.lote_array = None
+
+# Funciones
+def get_session() -> AppSession:
+    """Devuelve el estado de la sesión actual, creándolo la primera vez"""
+    if CLAVE_SESION not in st.session_state:
+        st.session_state[CLAVE_SESION] = AppSession()
+    return st.session_state[CLAVE_SESION]
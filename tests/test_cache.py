@@ -0,0 +1,81 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests de la caché de predicciones: LRU en memoria, caducidad y poda del disco"""
+
+import numpy as np
+import pytest
+
+from models import cache as cache_module
+from models.cache import FRACCION_PODA, PredictionCache
+
+# Clases
+class Reloj:
+    """Sustituye a time.time para avanzar el tiempo a mano"""
+
+    def __init__(self) -> None:
+        self.ahora = 1_000_000.0
+
+    def __call__(self) -> float:
+        return self.ahora
+
+@pytest.fixture
+def reloj(monkeypatch):
+    reloj = Reloj()
+    monkeypatch.setattr(cache_module.time, 'time', reloj)
+    return reloj
+
+# Tests
+def test_lru_en_memoria_expulsa_la_menos_usada():
+    cache = PredictionCache(max_size=2)
+    cache.put('a', 1, 0.9)
+    cache.put('b', 2, 0.8)
+    assert cache.get('a') == (1, 0.9)
+    cache.put('c', 3, 0.7)
+    assert cache.get('b') is None
+    assert cache.get('a') == (1, 0.9) and cache.get('c') == (3, 0.7)
+    assert cache.stats()['size'] == 2
+
+def test_ttl_caduca_en_memoria_y_en_disco(tmp_path, reloj):
+    cache = PredictionCache(ttl=10, db_path=tmp_path / 'cache.sqlite3')
+    cache.put('a', 1, 0.9)
+    reloj.ahora += 5
+    assert cache.get('a') == (1, 0.9)
+    reloj.ahora += 10
+    assert cache.get('a') is None
+    # Al abrir la base de datos se borran las caducadas
+    assert PredictionCache(ttl=10, db_path=tmp_path / 'cache.sqlite3').disk_size() == 0
+
+def test_poda_del_disco_por_ultimo_uso(tmp_path, reloj):
+    cache = PredictionCache(max_size=1, db_path=tmp_path / 'cache.sqlite3', max_disk_rows=10)
+    for i in range(10):
+        reloj.ahora += 1
+        cache.put(f'k{i}', i % 10, 0.5)
+    # k0 se usa de nuevo y pasa a ser de las más recientes
+    reloj.ahora += 1
+    assert cache.get('k0') == (0, 0.5)
+    reloj.ahora += 1
+    cache.put('k10', 0, 0.5)
+    assert cache.disk_size() == int(10 * FRACCION_PODA)
+    otra = PredictionCache(db_path=tmp_path / 'cache.sqlite3', max_disk_rows=10)
+    assert otra.get('k0') is not None and otra.get('k10') is not None
+    assert otra.get('k1') is None and otra.get('k2') is None
+
+def test_namespace_separa_digests_y_clear():
+    img = np.zeros((28, 28), dtype=np.uint8)
+    a, b = PredictionCache(namespace='v1'), PredictionCache(namespace='v2')
+    assert a.digest(img) != b.digest(img)
+    a.put(a.digest(img), 1, 0.5)
+    a.clear()
+    assert a.get(a.digest(img)) is None and a.stats()['hits'] == 0
@@ -0,0 +1,52 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests del ajuste de la temperatura de calibración"""
+
+import numpy as np
+import pytest
+
+from models.calibration import TEMPERATURA_MIN, apply_temperature, fit_temperature, negative_log_likelihood
+
+# Funciones auxiliares
+def muestra(temperatura: float, n: int = 20_000, seed: int = 0):
+    """Probabilidades de un modelo y etiquetas muestreadas de esas mismas
+    probabilidades con la temperatura indicada: la temperatura óptima es esa"""
+    rng = np.random.default_rng(seed)
+    logits = rng.normal(scale=3.0, size=(n, 10))
+    probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probs /= probs.sum(axis=1, keepdims=True)
+    reales = apply_temperature(probs, temperatura)
+    etiquetas = (reales.cumsum(axis=1) > rng.random((n, 1))).argmax(axis=1)
+    return probs, etiquetas
+
+# Tests
+@pytest.mark.parametrize('temperatura', [0.5, 1.0, 2.5])
+def test_fit_temperature_recupera_la_temperatura(temperatura):
+    probs, etiquetas = muestra(temperatura)
+    assert fit_temperature(probs, etiquetas) == pytest.approx(temperatura, rel=0.1)
+
+def test_fit_temperature_minimiza_la_nll():
+    probs, etiquetas = muestra(1.8, seed=1)
+    t = fit_temperature(probs, etiquetas)
+    nll = negative_log_likelihood(apply_temperature(probs, t), etiquetas)
+    for otra in (t * 0.8, t * 1.25, 1.0):
+        assert nll <= negative_log_likelihood(apply_temperature(probs, otra), etiquetas)
+
+def test_fit_temperature_dentro_de_los_limites():
+    # Un modelo que siempre acierta con confianza baja pide la temperatura mínima
+    probs = np.full((100, 10), 0.05)
+    probs[:, 0] = 0.55
+    t = fit_temperature(probs, np.zeros(100, dtype=int))
+    assert TEMPERATURA_MIN <= t <= 2 * TEMPERATURA_MIN
@@ -0,0 +1,43 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests de la reducción de series con LTTB"""
+
+import numpy as np
+
+from charts import lttb
+
+# Tests
+def test_lttb_no_toca_series_cortas():
+    y = np.arange(10, dtype=float)
+    x, y_reducida = lttb(y, num_puntos=20)
+    np.testing.assert_array_equal(x, np.arange(10))
+    np.testing.assert_array_equal(y_reducida, y)
+
+def test_lttb_reduce_a_num_puntos_conservando_extremos():
+    rng = np.random.default_rng(0)
+    y = rng.random(10_000)
+    y[4321] = 10.0
+    x, y_reducida = lttb(y, num_puntos=100)
+    assert len(x) == len(y_reducida) == 100
+    assert x[0] == 0 and x[-1] == len(y) - 1
+    assert np.all(np.diff(x) > 0)
+    np.testing.assert_array_equal(y_reducida, y[x])
+    # El pico destaca sobre el resto y tiene que sobrevivir a la reducción
+    assert 4321 in x
+
+def test_lttb_serie_monotona_sigue_siendo_monotona():
+    y = np.cumsum(np.ones(5_000))
+    _, y_reducida = lttb(y, num_puntos=50)
+    assert np.all(np.diff(y_reducida) > 0)
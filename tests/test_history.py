@@ -0,0 +1,107 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests del historial de evaluaciones: lotes atómicos y varios procesos sobre la misma base de datos"""
+
+import sqlite3
+
+import pytest
+
+from history import HistoryStore
+
+# Funciones auxiliares
+def evaluacion(archivo: str, sesion: str = '', pred: int = 3, real: int = 3) -> dict:
+    return {'archivo': archivo, 'pred': pred, 'conf': 0.5, 'real': real, 'timestamp': 1704106800, 'sesion': sesion}
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / 'historial.sqlite3'
+
+# Tests
+def test_add_many_no_guarda_nada_si_una_fila_no_es_valida(db_path):
+    store = HistoryStore(db_path)
+    store.add(evaluacion('previa.png'))
+    with pytest.raises(ValueError, match='Evaluación 1'):
+        store.add_many([evaluacion('a.png'), {**evaluacion('b.png'), 'pred': 10}, evaluacion('c.png')])
+    assert len(store) == 1 and 'a.png' not in store
+    assert store.stats.total == 1
+    assert len(HistoryStore(db_path)) == 1
+
+def test_add_many_deshace_el_lote_si_falla_la_escritura(db_path):
+    store = HistoryStore(db_path)
+    store.add(evaluacion('previa.png'))
+    version = store.version
+    # La segunda fila pasa la validación pero SQLite la rechaza a mitad del lote
+    store._db.execute("CREATE TRIGGER rechazo BEFORE INSERT ON historial WHEN NEW.archivo = 'b.png' "
+                      "BEGIN SELECT RAISE(ABORT, 'rechazada'); END")
+    with pytest.raises(sqlite3.IntegrityError):
+        store.add_many([evaluacion('a.png'), evaluacion('b.png')])
+    assert len(store) == 1 and 'a.png' not in store
+    assert store.version == version
+    assert store.stats.confusion.sum() == 1
+    assert store.add(evaluacion('a.png'))
+    assert list(HistoryStore(db_path).columns()['archivo']) == ['previa.png', 'a.png']
+
+def test_sync_carga_lo_guardado_por_otro_proceso(db_path):
+    a, b = HistoryStore(db_path), HistoryStore(db_path)
+    a.add(evaluacion('x1.png'))
+    # b inserta después de que a haya guardado: no puede saltarse la fila de a
+    b.add(evaluacion('x2.png'))
+    assert 'x1.png' in b and len(b) == 2
+    assert b.sync() == 0
+    assert a.sync() == 1
+    assert list(a.columns()['archivo']) == list(b.columns()['archivo']) == ['x1.png', 'x2.png']
+
+def test_duplicados_por_sesion(db_path):
+    a, b = HistoryStore(db_path), HistoryStore(db_path)
+    assert a.add(evaluacion('1.png', 's1'))
+    assert not a.add(evaluacion('1.png', 's1'))
+    assert not b.add(evaluacion('1.png', 's1'))
+    assert b.add(evaluacion('1.png', 's2'))
+    a.sync()
+    assert a.saved('1.png', 's2') and not a.saved('1.png', 's3')
+    assert len(a) == len(b) == 2
+
+def test_clear_se_propaga_a_otros_procesos(db_path):
+    a, b = HistoryStore(db_path), HistoryStore(db_path)
+    a.add_many([evaluacion('a.png'), evaluacion('b.png')])
+    b.sync()
+    a.clear()
+    b.sync()
+    assert len(b) == 0 and b.stats.total == 0
+    b.add(evaluacion('c.png'))
+    a.sync()
+    assert list(a.columns()['archivo']) == ['c.png']
+
+def test_sync_descarta_filas_no_validas(db_path):
+    store = HistoryStore(db_path)
+    db = sqlite3.connect(db_path)
+    db.execute("INSERT INTO historial (archivo, pred, conf, real, timestamp) VALUES ('mala.png', 12, 0.5, 3, 0)")
+    db.commit()
+    db.close()
+    store.add(evaluacion('buena.png'))
+    assert 'mala.png' not in store and 'buena.png' in store
+    assert len(store.descartadas) == 1
+
+def test_migra_tablas_con_archivo_unico(db_path):
+    db = sqlite3.connect(db_path)
+    db.execute('''CREATE TABLE historial (id INTEGER PRIMARY KEY AUTOINCREMENT, archivo TEXT NOT NULL UNIQUE,
+                  pred INTEGER NOT NULL, conf REAL NOT NULL, real INTEGER NOT NULL, fecha TEXT NOT NULL,
+                  timestamp REAL NOT NULL)''')
+    db.execute("INSERT INTO historial (archivo, pred, conf, real, fecha, timestamp) VALUES ('1.png', 1, 0.5, 1, '', 0)")
+    db.commit()
+    db.close()
+    store = HistoryStore(db_path)
+    assert '1.png' in store
+    assert store.add(evaluacion('1.png', 'otra'))
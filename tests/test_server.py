@@ -0,0 +1,94 @@
+# Copyright 2024 Sergio Tejedor Moreno
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests de la lectura de los cuerpos de las peticiones del servidor HTTP"""
+
+import base64
+from io import BytesIO
+import json
+
+import numpy as np
+from PIL import Image
+import pytest
+
+from server import PIXELES, RequestError, parse_images
+
+# Funciones auxiliares
+def cuerpo_json(datos) -> bytes:
+    return json.dumps(datos).encode()
+
+# Tests
+def test_octet_stream():
+    imagenes = np.arange(2 * PIXELES, dtype=np.uint8).reshape(2, 28, 28)
+    np.testing.assert_array_equal(parse_images(imagenes.tobytes(), 'application/octet-stream'), imagenes)
+
+def test_octet_stream_de_longitud_incorrecta():
+    with pytest.raises(RequestError, match='N \\* 784'):
+        parse_images(b'\x00' * (PIXELES + 1), 'application/octet-stream')
+
+def test_json_una_imagen_y_lote():
+    imagen = np.full((28, 28), 7, dtype=np.uint8)
+    una = parse_images(cuerpo_json({'images': imagen.tolist()}), 'application/json; charset=utf-8')
+    assert una.shape == (1, 28, 28) and una.dtype == np.uint8
+    lote = parse_images(cuerpo_json({'images': [imagen.tolist()] * 3}), 'application/json')
+    assert lote.shape == (3, 28, 28)
+
+def test_json_acepta_floats_enteros_en_rango():
+    imagen = np.full((28, 28), 254.0)
+    assert parse_images(cuerpo_json({'images': imagen.tolist()}), 'application/json').max() == 254
+
+def test_json_rechaza_booleanos():
+    with pytest.raises(RequestError, match='números'):
+        parse_images(cuerpo_json({'images': [[True] * 28] * 28}), 'application/json')
+
+@pytest.mark.parametrize('pixel, mensaje', [
+    ('7', 'números'),
+    (None, 'números'),
+    (256, 'entre 0 y 255'),
+    (-1, 'entre 0 y 255'),
+])
+def test_json_rechaza_pixeles_no_validos(pixel, mensaje):
+    imagen = [[0] * 28 for _ in range(28)]
+    imagen[5][5] = pixel
+    with pytest.raises(RequestError, match=mensaje):
+        parse_images(cuerpo_json({'images': imagen}), 'application/json')
+
+def test_json_rechaza_nan():
+    cuerpo = cuerpo_json({'images': [[0] * 28] * 28}).replace(b'0', b'NaN', 1)
+    with pytest.raises(RequestError, match='finitos'):
+        parse_images(cuerpo, 'application/json')
+
+@pytest.mark.parametrize('imagenes', [[[0] * 27] * 28, [], [[[0] * 28] * 28, [[0] * 28] * 27]])
+def test_json_rechaza_formas_no_validas(imagenes):
+    with pytest.raises(RequestError):
+        parse_images(cuerpo_json({'images': imagenes}), 'application/json')
+
+@pytest.mark.parametrize('cuerpo', [b'{no es json', cuerpo_json({'otra': 1}), cuerpo_json({'png': ['%%%']})])
+def test_json_mal_formado(cuerpo):
+    with pytest.raises(RequestError) as exc:
+        parse_images(cuerpo, 'application/json')
+    assert exc.value.status == 400
+
+def test_json_png_en_base64():
+    buffer = BytesIO()
+    imagen = np.zeros((28, 28), dtype=np.uint8)
+    imagen[8:20, 12:16] = 255
+    Image.fromarray(imagen).save(buffer, format='PNG')
+    lote = parse_images(cuerpo_json({'png': [base64.b64encode(buffer.getvalue()).decode()]}), 'application/json')
+    assert lote.shape == (1, 28, 28) and lote.max() > 0
+
+def test_content_type_no_soportado():
+    with pytest.raises(RequestError) as exc:
+        parse_images(b'hola', 'text/plain')
+    assert exc.value.status == 415